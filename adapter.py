@@ -1,36 +1,302 @@
+import time
+# 冷启动计时的起点（导入依赖之前），见 /startup/status
+STARTUP_STARTED = time.perf_counter()
 import os
+import sys
 import httpx
 from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import StreamingResponse, JSONResponse
+from fastapi.responses import StreamingResponse, JSONResponse, PlainTextResponse, FileResponse
 import json
-import time
 import uuid
 import logging
-from logging.handlers import RotatingFileHandler
-from dotenv import load_dotenv, find_dotenv, set_key
+import random
+from queue import SimpleQueue
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
+from dotenv import load_dotenv, find_dotenv, set_key, dotenv_values
 from datetime import datetime
+from email.parser import BytesParser
+from email import policy as email_policy
 import asyncio
+import hashlib
+import math
+from collections import deque, OrderedDict
+from typing import Optional
+from relay import UpstreamSSEParser, OpenAIChunkWriter, raw_byte_stream, coalesce_deltas
+from metrics import Registry
+from expire import decode_jwt
+from coordination import SharedState
+from transport import UpstreamTransport
+from batches import BatchStore
 
 # --- Configuration ---
+# load_dotenv 之前的进程环境变量。凭据只从这里和最新解析的 .env 中查找，
+# 否则从 .env 删掉的 JM_TOKEN_<名称> 会因为 load_dotenv 留在 os.environ 里的旧值继续生效
+PROCESS_ENV = dict(os.environ)
 load_dotenv(find_dotenv())
-BASE_URL = "https://jmapi.xjtlu.edu.cn/api/chat"
+# 可用环境变量 XIPUAI_BASE_URL 指向本地的 mock_upstream.py 做压测
+BASE_URL = os.getenv("XIPUAI_BASE_URL", "https://jmapi.xjtlu.edu.cn/api/chat")
 SESSION_API_URL = f"{BASE_URL}/saveSession?sf_request_type=ajax"
 CHAT_API_URL = f"{BASE_URL}/completions?sf_request_type=fetch"
 DELETE_SESSION_URL = f"{BASE_URL}/delSession?sf_request_type=ajax"
 
 # --- Tweakable Parameters ---
+# 上游调用之间的初始最小间隔（秒），由全局调度器统一执行，而不是每个请求各睡一次
 INTER_REQUEST_DELAY = 1.0 
 ENABLE_AUTO_DELETION = True
 
+# ===================================================================
+# ==                    上游限速调度器配置                         ==
+# ===================================================================
+# 所有上游调用（saveSession / completions / delSession / 心跳）共用一个调度器
+# 间隔的下限和上限（秒）
+UPSTREAM_INTERVAL_MIN = 0.5
+UPSTREAM_INTERVAL_MAX = 10.0
+# 遇到 "Request too fast" / 429 时间隔乘以该系数
+UPSTREAM_BACKOFF_FACTOR = 2.0
+# 连续成功多少次后把间隔缩短一步，以及每步缩短的秒数
+UPSTREAM_RECOVERY_STREAK = 10
+UPSTREAM_RECOVERY_STEP = 0.1
+# ===================================================================
+
+# ===================================================================
+# ==                    响应缓存配置                               ==
+# ===================================================================
+# 相同模型、参数和消息的请求直接从内存返回（默认关闭）
+ENABLE_RESPONSE_CACHE = False
+# 只缓存 temperature 不高于该值的请求
+RESPONSE_CACHE_MAX_TEMPERATURE = 0.0
+# 缓存条目过期时间（秒）、最大条目数和总字节上限
+RESPONSE_CACHE_TTL = 3600
+RESPONSE_CACHE_MAX_ENTRIES = 1000
+RESPONSE_CACHE_MAX_BYTES = 64 * 1024 * 1024
+# ===================================================================
+
+# 完全相同的并发请求共享同一次上游生成（客户端可用 Cache-Control: no-cache 跳过）。默认关闭。
+# 只对 temperature 不高于 RESPONSE_CACHE_MAX_TEMPERATURE 的确定性请求生效，高温度的请求本来就应该得到不同的回答
+ENABLE_REQUEST_COALESCING = False
+
+# ===================================================================
+# ==                    对话保持模式配置                           ==
+# ===================================================================
+# 启用后，回答完成的会话不立即删除，而是按 (参数, 完整对话历史) 的指纹保留下来。
+# 客户端下一轮带着同样的历史再追加新消息时，只把新消息发给这个会话，不再整段拼接上传；
+# 历史对不上（被编辑、截断或重新生成）时退回到完整拼接并使用新会话。默认关闭。
+ENABLE_CONVERSATION_AFFINITY = False
+# 每个账号最多保留的对话会话数，超出时删除最久未用的
+AFFINITY_MAX_SESSIONS = 8
+# 对话会话闲置多久后删除（秒）
+AFFINITY_TTL = 1800
+# ===================================================================
+
+# ===================================================================
+# ==                    重试与对冲配置                             ==
+# ===================================================================
+# 创建会话、以及 completions 在第一个片段之前失败时，按错误分类重试（带抖动的指数退避）
+ENABLE_UPSTREAM_RETRY = True
+# 每次调用最多尝试的次数（含第一次）
+RETRY_MAX_ATTEMPTS = 3
+# 第 n 次重试前等待 0 ~ min(RETRY_BACKOFF_MAX, RETRY_BACKOFF_BASE * 2^(n-1)) 秒
+RETRY_BACKOFF_BASE = 0.5
+RETRY_BACKOFF_MAX = 8.0
+# 值得重试的错误类别："Request too fast"、5xx、超时、网络错误、会话失效、README 中的 "Request Err!"
+RETRYABLE_ERRORS = ("rate_limited", "server_error", "timeout", "network", "session_invalid", "request_error")
+# 重试预算：每个新请求存入 RETRY_BUDGET_RATIO 个令牌（最多 RETRY_BUDGET_MAX 个），每次重试或对冲取走一个，
+# 上游整体出问题时重试不会把负载成倍放大
+RETRY_BUDGET_RATIO = 0.2
+RETRY_BUDGET_MAX = 10
+# 对冲：首字延迟超过最近 HEDGE_WINDOW 个样本的 HEDGE_PERCENTILE 分位数时，在另一个会话上再发一个备份请求，
+# 先出首字的一方胜出，另一方被取消。需要先积累 HEDGE_MIN_SAMPLES 个样本；有请求在排队时不对冲。默认关闭
+ENABLE_HEDGING = False
+HEDGE_PERCENTILE = 0.95
+HEDGE_MIN_SAMPLES = 20
+HEDGE_WINDOW = 200
+HEDGE_MIN_DELAY = 1.0
+# ===================================================================
+
+# ===================================================================
+# ==                    准入控制配置                               ==
+# ===================================================================
+# 同时进行的上游生成数上限（每个进程），超出的请求排队，不会一下子占满会话配额和限速。默认关闭
+ENABLE_ADMISSION_CONTROL = False
+ADMISSION_MAX_IN_FLIGHT = 10
+# 排队请求总数上限（满了返回 503）和单个客户端的排队上限（满了返回 429），均带 Retry-After
+ADMISSION_MAX_QUEUE = 100
+ADMISSION_MAX_QUEUE_PER_CLIENT = 20
+# 排队超过多久仍未轮到就返回 503（秒）
+ADMISSION_QUEUE_TIMEOUT = 60
+# 客户端用这个请求头声明优先级；数值越小越先放行，同一优先级内按客户端（API key 或来源 IP）轮转
+ADMISSION_PRIORITY_HEADER = "X-Priority"
+ADMISSION_PRIORITIES = {"high": 0, "normal": 1, "low": 2}
+# ===================================================================
+
+# ===================================================================
+# ==                    批量任务配置                               ==
+# ===================================================================
+# OpenAI 风格的 /v1/files + /v1/batches：上传 JSONL 后在后台逐条处理，任务状态和结果文件保存在 BATCH_DIR，重启后继续。
+# 默认关闭，关闭时这些接口返回 404
+ENABLE_BATCHES = False
+BATCH_DIR = "batches"
+# 同时处理的批量请求上限；只有上游调度器没有积压、准入队列里没有请求排队时才发出下一个
+BATCH_MAX_IN_FLIGHT = 2
+# 批量请求在准入控制中的优先级（见 ADMISSION_PRIORITIES），交互请求总是先放行
+BATCH_PRIORITY = "low"
+# 上传文件的大小上限（字节）和单个任务的请求数上限
+BATCH_MAX_FILE_BYTES = 100 * 1024 * 1024
+BATCH_MAX_REQUESTS = 50000
+# 支持的 completion_window 及其秒数，超时未完成的任务标记为 expired
+BATCH_COMPLETION_WINDOWS = {"24h": 86400}
+# 没有任务时检查新任务的间隔，以及等待上游空闲时的检查间隔（秒）
+BATCH_POLL_INTERVAL = 5.0
+BATCH_CAPACITY_CHECK_INTERVAL = 0.2
+# 处理进度只保存在内存里，攒够这么多行结果或隔这么多秒才写一次盘（同时取回其他进程收到的取消请求）；
+# 进程异常退出时还没写盘的请求会在重启后重新处理
+BATCH_SAVE_LINES = 50
+BATCH_SAVE_INTERVAL = 2.0
+# ===================================================================
+
+# ===================================================================
+# ==                    批量删除队列配置                           ==
+# ===================================================================
+# 用完的会话先进入队列，按批次调用 delSession（接口本身接受 ids 数组）
+# 定时刷新间隔（秒）
+DELETE_FLUSH_INTERVAL = 5.0
+# 队列中累积到这么多个会话时立即刷新
+DELETE_BATCH_SIZE = 10
+# 单次 delSession 最多携带的会话数
+DELETE_BATCH_MAX = 20
+# 删除失败的会话最多重试次数
+DELETE_MAX_RETRIES = 3
+# 存活会话数达到 SESSION_QUOTA - 该值时，创建新会话前先同步清空删除队列
+DELETE_QUOTA_MARGIN = 5
+# ===================================================================
+
+# 检查 .env 是否变化的间隔（秒）；凭据平时只从内存读取
+CREDENTIAL_CHECK_INTERVAL = 5.0
+
+# ===================================================================
+# ==                    上游连接配置                               ==
+# ===================================================================
+# 使用 HTTP/2 在一条连接上复用多个并发请求（需要 h2，见 libraries；上游不支持时自动退回 HTTP/1.1）
+UPSTREAM_HTTP2 = True
+# 连接池上限、保持的空闲连接数，以及空闲连接的保留时间（秒）
+UPSTREAM_MAX_CONNECTIONS = 20
+UPSTREAM_MAX_KEEPALIVE = 10
+UPSTREAM_KEEPALIVE_EXPIRY = 120.0
+# 控制类调用（saveSession / delSession / 心跳）的超时：连接超时和总的读写超时（秒）
+CONTROL_CONNECT_TIMEOUT = 5.0
+CONTROL_TIMEOUT = 20.0
+# 流式 completions 的超时：连接超时，以及两个片段之间允许的最长间隔（秒）
+STREAM_CONNECT_TIMEOUT = 5.0
+STREAM_READ_TIMEOUT = 120.0
+# 启动时预先建立到上游的连接（DNS + TCP + TLS），以及有过流量之后空闲多久重新预热（秒，0 表示不重新预热）；
+# 每个空闲期只预热一次，没有真实流量时不会定期访问上游
+ENABLE_CONNECTION_PREWARM = True
+PREWARM_IDLE_AFTER = 60
+# ===================================================================
+
+# ===================================================================
+# ==                    流式片段合并配置                           ==
+# ===================================================================
+# 把 STREAM_COALESCE_WINDOW 秒内到达的上游片段合并成一个 SSE 事件（0 表示逐个转发）；
+# 第一个片段和流结束时立即发出，缓冲超过 STREAM_COALESCE_MAX_BYTES 字节也立即发出
+STREAM_COALESCE_WINDOW = 0.0
+STREAM_COALESCE_MAX_BYTES = 512
+# 客户端可以用这个请求头按毫秒指定自己的合并窗口（0 表示不合并），不超过 STREAM_COALESCE_MAX_WINDOW 秒
+STREAM_COALESCE_HEADER = "X-Coalesce-Window"
+STREAM_COALESCE_MAX_WINDOW = 0.5
+# ===================================================================
+
+# ===================================================================
+# ==                    多进程模式配置                             ==
+# ===================================================================
+# 工作进程数（serve.py 通过环境变量 XIPUAI_WORKERS 传入）。大于 1 时各进程通过一个 SQLite 文件
+# 共享限速调度、会话配额计数和最近一次成功调用的时间，并选出一个进程负责心跳和令牌刷新。
+WORKERS = int(os.getenv("XIPUAI_WORKERS", "1"))
+SHARED_STATE_FILE = os.getenv("XIPUAI_STATE_FILE", os.path.join("logs", "adapter_state.db"))
+# 领导者租约时长和续租间隔（秒）；领导者进程退出后，其他进程最多 LEADER_LEASE_TTL 秒后接手
+LEADER_LEASE_TTL = 15
+LEADER_RENEW_INTERVAL = 5
+# ===================================================================
+
+# ===================================================================
+# ==                    令牌自动刷新配置                           ==
+# ===================================================================
+# 主账号的 JM_TOKEN 临近过期（按 JWT 的 exp 字段）时，在后台运行 auth.py 重新登录，
+# 新令牌写入 .env 后直接热替换，无需重启服务。需要 .env 中有 XJTLU_USERNAME / XJTLU_PASSWORD。默认关闭
+ENABLE_TOKEN_REFRESH = False
+# 提前多少秒开始刷新
+TOKEN_REFRESH_LEAD = 1800
+# 检查过期时间的间隔（秒）
+TOKEN_REFRESH_CHECK_INTERVAL = 60
+# 单次运行 auth.py 的超时时间（秒）
+TOKEN_REFRESH_TIMEOUT = 300
+# 刷新失败后多久再试（秒）
+TOKEN_REFRESH_RETRY_INTERVAL = 300
+# ===================================================================
+
+# 事件循环延迟的采样间隔（秒），结果见 /metrics
+EVENT_LOOP_LAG_INTERVAL = 0.5
+
+# ===================================================================
+# ==                    多账号配置                                 ==
+# ===================================================================
+# .env 中除 JM_TOKEN / SDP_SESSION / HEARTBEAT_SESSION_ID 外，
+# 还可以配置 JM_TOKEN_<名称> / SDP_SESSION_<名称> / HEARTBEAT_SESSION_ID_<名称>，
+# 每组对应一个独立账号，请求会分发到负载最低的可用账号。
+# 账号返回 403 或令牌错误后暂停使用的时间（秒），期满后允许试探一次；令牌更新后立即恢复
+ACCOUNT_COOLDOWN = 300
+# 判定为令牌错误的上游消息关键字
+TOKEN_ERROR_MARKERS = ("token", "登录", "login")
+# ===================================================================
+
 # ===================================================================
 # ==                    心跳保活机制配置                           ==
 # ===================================================================
-# 心跳间隔（秒）- 用户静默多长时间后开始发送心跳
+# 心跳间隔（秒）- 账号多长时间没有成功的上游调用（真实请求也算）后发送心跳
 HEARTBEAT_INTERVAL = 1200
+# 心跳调度两次检查之间的最短间隔（秒）
+HEARTBEAT_MIN_SLEEP = 5
 # 是否启用心跳功能
 ENABLE_HEARTBEAT = True
 # 心跳会话名称
 HEARTBEAT_SESSION_NAME = "Persistent Heartbeat Session"
+# 启动时本地解码 JM_TOKEN 的 exp：剩余有效期超过该值（秒）且 .env 中已有心跳会话ID时，不做网络探测
+STARTUP_PROBE_MIN_VALIDITY = 600
+# ===================================================================
+
+# ===================================================================
+# ==                    预热会话池配置                             ==
+# ===================================================================
+# 是否启用预热会话池（命中时跳过 saveSession 和 INTER_REQUEST_DELAY）
+ENABLE_SESSION_POOL = True
+# 每种参数组合 (model, temperature, max_tokens, penalties) 预热的会话数
+SESSION_POOL_SIZE_PER_KEY = 2
+# 池中空闲会话总数上限
+SESSION_POOL_MAX_IDLE = 10
+# 没有需要补充的会话时，两次检查之间的间隔（秒）。补充本身以低优先级经调度器预约时间槽，
+# 排在前台请求之后，有负载时也能在空出来的时间槽里补充
+SESSION_POOL_REFILL_INTERVAL = 3.0
+# 参数组合多久无人请求后停止预热（秒）
+SESSION_POOL_KEY_TTL = 600
+# 空闲会话最长保留时间（秒），超时后删除
+SESSION_POOL_MAX_IDLE_AGE = 1800
+# 服务器端会话总数上限（见 坑.md），以及为心跳和正在处理的请求保留的余量
+SESSION_QUOTA = 50
+SESSION_QUOTA_HEADROOM = 10
+# ===================================================================
+
+# ===================================================================
+# ==                    有上限的会话池配置                         ==
+# ===================================================================
+# 启用后每个账号同时持有的会话不超过 BOUNDED_POOL_MAX_SESSIONS 个，全部被占用时新请求排队等待。
+# 这只是给会话数量加上硬上限，并不省上游调用：生成过回答的会话在服务器端保存着那段对话，
+# 不能给下一个请求复用，用完后照样删除再新建，每个请求仍是一次 saveSession 加一次 delSession。
+# 预热好但还没用过的会话参数不同时，用带 id 的 saveSession 原地更新（见 tokentest.py）后租出。
+ENABLE_BOUNDED_SESSION_POOL = False
+# 每个账号同时持有的会话数量上限
+BOUNDED_POOL_MAX_SESSIONS = 8
+# 所有会话都被占用时等待的超时时间（秒）
+BOUNDED_POOL_WAIT_TIMEOUT = 60
 # ===================================================================
 
 AVAILABLE_MODELS = [
@@ -41,34 +307,441 @@ AVAILABLE_MODELS = [
 
 # --- Logging Setup ---
 LOG_DIR = "logs"
+LOG_MAX_BYTES = 5*1024*1024
+LOG_BACKUP_COUNT = 5
+# 提示词/请求内容的记录方式: "full" 完整记录, "truncate" 截断到 LOG_PROMPT_MAX_CHARS, "hash" 只记录长度和哈希, "off" 不记录
+LOG_PROMPT_MODE = "truncate"
+LOG_PROMPT_MAX_CHARS = 2000
+# 按路由抽样记录请求详情（0~1），未列出的路由全部记录；错误日志不受抽样影响
+LOG_SAMPLE_RATES = {
+    "/v1/chat/completions": 1.0,
+    "/v1/models": 1.0,
+}
+# 流量录制：每个 chat 请求写一行紧凑记录（到达时间、参数、提示词大小、片段时间、上游状态），
+# 可用 replay_traffic.py 按原始或缩放后的到达节奏回放；多进程模式下每个进程写自己的文件
+ENABLE_TRAFFIC_CAPTURE = False
+CAPTURE_FILE = os.path.join(LOG_DIR, "requests.jsonl")
+# 是否记录消息正文；关闭时每条消息只记录角色、长度和哈希，回放时用等长的占位文本代替
+CAPTURE_PROMPTS = False
+# 录制的抽样比例（0~1），以及每个请求最多记录的片段时间个数
+CAPTURE_SAMPLE_RATE = 1.0
+CAPTURE_MAX_CHUNK_TIMES = 1000
 os.makedirs(LOG_DIR, exist_ok=True)
 logger = logging.getLogger("adapter_logger")
 logger.setLevel(logging.INFO)
 log_filename = f"adapter_log_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}.log"
-file_handler = RotatingFileHandler(os.path.join(LOG_DIR, log_filename), maxBytes=5*1024*1024, backupCount=5, encoding='utf-8')
+if WORKERS > 1:
+    # 多进程模式下各进程同一秒启动，每个进程写自己的日志文件，否则会一起轮转同一个文件
+    root, ext = os.path.splitext(log_filename)
+    log_filename = f"{root}.{os.getpid()}{ext}"
+file_handler = RotatingFileHandler(os.path.join(LOG_DIR, log_filename), maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding='utf-8')
 formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
 file_handler.setFormatter(formatter)
+# 事件循环里只把日志记录放进队列，写文件由 QueueListener 的后台线程完成
+log_queue = SimpleQueue()
+log_listener = QueueListener(log_queue, file_handler, respect_handler_level=True)
 if not logger.handlers:
-    logger.addHandler(file_handler)
+    logger.addHandler(QueueHandler(log_queue))
+    log_listener.start()
+
+def log_sampled(route: str) -> bool:
+    """按 LOG_SAMPLE_RATES 决定本次请求是否记录详情"""
+    rate = LOG_SAMPLE_RATES.get(route, 1.0)
+    return rate >= 1.0 or random.random() < rate
+
+def summarize_text(text: str) -> str:
+    """按 LOG_PROMPT_MODE 把（可能很大的）文本压缩成适合写入日志的形式"""
+    if LOG_PROMPT_MODE == "full" or (LOG_PROMPT_MODE == "truncate" and len(text) <= LOG_PROMPT_MAX_CHARS):
+        return text
+    digest = f"len={len(text)} sha256={hashlib.sha256(text.encode('utf-8')).hexdigest()[:16]}"
+    if LOG_PROMPT_MODE == "truncate":
+        half = LOG_PROMPT_MAX_CHARS // 2
+        return f"{text[:half]} …[{digest}]… {text[-half:]}"
+    return digest
+
+def request_log_record(openai_request: dict) -> str:
+    """客户端请求的单行紧凑记录：参数 + 消息数量和大小，不含正文"""
+    messages = openai_request.get("messages") or []
+    record = {k: v for k, v in openai_request.items() if k != "messages"}
+    record["messages"] = len(messages)
+    record["roles"] = "".join(str(m.get("role", "?"))[:1] for m in messages if isinstance(m, dict))
+    record["chars"] = sum(len(str(m.get("content", ""))) for m in messages if isinstance(m, dict))
+    return json.dumps(record, ensure_ascii=False, separators=(",", ":"))
+
+class TrafficCapture:
+    """把 chat 请求的紧凑记录写入 JSONL 文件；写文件和日志一样由 QueueListener 的后台线程完成"""
+
+    def __init__(self, path: str):
+        if WORKERS > 1:
+            root, ext = os.path.splitext(path)
+            path = f"{root}.{os.getpid()}{ext}"
+        self.path = path
+        self.recorded = 0
+        self.queue = SimpleQueue()
+        self.logger = logging.getLogger("traffic_capture")
+        self.logger.setLevel(logging.INFO)
+        self.logger.propagate = False
+        handler = RotatingFileHandler(path, maxBytes=LOG_MAX_BYTES * 4, backupCount=LOG_BACKUP_COUNT, encoding='utf-8')
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        self.listener = QueueListener(self.queue, handler)
+        if not self.logger.handlers:
+            self.logger.addHandler(QueueHandler(self.queue))
+            self.listener.start()
+
+    def begin(self, openai_request: dict) -> Optional["TrafficRecord"]:
+        """开始记录一个请求；没有被抽中时返回 None"""
+        if CAPTURE_SAMPLE_RATE < 1.0 and random.random() >= CAPTURE_SAMPLE_RATE:
+            return None
+        return TrafficRecord(self, openai_request)
+
+    def write(self, record: dict):
+        self.recorded += 1
+        self.logger.info(json.dumps(record, ensure_ascii=False, separators=(",", ":")))
+
+    def stop(self):
+        self.listener.stop()
+
+    def status(self) -> dict:
+        return {"enabled": ENABLE_TRAFFIC_CAPTURE, "file": os.path.abspath(self.path), "recorded": self.recorded,
+                "prompts": "full" if CAPTURE_PROMPTS else "redacted", "sample_rate": CAPTURE_SAMPLE_RATE}
+
+
+class TrafficRecord:
+    """单个请求的录制记录：片段到达时间以相对到达时刻的毫秒数保存，请求结束时写出一次"""
+
+    def __init__(self, capture: TrafficCapture, openai_request: dict):
+        self.capture = capture
+        self.arrived = time.time()
+        self.started = time.perf_counter()
+        self.openai_request = openai_request
+        self.source = None
+        self.status = None
+        self.error = None
+        self.chunk_ms = []
+        self.chunks = 0
+        self.chars = 0
+        self.written = False
+
+    def chunk(self, data_content: str):
+        self.chunks += 1
+        self.chars += len(data_content)
+        if len(self.chunk_ms) < CAPTURE_MAX_CHUNK_TIMES:
+            self.chunk_ms.append(round((time.perf_counter() - self.started) * 1000))
+
+    def fail(self, error: BaseException):
+        """记录失败原因；只保留第一次（最接近源头的）失败"""
+        if self.status is not None:
+            return
+        if isinstance(error, (asyncio.CancelledError, GeneratorExit)):
+            self.status, self.error = 499, "disconnected"
+        elif isinstance(error, HTTPException):
+            self.status, self.error = error.status_code, getattr(error, "kind", None) or str(error.detail)[:200]
+        else:
+            self.status, self.error = 500, type(error).__name__
+
+    @staticmethod
+    def _message(message) -> dict:
+        if not isinstance(message, dict):
+            return {"role": "?", "chars": len(str(message))}
+        content = message.get("content", "")
+        text = content if isinstance(content, str) else json.dumps(content, ensure_ascii=False)
+        return {"role": message.get("role", "?"), "chars": len(text),
+                "sha256": hashlib.sha256(text.encode("utf-8")).hexdigest()[:16]}
+
+    def finish(self):
+        if self.written:
+            return
+        self.written = True
+        messages = self.openai_request.get("messages") or []
+        record = {
+            "t": round(self.arrived, 3),
+            "model": self.openai_request.get("model"),
+            "stream": bool(self.openai_request.get("stream", False)),
+            "params": {k: v for k, v in self.openai_request.items() if k not in ("model", "stream", "messages")},
+            "messages": messages if CAPTURE_PROMPTS else [self._message(m) for m in messages],
+            "prompt_chars": sum(self._message(m)["chars"] for m in messages),
+            "source": self.source,
+            "status": self.status or 200,
+            "error": self.error,
+            "ms": round((time.perf_counter() - self.started) * 1000),
+            "chunks": self.chunks,
+            "chars": self.chars,
+            "chunk_ms": self.chunk_ms,
+        }
+        self.capture.write(record)
+
+traffic_capture = TrafficCapture(CAPTURE_FILE) if ENABLE_TRAFFIC_CAPTURE else None
 
 # --- FastAPI App & Global Variables ---
 app = FastAPI(
     title="XJTLU GenAI Adapter (v12 - With Heartbeat)",
     description="添加了心跳保活机制的适配器"
 )
-client = httpx.AsyncClient(timeout=120.0)
+upstream = UpstreamTransport(
+    http2=UPSTREAM_HTTP2,
+    limits=httpx.Limits(max_connections=UPSTREAM_MAX_CONNECTIONS, max_keepalive_connections=UPSTREAM_MAX_KEEPALIVE,
+                        keepalive_expiry=UPSTREAM_KEEPALIVE_EXPIRY),
+    control_timeout=httpx.Timeout(CONTROL_TIMEOUT, connect=CONTROL_CONNECT_TIMEOUT),
+    stream_timeout=httpx.Timeout(STREAM_READ_TIMEOUT, connect=STREAM_CONNECT_TIMEOUT),
+)
+prewarm_task = None
 
 # 心跳相关全局变量
-heartbeat_session_id = None
 last_user_activity = time.time()
 heartbeat_task = None
+startup_probe_task = None
+loop_lag_task = None
+
+# 多进程模式下的共享状态；单进程时为 None，所有状态都在本进程内存中
+shared_state = SharedState(SHARED_STATE_FILE) if WORKERS > 1 else None
+
+def shared_write(method, *args):
+    """不需要结果的共享状态写操作：交给写线程后立即返回，失败只记录日志"""
+    def report(future):
+        if future.exception():
+            logger.warning(f"Shared state write {method.__name__} failed: {future.exception()}")
+    shared_state.post(method, *args).add_done_callback(report)
+
+class LeaderElection:
+    """多进程模式下选出唯一负责心跳和令牌刷新的进程；单进程时本进程总是领导者"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.is_leader = shared_state is None
+        self.task = None
+
+    async def renew(self) -> bool:
+        if shared_state is not None:
+            was_leader = self.is_leader
+            self.is_leader = await shared_state.call(shared_state.try_lead, self.name, LEADER_LEASE_TTL)
+            if self.is_leader != was_leader:
+                logger.info(f"👑 Worker {shared_state.owner} {'became' if self.is_leader else 'is no longer'} the {self.name} leader.")
+        return self.is_leader
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.sleep(LEADER_RENEW_INTERVAL)
+                await self.renew()
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                logger.error(f"Error in leader election loop: {e}", exc_info=True)
+
+    async def release(self):
+        if shared_state is not None and self.is_leader:
+            await shared_state.call(shared_state.release, self.name)
+            self.is_leader = False
+
+    def status(self) -> dict:
+        return {
+            "workers": WORKERS,
+            "worker": shared_state.owner if shared_state else str(os.getpid()),
+            "is_leader": self.is_leader,
+            "leader": shared_state.leader(self.name) if shared_state else str(os.getpid()),
+            "state_file": os.path.abspath(SHARED_STATE_FILE) if shared_state else None,
+        }
+
+leader = LeaderElection("background")
+
+# --- Metrics (Prometheus text format, served at /metrics) ---
+metrics = Registry()
+STAGE_SECONDS = metrics.histogram(
+    "xipuai_stage_seconds", "Duration of each chat pipeline stage.", ("stage", "model"))
+SCHEDULER_WAIT_SECONDS = metrics.histogram(
+    "xipuai_scheduler_wait_seconds", "Time upstream calls spent waiting for a scheduler slot.", ("kind",))
+REQUESTS_TOTAL = metrics.counter(
+    "xipuai_requests_total", "Chat completion requests by where the answer came from.", ("model", "source"))
+UPSTREAM_ERRORS = metrics.counter(
+    "xipuai_upstream_errors_total", "Upstream errors by account and status code or error type.", ("account", "code"))
+STREAM_CHUNKS = metrics.counter(
+    "xipuai_stream_chunks_total", "Text chunks received from the upstream completions stream.", ("model",))
+STREAM_CHARS = metrics.counter(
+    "xipuai_stream_chars_total", "Characters received from the upstream completions stream.", ("model",))
+STREAM_EVENTS = metrics.counter(
+    "xipuai_stream_events_total", "Content events sent to streaming clients, by coalescing window.", ("model", "window"))
+STREAM_EVENT_DELTAS = metrics.counter(
+    "xipuai_stream_event_deltas_total", "Upstream text chunks carried by those events (divide by events for the merge factor).", ("model", "window"))
+COALESCE_HOLD_SECONDS = metrics.histogram(
+    "xipuai_coalesce_hold_seconds", "How long the oldest chunk of each event waited in the coalescing buffer.", ("window",),
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5))
+REQUESTS_IN_FLIGHT = metrics.gauge(
+    "xipuai_requests_in_flight", "Chat completion requests currently being handled or streamed.")
+ADMISSION_WAIT_SECONDS = metrics.histogram(
+    "xipuai_admission_wait_seconds", "Time chat requests spent queued for an upstream generation slot.", ("priority",))
+ADMISSION_REJECTED = metrics.counter(
+    "xipuai_admission_rejected_total", "Chat requests shed by admission control.", ("reason",))
+UPSTREAM_RETRIES = metrics.counter(
+    "xipuai_upstream_retries_total", "Upstream calls retried, by operation and classified error.", ("operation", "kind"))
+RETRIES_DENIED = metrics.counter(
+    "xipuai_upstream_retries_denied_total", "Retryable upstream failures that were not retried.", ("operation", "reason"))
+HEDGES = metrics.counter(
+    "xipuai_hedged_requests_total", "Backup completions requests launched after a slow first token, by outcome.", ("outcome",))
+CLIENT_DISCONNECTS = metrics.counter(
+    "xipuai_client_disconnects_total", "Chat requests whose client went away before the response finished.", ("stage",))
+BATCH_REQUESTS = metrics.counter(
+    "xipuai_batch_requests_total", "Batch requests processed, by outcome.", ("outcome",))
+GENERATIONS_ABORTED = metrics.counter(
+    "xipuai_generations_aborted_total", "Upstream completions streams closed before they finished.", ("model",))
+EVENT_LOOP_LAG = metrics.histogram(
+    "xipuai_event_loop_lag_seconds", "How late the event loop woke up a periodic timer.",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5))
 
-def get_dynamic_headers():
-    load_dotenv(find_dotenv(), override=True)
-    jm_token = os.getenv("JM_TOKEN")
-    sdp_session = os.getenv("SDP_SESSION")
-    if not jm_token or not sdp_session:
-        raise ValueError("JM_TOKEN or SDP_SESSION not found in .env file.")
+def account_gauge(name: str, documentation: str, value):
+    """抓取时从每个账号读取的仪表"""
+    return metrics.gauge(name, documentation, ("account",),
+                         collect=lambda: {(a.name,): value(a) for a in account_pool.accounts.values()})
+
+metrics.gauge("xipuai_admission_in_flight", "Upstream generations admitted and not yet finished.",
+              collect=lambda: {(): admission.active})
+metrics.gauge("xipuai_admission_queued", "Chat requests waiting for an upstream generation slot.", ("priority",),
+              collect=lambda: {(name,): admission.queued(name) for name in ADMISSION_PRIORITIES})
+metrics.gauge("xipuai_batch_in_flight", "Batch requests currently being processed.",
+              collect=lambda: {(): batch_runner.in_flight})
+metrics.gauge("xipuai_retry_budget", "Retry tokens currently available.", collect=lambda: {(): retry_policy.tokens})
+metrics.gauge("xipuai_upstream_requests", "HTTP requests sent upstream.",
+              collect=lambda: {(): upstream.requests})
+metrics.gauge("xipuai_upstream_connections_opened", "New upstream TCP connections (requests minus this = reused).",
+              collect=lambda: {(): upstream.connections_opened})
+account_gauge("xipuai_account_in_flight", "Requests currently using each upstream account.", lambda a: a.in_flight)
+account_gauge("xipuai_live_sessions", "Sessions believed to exist on the server for each account.", lambda a: a.live_sessions)
+account_gauge("xipuai_idle_sessions", "Idle sessions held in each account's pool.", lambda a: a.pool.idle_count())
+account_gauge("xipuai_delete_queue_depth", "Sessions waiting in each account's deletion queue.", lambda a: len(a.deleter.pending))
+account_gauge("xipuai_scheduler_queue_depth", "Upstream calls waiting for a scheduler slot.", lambda a: a.scheduler.waiting)
+account_gauge("xipuai_scheduler_interval_seconds", "Current minimum spacing between upstream calls.", lambda a: a.scheduler.interval)
+
+async def prewarm_loop():
+    """启动时预热到上游的连接；之后每个空闲期最多重新预热一次"""
+    while True:
+        try:
+            if await upstream.prewarm(BASE_URL):
+                logger.info(f"🔥 Upstream connection pre-warmed ({upstream.status()['http_versions']}).")
+            else:
+                logger.warning("⚠️ Upstream connection pre-warm failed.")
+            if not PREWARM_IDLE_AFTER:
+                break
+            # 有真实流量时连接本来就是热的；一直没有流量时也不反复预热，
+            # 只有在上次预热之后出现过真实请求、随后又空闲了 PREWARM_IDLE_AFTER 秒，才再预热一次
+            prewarmed_at = time.time()
+            while upstream.last_request <= prewarmed_at or upstream.idle_for() < PREWARM_IDLE_AFTER:
+                if upstream.last_request <= prewarmed_at:
+                    await asyncio.sleep(PREWARM_IDLE_AFTER)
+                else:
+                    await asyncio.sleep(max(1.0, PREWARM_IDLE_AFTER - upstream.idle_for()))
+        except asyncio.CancelledError:
+            break
+        except Exception as e:
+            logger.error(f"Error in connection prewarm loop: {e}", exc_info=True)
+            await asyncio.sleep(PREWARM_IDLE_AFTER or 60)
+
+async def loop_lag_monitor():
+    """定时睡眠并记录实际醒来比预期晚了多少，用来发现阻塞事件循环的代码"""
+    while True:
+        try:
+            started = time.perf_counter()
+            await asyncio.sleep(EVENT_LOOP_LAG_INTERVAL)
+            EVENT_LOOP_LAG.observe(max(0.0, time.perf_counter() - started - EVENT_LOOP_LAG_INTERVAL))
+        except asyncio.CancelledError:
+            break
+
+class CredentialStore:
+    """内存中的凭据缓存。
+
+    只有当 .env 的 inode/mtime/大小变化，或调用 /credentials/reload 时才重新解析，
+    文件读写都放到线程里执行，不阻塞事件循环。
+    """
+
+    def __init__(self):
+        self.env_file = find_dotenv() or ".env"
+        self.values = {}
+        self.header_cache = {}
+        self.signature = None
+        self.reloads = 0
+        self.last_reload = None
+        self.task = None
+        self.listeners = []
+
+    def _stat_signature(self):
+        try:
+            st = os.stat(self.env_file)
+        except OSError:
+            return None
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    def _read(self):
+        """读取并解析 .env（阻塞，只在线程中或启动时调用）"""
+        signature = self._stat_signature()
+        values = dotenv_values(self.env_file) if signature else {}
+        return signature, values
+
+    def _apply(self, signature, values: dict):
+        self.signature = signature
+        self.values = values
+        # 整体替换引用，正在进行的请求继续使用旧的字典
+        self.header_cache = {}
+        self.reloads += 1
+        self.last_reload = time.time()
+        for listener in self.listeners:
+            listener()
+
+    def load(self):
+        """同步加载，仅用于模块导入时"""
+        self._apply(*self._read())
+
+    async def refresh(self, force: bool = False) -> bool:
+        """文件有变化（或 force）时重新加载，返回是否重新加载了"""
+        signature = await asyncio.to_thread(self._stat_signature)
+        if not force and signature == self.signature:
+            return False
+        self._apply(*await asyncio.to_thread(self._read))
+        logger.info(f"🔐 Credentials reloaded from {self.env_file}")
+        return True
+
+    async def set(self, key: str, value: str):
+        """写入 .env 并立即刷新缓存"""
+        await asyncio.to_thread(set_key, self.env_file, key, value)
+        await self.refresh(force=True)
+
+    def get(self, key: str):
+        return self.values.get(key) or PROCESS_ENV.get(key)
+
+    def get_headers(self, token_key: str = "JM_TOKEN", session_key: str = "SDP_SESSION") -> dict:
+        jm_token = self.get(token_key)
+        sdp_session = self.get(session_key)
+        if not jm_token or not sdp_session:
+            raise ValueError(f"{token_key} or {session_key} not found in .env file.")
+        headers = self.header_cache.get((jm_token, sdp_session))
+        if headers is None:
+            headers = self.header_cache[(jm_token, sdp_session)] = build_headers(jm_token, sdp_session)
+        return headers
+
+    def account_suffixes(self) -> list:
+        """已配置的账号后缀：主账号为 ""，其余为 JM_TOKEN_<名称> 中的 "_<名称>" """
+        keys = set(self.values) | set(PROCESS_ENV)
+        suffixes = [""] if self.get("JM_TOKEN") else []
+        suffixes += sorted(k[len("JM_TOKEN"):] for k in keys if k.startswith("JM_TOKEN_") and self.get(k))
+        return suffixes
+
+    async def watch_loop(self):
+        """定期检查 .env 是否被 auth.py 等外部程序修改"""
+        while True:
+            try:
+                await asyncio.sleep(CREDENTIAL_CHECK_INTERVAL)
+                await self.refresh()
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                logger.error(f"Error in credential watch loop: {e}", exc_info=True)
+
+    def status(self) -> dict:
+        return {
+            "env_file": os.path.abspath(self.env_file),
+            "accounts": len(self.account_suffixes()),
+            "reloads": self.reloads,
+            "last_reload": datetime.fromtimestamp(self.last_reload).strftime('%Y-%m-%d %H:%M:%S') if self.last_reload else None,
+        }
+
+def build_headers(jm_token: str, sdp_session: str) -> dict:
     return {
         "accept": "application/json, text/plain, */*", "content-type": "application/json",
         "origin": "https://xipuai.xjtlu.edu.cn", "referer": "https://xipuai.xjtlu.edu.cn/",
@@ -76,66 +749,592 @@ def get_dynamic_headers():
         "jm-token": jm_token, "sdp-app-session": sdp_session,
     }
 
-def process_and_format_prompt(messages: list) -> str:
+credential_store = CredentialStore()
+credential_store.load()
+
+def invalid_messages(messages) -> str:
+    """检查 messages 的结构，有问题时返回错误说明，没有问题时返回 None"""
+    if not isinstance(messages, list):
+        return "'messages' must be a list."
+    for i, msg in enumerate(messages):
+        if not isinstance(msg, dict):
+            return f"messages[{i}] must be an object with 'role' and 'content'."
+        if not isinstance(msg.get("role", "user"), str):
+            return f"messages[{i}].role must be a string."
+    return None
+
+def process_and_format_prompt(messages: list, log_details: bool = True) -> str:
     prompt_parts = [f"{msg.get('role', 'user').capitalize()}:\n{msg.get('content', '')}" for msg in messages]
     full_prompt = "\n\n".join(prompt_parts)
-    logger.info(f"Final, PROCESSED prompt for backend:\n---\n{full_prompt}\n---")
+    if log_details and LOG_PROMPT_MODE != "off":
+        logger.info(f"Final, PROCESSED prompt for backend:\n---\n{summarize_text(full_prompt)}\n---")
     return full_prompt
 
-async def create_new_session(openai_request: dict):
-    """创建新的会话"""
-    headers = get_dynamic_headers()
-    session_name = f"API Request @ {datetime.now().strftime('%H:%M:%S')}"
-    payload = {
-        "name": session_name,
+class UpstreamScheduler:
+    """单个账号的上游限速调度器，该账号的所有上游调用都经过它。
+
+    每次上游调用前先预约一个时间槽，相邻槽之间至少相隔 interval 秒。
+    被限速时间隔按倍数放大，连续成功后再逐步缩小（AIMD）。
+    """
+
+    def __init__(self, interval: float, scope: str):
+        self.scope = scope   # 多进程模式下共享状态中的键（账号名）
+        self.interval = interval
+        self.next_slot = 0.0
+        self.last_call = 0.0
+        self.waiting = 0
+        self.success_streak = 0
+        self.calls = {}
+        self.rate_limited = 0
+
+    async def acquire(self, kind: str) -> float:
+        """等待轮到本次调用，返回等待的秒数"""
+        now = time.time()
+        if shared_state is not None:
+            # 时间槽在所有工作进程之间统一预约
+            slot, self.interval = await shared_state.call(shared_state.reserve_slot, self.scope, self.interval, now)
+        else:
+            slot = max(now, self.next_slot)
+        self.next_slot = slot + self.interval
+        self.calls[kind] = self.calls.get(kind, 0) + 1
+        if slot > now:
+            self.waiting += 1
+            try:
+                await asyncio.sleep(slot - now)
+            finally:
+                self.waiting -= 1
+        self.last_call = time.time()
+        if shared_state is not None:
+            shared_write(shared_state.set_max, self.scope, "last_call", self.last_call)
+        waited = self.last_call - now
+        SCHEDULER_WAIT_SECONDS.observe(waited, kind=kind)
+        return waited
+
+    async def acquire_spare(self, kind: str) -> float:
+        """低优先级地预约时间槽：等到没有调用在排队、下一个时间槽已经空出来时再预约，
+        后台调用（预热会话池）只用前台请求没用上的槽位，不会推迟它们"""
+        while True:
+            next_slot = self.next_slot
+            if shared_state is not None:
+                # 其他工作进程预约的时间槽也算
+                next_slot = max(next_slot, shared_state.scheduler_state(self.scope, self.interval)[0])
+            if self.waiting == 0 and next_slot <= time.time():
+                return await self.acquire(kind)
+            await asyncio.sleep(max(next_slot - time.time(), self.interval))
+
+    def report_success(self):
+        self.success_streak += 1
+        if self.success_streak >= UPSTREAM_RECOVERY_STREAK:
+            self.success_streak = 0
+            if shared_state is not None:
+                # 共享的间隔在写线程里更新，下一次预约时间槽时取回
+                shared_write(shared_state.recover, self.scope, self.interval, UPSTREAM_RECOVERY_STEP, UPSTREAM_INTERVAL_MIN)
+            self.interval = max(UPSTREAM_INTERVAL_MIN, self.interval - UPSTREAM_RECOVERY_STEP)
+
+    def report_rate_limited(self):
+        self.success_streak = 0
+        self.rate_limited += 1
+        if shared_state is not None:
+            shared_write(shared_state.backoff, self.scope, self.interval, UPSTREAM_BACKOFF_FACTOR, UPSTREAM_INTERVAL_MAX, time.time())
+        self.interval = min(UPSTREAM_INTERVAL_MAX, self.interval * UPSTREAM_BACKOFF_FACTOR)
+        # 已预约的槽位之后再额外空出一个新间隔
+        self.next_slot = max(self.next_slot, time.time()) + self.interval
+        logger.warning(f"⏳ Upstream rate limited, widening interval to {self.interval:.2f}s")
+
+    def report_status(self, status_code: int):
+        """按 HTTP 状态码反馈（用于无法预读响应体的流式调用）"""
+        if status_code == 429:
+            self.report_rate_limited()
+        elif status_code < 400:
+            self.report_success()
+
+    def status(self) -> dict:
+        return {
+            "interval": round(self.interval, 3),
+            "rate_per_second": round(1 / self.interval, 3),
+            "queue_depth": self.waiting,
+            "calls": dict(self.calls),
+            "rate_limited": self.rate_limited,
+        }
+
+def is_rate_limited_response(response: httpx.Response) -> bool:
+    """判断上游是否返回了 429 或 "Request too fast" """
+    if response.status_code == 429:
+        return True
+    try:
+        msg = response.json().get("msg") or ""
+    except Exception:
+        return False
+    return "too fast" in str(msg).lower()
+
+def is_token_error_response(response: httpx.Response) -> bool:
+    """判断上游是否返回了 403 或令牌相关的错误"""
+    if response.status_code in (401, 403):
+        return True
+    try:
+        data = response.json()
+    except Exception:
+        return False
+    if data.get("code") in (0, None):
+        return False
+    msg = str(data.get("msg") or "").lower()
+    return any(marker in msg for marker in TOKEN_ERROR_MARKERS)
+
+class UpstreamError(HTTPException):
+    """分类后的上游错误；kind 决定是否值得重试"""
+
+    def __init__(self, kind: str, status_code: int, detail: str):
+        super().__init__(status_code=status_code, detail=detail)
+        self.kind = kind
+
+def response_message(response: httpx.Response) -> str:
+    try:
+        data = response.json()
+    except Exception:
+        return response.text[:200]
+    return str(data.get("msg") or data) if isinstance(data, dict) else str(data)[:200]
+
+def classify_response(response: httpx.Response) -> str:
+    """把失败的上游响应归类"""
+    if is_rate_limited_response(response):
+        return "rate_limited"
+    if is_token_error_response(response):
+        return "token"
+    if response.status_code >= 500:
+        return "server_error"
+    if response.status_code >= 400:
+        return "client_error"
+    msg = response_message(response).lower()
+    if "request err" in msg:
+        return "request_error"
+    if "session" in msg and ("not found" in msg or "not exist" in msg):
+        return "session_invalid"
+    if "delete some" in msg:
+        return "quota"
+    return "backend_error"
+
+def upstream_error(response: httpx.Response, action: str) -> UpstreamError:
+    kind = classify_response(response)
+    status_code = 429 if kind == "rate_limited" else response.status_code if response.status_code >= 400 else 500
+    return UpstreamError(kind, status_code, f"Upstream error during {action} ({kind}): {response_message(response)}")
+
+def transport_error(error: httpx.TransportError, action: str) -> UpstreamError:
+    if isinstance(error, httpx.TimeoutException):
+        return UpstreamError("timeout", 504, f"Upstream timed out during {action}: {type(error).__name__}")
+    return UpstreamError("network", 502, f"Upstream connection failed during {action}: {type(error).__name__}")
+
+class RetryPolicy:
+    """按错误分类决定是否重试，带抖动的指数退避，加上按请求量补充的重试预算"""
+
+    def __init__(self):
+        self.tokens = float(RETRY_BUDGET_MAX)
+        self.retries = 0
+        self.denied = {}
+        self.ttft = deque(maxlen=HEDGE_WINDOW)
+        self.hedges = {}
+
+    def deposit(self):
+        """每个客户端请求为预算存入一点令牌（只在 resilient_deltas 中调用一次）"""
+        self.tokens = min(RETRY_BUDGET_MAX, self.tokens + RETRY_BUDGET_RATIO)
+
+    def _deny(self, operation: str, reason: str) -> bool:
+        self.denied[reason] = self.denied.get(reason, 0) + 1
+        RETRIES_DENIED.inc(operation=operation, reason=reason)
+        return False
+
+    def allow(self, error: UpstreamError, attempt: int, operation: str, retryable: bool = None) -> bool:
+        """第 attempt 次尝试失败后是否再试一次；允许时从预算中取走一个令牌"""
+        if not ENABLE_UPSTREAM_RETRY:
+            return False
+        if not (error.kind in RETRYABLE_ERRORS if retryable is None else retryable):
+            return False
+        if attempt >= RETRY_MAX_ATTEMPTS:
+            return self._deny(operation, "attempts")
+        if self.tokens < 1:
+            return self._deny(operation, "budget")
+        self.tokens -= 1
+        self.retries += 1
+        UPSTREAM_RETRIES.inc(operation=operation, kind=error.kind)
+        return True
+
+    @staticmethod
+    def backoff(attempt: int) -> float:
+        """full jitter：并发失败的请求不会在同一时刻一起重试"""
+        return random.uniform(0, min(RETRY_BACKOFF_MAX, RETRY_BACKOFF_BASE * 2 ** (attempt - 1)))
+
+    async def call(self, operation: str, func):
+        """执行 func()，可重试的 UpstreamError 退避后重试；预算由所属的客户端请求存入，这里不再存"""
+        attempt = 1
+        while True:
+            try:
+                return await func()
+            except UpstreamError as e:
+                if not self.allow(e, attempt, operation):
+                    raise
+                delay = self.backoff(attempt)
+                logger.warning(f"🔁 {operation} failed ({e.kind}), retrying in {delay:.2f}s (attempt {attempt + 1}/{RETRY_MAX_ATTEMPTS}).")
+                await asyncio.sleep(delay)
+                attempt += 1
+
+    # --- 对冲 ---
+    def observe_ttft(self, seconds: float):
+        self.ttft.append(seconds)
+
+    def hedge_delay(self):
+        """触发对冲的首字等待时间；样本不足时返回 None"""
+        if len(self.ttft) < HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(self.ttft)
+        return max(HEDGE_MIN_DELAY, ordered[min(len(ordered) - 1, int(len(ordered) * HEDGE_PERCENTILE))])
+
+    def take_hedge(self) -> bool:
+        """对冲同样消耗重试预算；有请求在排队时不对冲，避免放大负载"""
+        if admission.waiting:
+            self.record_hedge("skipped_queue")
+            return False
+        if self.tokens < 1:
+            self.record_hedge("skipped_budget")
+            return False
+        self.tokens -= 1
+        self.record_hedge("launched")
+        return True
+
+    def record_hedge(self, outcome: str):
+        self.hedges[outcome] = self.hedges.get(outcome, 0) + 1
+        HEDGES.inc(outcome=outcome)
+
+    def status(self) -> dict:
+        delay = self.hedge_delay()
+        return {
+            "enabled": ENABLE_UPSTREAM_RETRY,
+            "budget_tokens": round(self.tokens, 2),
+            "retries": self.retries,
+            "denied": dict(self.denied),
+            "hedging": ENABLE_HEDGING,
+            "hedge_delay": round(delay, 3) if delay is not None else None,
+            "ttft_samples": len(self.ttft),
+            "hedges": dict(self.hedges),
+        }
+
+retry_policy = RetryPolicy()
+
+def build_session_config(openai_request: dict) -> dict:
+    """从客户端请求中提取会话参数"""
+    return {
         "model": openai_request.get("model"),
         "temperature": openai_request.get("temperature", 0.7),
         "maxToken": openai_request.get("max_tokens", 0),
         "presencePenalty": openai_request.get("presence_penalty", 0),
         "frequencyPenalty": openai_request.get("frequency_penalty", 0)
     }
-    logger.info(f"Creating new session with payload: {json.dumps(payload)}")
+
+def session_key(session_config: dict) -> tuple:
+    """会话参数组合的键，用于匹配预热会话"""
+    return tuple(session_config.items())
+
+async def save_session(account: "Account", session_config: dict, session_name: str, spare: bool = False) -> str:
+    """调用 saveSession 创建一个配置好的会话，返回其ID；spare 时以低优先级预约调度器的时间槽"""
+    payload = {"name": session_name, **session_config}
+    await account.deleter.ensure_quota()
+    if not await account.reserve_session():
+        raise UpstreamError("quota", 503, f"All {SESSION_QUOTA} sessions of account {account.name} are in use, please retry later.")
     try:
-        response = await client.post(SESSION_API_URL, headers=headers, json=payload)
-        response.raise_for_status()
-        data = response.json()
+        logger.info(f"[{account.name}] Creating new session with payload: {json.dumps(payload)}")
+        started = time.perf_counter()
+        try:
+            response = await account.post(SESSION_API_URL, payload, "saveSession", spare)
+        except httpx.TransportError as e:
+            raise transport_error(e, "session creation") from e
+        STAGE_SECONDS.observe(time.perf_counter() - started, stage="session_create", model=session_config.get("model"))
+        if response.status_code >= 400:
+            raise upstream_error(response, "session creation")
+        try:
+            data = response.json()
+        except ValueError:
+            data = None
+        if not isinstance(data, dict):
+            # 2xx 却不是 JSON 对象（例如网关的错误页），按服务端错误分类，交给重试策略
+            raise UpstreamError("server_error", 502, f"Upstream returned a non-JSON response during session creation: {response.text[:200]}")
         if data.get("code") != 0:
-            raise HTTPException(status_code=500, detail=f"Backend Error on Session Create: {data.get('msg')}")
+            raise upstream_error(response, "session creation")
         new_id = data.get("data", {}).get("id")
-        if new_id:
-            logger.info(f"✅ Successfully created new Session ID: {new_id}")
-            return str(new_id)
-        raise HTTPException(status_code=500, detail="Session created but no ID was returned.")
-    except httpx.HTTPStatusError as e:
-        raise HTTPException(status_code=e.response.status_code, detail=f"Upstream API error during session creation: {e.response.text}")
-
-async def create_heartbeat_session():
-    """创建或获取心跳会话"""
-    global heartbeat_session_id
-    
-    # 先尝试从 .env 文件读取现有的心跳会话ID
-    env_file = find_dotenv()
-    load_dotenv(env_file, override=True)
-    existing_heartbeat_id = os.getenv("HEARTBEAT_SESSION_ID")
-    
-    if existing_heartbeat_id:
-        logger.info(f"💓 Found existing heartbeat session ID: {existing_heartbeat_id}")
-        heartbeat_session_id = existing_heartbeat_id
-        return existing_heartbeat_id
-    
-    # 创建新的心跳会话
-    headers = get_dynamic_headers()
+        if not new_id:
+            raise HTTPException(status_code=500, detail="Session created but no ID was returned.")
+    except BaseException:
+        # 没有创建成功，归还预先占用的配额名额
+        account.adjust_live_sessions(-1)
+        raise
+    logger.info(f"✅ [{account.name}] Successfully created new Session ID: {new_id}")
+    return str(new_id)
+
+async def create_new_session(account: "Account", session_config: dict):
+    """创建新的会话；限速和临时错误按 retry_policy 重试"""
+    session_name = f"API Request @ {datetime.now().strftime('%H:%M:%S')}"
+    return await retry_policy.call("saveSession", lambda: save_session(account, session_config, session_name))
+
+async def update_session(account: "Account", session_id: str, session_config: dict):
+    """用带 id 的 saveSession 原地更新已有会话的参数"""
+    payload = {"id": int(session_id), "name": f"Pooled Session @ {datetime.now().strftime('%H:%M:%S')}", **session_config}
+    logger.info(f"[{account.name}] Reconfiguring session {session_id} with payload: {json.dumps(payload)}")
+    try:
+        response = await account.post(SESSION_API_URL, payload, "saveSession")
+    except httpx.TransportError as e:
+        raise transport_error(e, "session update") from e
+    if response.status_code >= 400:
+        raise upstream_error(response, "session update")
+    try:
+        data = response.json()
+    except ValueError:
+        data = None
+    if not isinstance(data, dict):
+        raise UpstreamError("server_error", 502, f"Upstream returned a non-JSON response during session update: {response.text[:200]}")
+    if data.get("code") != 0:
+        raise upstream_error(response, "session update")
+
+class SessionPool:
+    """单个账号按会话参数分组的空闲会话池。
+
+    预热模式下由后台任务按限速补充；有上限的模式下持有的会话数量不超过上限，
+    没有生成过回答的会话参数不匹配时原地更新后再租出。
+    """
+
+    def __init__(self, account: "Account"):
+        self.account = account
+        self.idle = {}        # key -> deque[(session_id, created_at)]
+        self.demand = {}      # key -> 最近一次被请求的时间
+        self.owned = set()    # 有上限的模式下计入上限的会话
+        self.hits = 0
+        self.misses = 0
+        self.refilled = 0
+        self.reconfigured = 0
+        self.waiting = 0
+        self.returned = asyncio.Condition()
+        self.task = None
+
+    def idle_count(self) -> int:
+        return sum(len(q) for q in self.idle.values())
+
+    def _pop(self, key: tuple):
+        queue = self.idle.get(key)
+        if not queue:
+            return None
+        session_id, _ = queue.popleft()
+        if not queue:
+            del self.idle[key]
+        return session_id
+
+    def _pop_any(self):
+        """取出最久未用的空闲会话（不论参数）"""
+        if not self.idle:
+            return None
+        key = min(self.idle, key=lambda k: self.idle[k][0][1])
+        return self._pop(key)
+
+    async def lease(self, session_config: dict):
+        """租出一个按 session_config 配置好的会话，返回 (session_id, is_warm)"""
+        key = session_key(session_config)
+        self.demand[key] = time.time()
+        session_id = self._pop(key)
+        if session_id:
+            self.hits += 1
+            logger.info(f"♨️  Using pooled Session ID: {session_id}")
+            return session_id, True
+        self.misses += 1
+        if not ENABLE_BOUNDED_SESSION_POOL:
+            return await create_new_session(self.account, session_config), False
+
+        deadline = time.time() + BOUNDED_POOL_WAIT_TIMEOUT
+        while True:
+            session_id = self._pop_any()
+            if session_id:
+                try:
+                    await update_session(self.account, session_id, session_config)
+                    self.reconfigured += 1
+                    return session_id, False
+                except Exception as e:
+                    # 会话可能已在服务器端失效，删除它（仍占着配额）并重新获取
+                    logger.warning(f"Failed to reconfigure session {session_id}, dropping it: {e}")
+                    self.discard(session_id)
+                    continue
+            if len(self.owned) < BOUNDED_POOL_MAX_SESSIONS:
+                session_name = f"Pooled Session @ {datetime.now().strftime('%H:%M:%S')}"
+                # 先占位再创建，避免并发请求同时越过上限
+                placeholder = object()
+                self.owned.add(placeholder)
+                try:
+                    session_id = await save_session(self.account, session_config, session_name)
+                finally:
+                    self.owned.discard(placeholder)
+                self.owned.add(session_id)
+                return session_id, False
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise HTTPException(status_code=503, detail="All pooled sessions are busy, please retry later.")
+            self.waiting += 1
+            try:
+                async with self.returned:
+                    await asyncio.wait_for(self.returned.wait(), timeout=remaining)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                self.waiting -= 1
+
+    async def release(self, session_id: str, session_config: dict, generated: bool = False):
+        """归还会话：没有生成过回答的会话放回池中，其余会话按配置删除"""
+        if conversation_affinity.is_pinned(session_id):
+            # 对话保持模式下由 ConversationAffinity 决定保留还是归还
+            return
+        if session_id in self.owned and not generated:
+            self.idle.setdefault(session_key(session_config), deque()).append((session_id, time.time()))
+            async with self.returned:
+                self.returned.notify()
+            return
+        if session_id in self.owned:
+            # 服务器端保存着这次对话，复用会泄露给下一个请求；删除它，空出的名额由新会话补上
+            self.owned.discard(session_id)
+            async with self.returned:
+                self.returned.notify()
+        if ENABLE_AUTO_DELETION:
+            logger.info(f"Scheduling session {session_id} for deletion.")
+            delete_session(self.account, session_id)
+
+    def discard(self, session_id: str):
+        """生成被中途放弃的会话不再复用（服务器上可能还在写这次回答），立即删除"""
+        self.owned.discard(session_id)
+        if ENABLE_AUTO_DELETION:
+            logger.info(f"Deleting abandoned session {session_id}.")
+            delete_session(self.account, session_id, urgent=True)
+
+    def _expire(self):
+        """清理长期无人请求的参数组合和过旧的空闲会话（计入上限的会话除外）"""
+        now = time.time()
+        for key, last_seen in list(self.demand.items()):
+            if now - last_seen > SESSION_POOL_KEY_TTL:
+                del self.demand[key]
+        for key, queue in list(self.idle.items()):
+            stale = key not in self.demand
+            kept = deque()
+            for session_id, created_at in queue:
+                if session_id not in self.owned and (stale or now - created_at > SESSION_POOL_MAX_IDLE_AGE):
+                    logger.info(f"Session pool: retiring idle session {session_id}")
+                    delete_session(self.account, session_id)
+                else:
+                    kept.append((session_id, created_at))
+            if kept:
+                self.idle[key] = kept
+            else:
+                del self.idle[key]
+
+    def _next_deficit_key(self):
+        """找出最缺预热会话的参数组合（最近被请求的优先）"""
+        if self.idle_count() >= SESSION_POOL_MAX_IDLE:
+            return None
+        if self.account.live_sessions >= SESSION_QUOTA - SESSION_QUOTA_HEADROOM:
+            return None
+        if ENABLE_BOUNDED_SESSION_POOL and len(self.owned) >= BOUNDED_POOL_MAX_SESSIONS:
+            return None
+        candidates = [k for k in self.demand if len(self.idle.get(k, ())) < SESSION_POOL_SIZE_PER_KEY]
+        if not candidates:
+            return None
+        return max(candidates, key=lambda k: self.demand[k])
+
+    async def refill_loop(self):
+        """后台补充循环：一次创建一个会话，用调度器里前台请求没用上的时间槽"""
+        logger.info(f"[{self.account.name}] Session pool refill loop started.")
+        while True:
+            try:
+                self._expire()
+                key = self._next_deficit_key()
+                if key is None:
+                    await asyncio.sleep(SESSION_POOL_REFILL_INTERVAL)
+                    continue
+                session_name = f"Warm Pool @ {datetime.now().strftime('%H:%M:%S')}"
+                session_id = await save_session(self.account, dict(key), session_name, spare=True)
+                if ENABLE_BOUNDED_SESSION_POOL:
+                    self.owned.add(session_id)
+                self.idle.setdefault(key, deque()).append((session_id, time.time()))
+                self.refilled += 1
+            except asyncio.CancelledError:
+                logger.info("Session pool refill loop cancelled")
+                break
+            except Exception as e:
+                logger.error(f"Error in session pool refill loop: {e}", exc_info=True)
+                await asyncio.sleep(SESSION_POOL_REFILL_INTERVAL)
+
+    def drain(self) -> list:
+        """清空池并返回所有空闲会话ID"""
+        ids = [session_id for queue in self.idle.values() for session_id, _ in queue]
+        self.idle.clear()
+        self.owned.clear()
+        return ids
+
+    def status(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "enabled": ENABLE_SESSION_POOL,
+            "bounded": ENABLE_BOUNDED_SESSION_POOL,
+            "idle_sessions": self.idle_count(),
+            "bounded_sessions": len(self.owned),
+            "waiting_requests": self.waiting,
+            "keys": len(self.demand),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "refilled": self.refilled,
+            "reconfigured": self.reconfigured,
+            "live_sessions": self.account.live_sessions,
+            "deletion": self.account.deleter.status(),
+        }
+
+def heartbeat_payload(session_id=None) -> dict:
+    """心跳会话的 saveSession 请求体；带 id 时为原地更新（与 tokentest.py 相同）"""
     payload = {
-        "name": HEARTBEAT_SESSION_NAME,
+        "name": f"{HEARTBEAT_SESSION_NAME} (Last Beat: {datetime.now().strftime('%H:%M:%S')})" if session_id else HEARTBEAT_SESSION_NAME,
         "model": "qwen-2.5-72b",  # 使用默认模型
         "temperature": 0.7,
         "maxToken": 0,
         "presencePenalty": 0,
         "frequencyPenalty": 0
     }
+    if session_id:
+        payload = {"id": int(session_id), **payload}
+    return payload
+
+async def update_heartbeat_session(account: "Account"):
+    """原地更新心跳会话。返回 True 表示有效，False 表示会话已失效，None 表示因令牌或限速无法判断"""
+    response = await account.post(SESSION_API_URL, heartbeat_payload(account.heartbeat_session_id), "heartbeat")
+    if is_rate_limited_response(response) or is_token_error_response(response):
+        logger.warning(f"[{account.name}] Heartbeat could not be verified (HTTP {response.status_code}).")
+        return None
+    response.raise_for_status()
+    data = response.json()
+    if data.get("code") == 0:
+        account.last_heartbeat = time.time()
+        return True
+    logger.warning(f"[{account.name}] Heartbeat session {account.heartbeat_session_id} rejected: {data.get('msg')}")
+    return False
+
+async def create_heartbeat_session(account: "Account", reuse: bool = True):
+    """获取心跳会话：.env 中已有的ID先原地更新一次以验证，失效时重新创建"""
+    # 先尝试从 .env 文件读取现有的心跳会话ID
+    existing_heartbeat_id = credential_store.get(account.key("HEARTBEAT_SESSION_ID")) if reuse else None
+    
+    if existing_heartbeat_id:
+        logger.info(f"💓 [{account.name}] Found existing heartbeat session ID: {existing_heartbeat_id}")
+        account.set_heartbeat_session(existing_heartbeat_id)
+        try:
+            if await update_heartbeat_session(account) is not False:
+                return existing_heartbeat_id
+        except Exception as e:
+            # 网络错误等无法判断会话是否有效，先沿用
+            logger.error(f"Failed to verify heartbeat session: {e}")
+            return existing_heartbeat_id
+        logger.warning(f"💓 [{account.name}] Heartbeat session {existing_heartbeat_id} is stale, creating a new one.")
+        account.set_heartbeat_session(None)
     
+    # 创建新的心跳会话
     try:
-        response = await client.post(SESSION_API_URL, headers=headers, json=payload)
+        response = await account.post(SESSION_API_URL, heartbeat_payload(), "heartbeat")
         response.raise_for_status()
         data = response.json()
         if data.get("code") != 0:
@@ -144,12 +1343,13 @@ async def create_heartbeat_session():
         
         new_id = data.get("data", {}).get("id")
         if new_id:
-            heartbeat_session_id = str(new_id)
+            account.set_heartbeat_session(str(new_id))
+            account.last_heartbeat = time.time()
             # 保存到 .env 文件
-            set_key(env_file, "HEARTBEAT_SESSION_ID", heartbeat_session_id)
-            logger.info(f"💓 Created new heartbeat session ID: {heartbeat_session_id}")
-            print(f"💓 [HEARTBEAT] Created persistent session ID: {heartbeat_session_id}")
-            return heartbeat_session_id
+            await credential_store.set(account.key("HEARTBEAT_SESSION_ID"), account.heartbeat_session_id)
+            logger.info(f"💓 [{account.name}] Created new heartbeat session ID: {account.heartbeat_session_id}")
+            print(f"💓 [HEARTBEAT] Created persistent session ID for {account.name}: {account.heartbeat_session_id}")
+            return account.heartbeat_session_id
         else:
             logger.error("Heartbeat session created but no ID was returned.")
             return None
@@ -157,237 +1357,2169 @@ async def create_heartbeat_session():
         logger.error(f"Failed to create heartbeat session: {e}", exc_info=True)
         return None
 
-async def send_heartbeat():
-    """发送心跳请求"""
-    global heartbeat_session_id
-    
-    if not heartbeat_session_id:
-        logger.warning("No heartbeat session ID available, attempting to create one...")
-        await create_heartbeat_session()
-        if not heartbeat_session_id:
+async def send_heartbeat(account: "Account"):
+    """发送心跳：原地更新心跳会话，会话失效时重新创建"""
+    if not account.heartbeat_session_id:
+        logger.warning(f"[{account.name}] No heartbeat session ID available, attempting to create one...")
+        await create_heartbeat_session(account)
+        if not account.heartbeat_session_id:
             logger.error("Failed to create heartbeat session, skipping heartbeat")
-            return
+        return
     
     try:
-        headers = get_dynamic_headers()
-        # 发送一个简单的saveSession请求作为心跳
-        payload = {
-            "name": HEARTBEAT_SESSION_NAME,
-            "model": "qwen-2.5-72b",
-            "temperature": 0.7,
-            "maxToken": 0,
-            "presencePenalty": 0,
-            "frequencyPenalty": 0
-        }
-        
-        response = await client.post(SESSION_API_URL, headers=headers, json=payload)
-        response.raise_for_status()
-        data = response.json()
-        
-        if data.get("code") == 0:
-            current_time = datetime.now().strftime('%H:%M:%S')
-            logger.info(f"💓 Heartbeat sent successfully at {current_time}")
-            print(f"💓 [HEARTBEAT] Keepalive sent at {current_time} (Session: {heartbeat_session_id})")
-        else:
-            logger.warning(f"Heartbeat response warning: {data.get('msg')}")
-            
+        valid = await update_heartbeat_session(account)
     except Exception as e:
         logger.error(f"Failed to send heartbeat: {e}", exc_info=True)
         print(f"❌ [HEARTBEAT] Failed to send keepalive: {e}")
+        return
+
+    if valid:
+        current_time = datetime.now().strftime('%H:%M:%S')
+        logger.info(f"💓 [{account.name}] Heartbeat sent successfully at {current_time}")
+        print(f"💓 [HEARTBEAT] Keepalive sent at {current_time} ({account.name}, Session: {account.heartbeat_session_id})")
+    elif valid is False:
+        print(f"⚠️ [HEARTBEAT] Session {account.heartbeat_session_id} is stale, recreating ({account.name})")
+        await create_heartbeat_session(account, reuse=False)
 
 def update_user_activity():
     """更新用户活动时间"""
     global last_user_activity
     last_user_activity = time.time()
 
+def heartbeat_due(account: "Account") -> float:
+    """下一次心跳的时间：最近一次成功的上游调用（含真实请求）之后 HEARTBEAT_INTERVAL 秒"""
+    return max(account.last_upstream_ok, account.last_heartbeat) + HEARTBEAT_INTERVAL
+
 async def heartbeat_loop():
-    """心跳循环任务"""
-    global last_user_activity
-    
+    """心跳调度：只在账号长时间没有成功的上游调用时才发送，平时一直睡到最早的到期时间"""
     logger.info(f"💓 Heartbeat loop started (interval: {HEARTBEAT_INTERVAL}s)")
     print(f"💓 [HEARTBEAT] Keepalive enabled (interval: {HEARTBEAT_INTERVAL}s)")
     
     while True:
         try:
-            await asyncio.sleep(30)  # 每30秒检查一次
-            
-            current_time = time.time()
-            time_since_activity = current_time - last_user_activity
-            
-            # 如果用户静默时间超过心跳间隔，发送心跳
-            if time_since_activity >= HEARTBEAT_INTERVAL:
-                await send_heartbeat()
-                last_user_activity = current_time  # 重置计时器
-                
+            if not leader.is_leader:
+                # 其他工作进程负责心跳
+                await asyncio.sleep(LEADER_RENEW_INTERVAL)
+                continue
+            next_due = time.time() + HEARTBEAT_INTERVAL
+            for account in account_pool.active():
+                if heartbeat_due(account) <= time.time():
+                    await send_heartbeat(account)
+                    # 失败时也等一个完整间隔再试，令牌问题交给自动刷新处理
+                    account.last_heartbeat = max(account.last_heartbeat, time.time())
+                next_due = min(next_due, heartbeat_due(account))
+            sleep_for = max(HEARTBEAT_MIN_SLEEP, next_due - time.time())
+            if shared_state is not None:
+                # 多进程模式下领导者可能易主，不能一次睡太久
+                sleep_for = min(sleep_for, LEADER_RENEW_INTERVAL)
+            await asyncio.sleep(sleep_for)
         except asyncio.CancelledError:
             logger.info("💓 Heartbeat loop cancelled")
             break
         except Exception as e:
             logger.error(f"Error in heartbeat loop: {e}", exc_info=True)
+            await asyncio.sleep(HEARTBEAT_MIN_SLEEP)
+
+class SessionDeleter:
+    """单个账号的合并删除队列：收集用完的会话ID，定时或攒够一批后经调度器批量删除"""
+
+    def __init__(self, account: "Account"):
+        self.account = account
+        self.pending = {}      # session_id -> 已失败次数
+        self.wakeup = asyncio.Event()
+        self.lock = asyncio.Lock()
+        self.deleted = 0
+        self.failed = 0
+        self.batches = 0
+        self.task = None
+
+    def enqueue(self, session_id: str, urgent: bool = False):
+        self.pending.setdefault(session_id, 0)
+        if urgent or len(self.pending) >= DELETE_BATCH_SIZE:
+            self.wakeup.set()
+
+    async def flush(self):
+        """把当前队列中的会话全部提交删除（每批最多 DELETE_BATCH_MAX 个）"""
+        account = self.account
+        async with self.lock:
+            while self.pending:
+                batch = list(self.pending)[:DELETE_BATCH_MAX]
+                attempts = {session_id: self.pending.pop(session_id) for session_id in batch}
+                logger.info(f"[{account.name}] Cleanup Task: Deleting {len(batch)} sessions: {batch}")
+                started = time.perf_counter()
+                try:
+                    response = await account.post(DELETE_SESSION_URL, {"ids": [int(i) for i in batch]}, "delSession")
+                    STAGE_SECONDS.observe(time.perf_counter() - started, stage="session_delete")
+                    response.raise_for_status()
+                    data = response.json()
+                    if data.get("code") not in (0, None):
+                        raise ValueError(f"Backend Error on Session Delete: {data.get('msg')}")
+                except asyncio.CancelledError:
+                    # 被取消（例如关闭服务时）的批次放回队列，交给下一次刷新
+                    self.pending.update(attempts)
+                    raise
+                except Exception as e:
+                    logger.error(f"Cleanup Task: Failed to delete sessions {batch}. Error: {e}")
+                    for session_id, failures in attempts.items():
+                        if failures + 1 < DELETE_MAX_RETRIES:
+                            self.pending[session_id] = failures + 1
+                        else:
+                            # 不再跟踪这个会话，也不再把它计入存活会话，否则计数只增不减，最终卡住配额检查
+                            self.failed += 1
+                            account.adjust_live_sessions(-1)
+                            logger.error(f"Cleanup Task: Giving up on session {session_id} after {DELETE_MAX_RETRIES} attempts.")
+                    # 失败的会话留到下一次定时刷新再试
+                    break
+                self.batches += 1
+                self.deleted += len(batch)
+                account.adjust_live_sessions(-len(batch))
+                logger.info(f"✅ Cleanup Task: {len(batch)} sessions deleted successfully.")
+
+    async def ensure_quota(self):
+        """存活会话接近配额上限时，先释放对话保持的会话，再同步清空删除队列"""
+        if self.account.live_sessions >= SESSION_QUOTA - DELETE_QUOTA_MARGIN:
+            await conversation_affinity.evict_for_quota(self.account)
+        if self.pending and self.account.live_sessions >= SESSION_QUOTA - DELETE_QUOTA_MARGIN:
+            logger.warning(f"[{self.account.name}] Live sessions ({self.account.live_sessions}) near quota, flushing deletion queue first.")
+            await self.flush()
+
+    async def run(self):
+        """后台循环：定时刷新，或在队列攒够一批时被提前唤醒"""
+        while True:
+            try:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout=DELETE_FLUSH_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                self.wakeup.clear()
+                await self.flush()
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                logger.error(f"Error in session deletion loop: {e}", exc_info=True)
+
+    def status(self) -> dict:
+        return {
+            "pending": len(self.pending),
+            "deleted": self.deleted,
+            "batches": self.batches,
+            "failed": self.failed,
+        }
 
-async def delete_session(session_id: str):
-    """删除会话（心跳会话除外）"""
+def delete_session(account: "Account", session_id: str, urgent: bool = False):
+    """把会话加入所属账号的删除队列（心跳会话除外）；urgent 时立即触发一次刷新"""
     # 如果是心跳会话，不删除
-    if session_id == heartbeat_session_id:
+    if session_id == account.heartbeat_session_id:
         logger.info(f"Skipping deletion of heartbeat session: {session_id}")
         return
-        
-    await asyncio.sleep(2.0)
-    try:
-        headers = get_dynamic_headers()
-        payload = {"ids": [int(session_id)]}
-        logger.info(f"Cleanup Task: Deleting session {session_id}...")
-        response = await client.post(DELETE_SESSION_URL, headers=headers, json=payload)
-        response.raise_for_status()
-        logger.info(f"✅ Cleanup Task: Session {session_id} deleted successfully.")
-    except Exception as e:
-        logger.error(f"Cleanup Task: Failed to delete session {session_id}. Error: {e}", exc_info=True)
+    account.deleter.enqueue(session_id, urgent)
+
+class Account:
+    """一个上游账号：独立的凭据、限速调度器、会话池、删除队列、配额计数和心跳会话"""
+
+    def __init__(self, suffix: str):
+        self.suffix = suffix   # .env 中的键后缀，主账号为 ""
+        self.name = suffix.lstrip("_") or "primary"
+        self.scheduler = UpstreamScheduler(INTER_REQUEST_DELAY, self.name)
+        self.pool = SessionPool(self)
+        self.deleter = SessionDeleter(self)
+        self.local_live_sessions = 0
+        self.heartbeat_session_id = None
+        self.last_heartbeat = 0.0
+        self.local_last_upstream_ok = 0.0
+        self.in_flight = 0
+        self.requests = 0
+        self.errors = {}
+        self.configured = True
+        self.healthy = True
+        self.unhealthy_since = None
+        self.unhealthy_reason = None
+        self.token = credential_store.get(self.key("JM_TOKEN"))
+        self.tasks = []
+
+    def key(self, base: str) -> str:
+        return f"{base}{self.suffix}"
+
+    def set_heartbeat_session(self, session_id):
+        """更换心跳会话。心跳会话同样占用服务器端的会话配额，持有期间计入存活会话，放弃时归还"""
+        if self.heartbeat_session_id:
+            self.adjust_live_sessions(-1)
+        self.heartbeat_session_id = session_id
+        if session_id:
+            self.adjust_live_sessions(1)
+
+    @property
+    def live_sessions(self) -> int:
+        """服务器端存活的会话数；多进程模式下是所有工作进程的合计"""
+        if shared_state is not None:
+            return int(shared_state.get(self.name, "live_sessions"))
+        return self.local_live_sessions
+
+    async def reserve_session(self) -> bool:
+        """创建会话之前先占用一个配额名额。检查和占用是原子的（多进程模式下在同一个 SQLite 事务里），
+        多个请求或工作进程同时创建会话也不会一起越过 SESSION_QUOTA；配额已满时返回 False"""
+        if shared_state is not None:
+            if not await shared_state.call(shared_state.reserve, self.name, "live_sessions", SESSION_QUOTA):
+                return False
+        elif self.local_live_sessions >= SESSION_QUOTA:
+            return False
+        self.local_live_sessions += 1
+        return True
+
+    def adjust_live_sessions(self, delta: int):
+        if shared_state is not None:
+            shared_write(shared_state.add, self.name, "live_sessions", delta, 0)
+        self.local_live_sessions = max(0, self.local_live_sessions + delta)
+
+    @property
+    def last_upstream_ok(self) -> float:
+        """最近一次成功的上游调用时间（多进程模式下取所有工作进程中最近的）"""
+        if shared_state is not None:
+            return max(self.local_last_upstream_ok, shared_state.get(self.name, "last_upstream_ok"))
+        return self.local_last_upstream_ok
+
+    def mark_upstream_ok(self):
+        self.local_last_upstream_ok = time.time()
+        if shared_state is not None:
+            shared_write(shared_state.set_max, self.name, "last_upstream_ok", self.local_last_upstream_ok)
+
+    def headers(self) -> dict:
+        return credential_store.get_headers(self.key("JM_TOKEN"), self.key("SDP_SESSION"))
+
+    async def post(self, url: str, payload: dict, kind: str, spare: bool = False) -> httpx.Response:
+        """经本账号的调度器发送一个非流式的上游请求，并反馈结果；spare 时只用前台请求没用上的时间槽"""
+        headers = self.headers()
+        if spare:
+            await self.scheduler.acquire_spare(kind)
+        else:
+            await self.scheduler.acquire(kind)
+        try:
+            response = await upstream.post(url, headers=headers, json=payload)
+        except httpx.HTTPError as e:
+            self.record_error(type(e).__name__)
+            raise
+        self.record_response(response, kind)
+        return response
+
+    def record_response(self, response: httpx.Response, kind: str):
+        """按非流式响应的内容反馈给调度器和账号健康状态"""
+        if is_rate_limited_response(response):
+            self.scheduler.report_rate_limited()
+            self.record_error("rate_limited")
+        elif is_token_error_response(response):
+            self.mark_unhealthy(f"{kind} returned token error (HTTP {response.status_code})")
+        elif response.status_code < 400:
+            self.scheduler.report_success()
+            self.mark_healthy()
+            self.mark_upstream_ok()
+        else:
+            self.record_error(str(response.status_code))
+
+    def record_status(self, status_code: int):
+        """流式调用只能按状态码反馈"""
+        self.scheduler.report_status(status_code)
+        if status_code in (401, 403):
+            self.mark_unhealthy(f"completions returned HTTP {status_code}")
+        elif status_code < 400:
+            self.mark_healthy()
+            self.mark_upstream_ok()
+        else:
+            self.record_error(str(status_code))
+
+    def record_error(self, label: str):
+        self.errors[label] = self.errors.get(label, 0) + 1
+        UPSTREAM_ERRORS.inc(account=self.name, code=label)
+
+    def mark_unhealthy(self, reason: str):
+        self.record_error("token")
+        if self.suffix == "":
+            token_refresher.wake()
+        if self.healthy:
+            logger.error(f"🚫 [{self.name}] Taking account out of rotation: {reason}")
+            print(f"🚫 [ACCOUNT] {self.name} taken out of rotation: {reason}")
+        self.healthy = False
+        self.unhealthy_since = time.time()
+        self.unhealthy_reason = reason
+
+    def mark_healthy(self):
+        if not self.healthy:
+            logger.info(f"✅ [{self.name}] Account back in rotation.")
+        self.healthy = True
+        self.unhealthy_since = None
+        self.unhealthy_reason = None
+
+    def is_available(self) -> bool:
+        """健康，或已过冷却期可以试探"""
+        if not self.configured:
+            return False
+        return self.healthy or time.time() - self.unhealthy_since >= ACCOUNT_COOLDOWN
+
+    def load(self) -> int:
+        return self.in_flight + self.scheduler.waiting + self.pool.waiting
+
+    def start(self):
+        self.tasks.append(asyncio.create_task(self.deleter.run()))
+        if ENABLE_SESSION_POOL:
+            self.tasks.append(asyncio.create_task(self.pool.refill_loop()))
+
+    async def stop(self):
+        for task in self.tasks:
+            await cancel_task(task)
+        self.tasks = []
+        await conversation_affinity.evict_account(self)
+        # 删除池中剩余的空闲会话和队列里尚未删除的会话，避免占用配额
+        for session_id in self.pool.drain():
+            delete_session(self, session_id)
+        await self.deleter.flush()
+
+    def status(self) -> dict:
+        return {
+            "configured": self.configured,
+            "healthy": self.healthy,
+            "unhealthy_reason": self.unhealthy_reason,
+            "in_flight": self.in_flight,
+            "load": self.load(),
+            "requests": self.requests,
+            "live_sessions": self.live_sessions,
+            "errors": dict(self.errors),
+            "heartbeat_session_id": self.heartbeat_session_id,
+        }
+
+class AccountPool:
+    """所有已配置的账号，按负载分发请求"""
+
+    def __init__(self):
+        self.accounts = {}   # suffix -> Account
+        self.running = False
+
+    def sync(self):
+        """根据当前凭据新增账号；令牌变化的账号恢复可用，被删掉的账号停止分发"""
+        suffixes = credential_store.account_suffixes()
+        for suffix in suffixes:
+            account = self.accounts.get(suffix)
+            if account is None:
+                account = self.accounts[suffix] = Account(suffix)
+                logger.info(f"🔑 Loaded upstream account '{account.name}'")
+                if self.running:
+                    account.start()
+            token = credential_store.get(account.key("JM_TOKEN"))
+            if token != account.token:
+                account.token = token
+                account.mark_healthy()
+            account.configured = True
+        for suffix, account in self.accounts.items():
+            if suffix not in suffixes:
+                account.configured = False
+
+    def active(self) -> list:
+        return [a for a in self.accounts.values() if a.is_available()]
+
+    def pick(self) -> Account:
+        """选出负载最低的可用账号；全部不可用时选最早被停用的账号试探"""
+        candidates = self.active()
+        if candidates:
+            return min(candidates, key=lambda a: (a.load(), a.live_sessions))
+        configured = [a for a in self.accounts.values() if a.configured]
+        if not configured:
+            raise HTTPException(status_code=500, detail="JM_TOKEN or SDP_SESSION not found in .env file.")
+        return min(configured, key=lambda a: a.unhealthy_since or 0)
+
+    def start(self):
+        self.running = True
+        for account in self.accounts.values():
+            account.start()
+
+    async def stop(self):
+        self.running = False
+        for account in self.accounts.values():
+            await account.stop()
+
+    def status(self) -> dict:
+        return {account.name: account.status() for account in self.accounts.values()}
+
+account_pool = AccountPool()
+account_pool.sync()
+credential_store.listeners.append(account_pool.sync)
+
+def token_expires_at(token: str):
+    """本地解码 JWT（与 expire.py 相同）得到 exp 时间戳，无法解析时返回 None"""
+    info = decode_jwt(token) if token else None
+    if not isinstance(info, dict):
+        return None
+    return info["payload"].get("exp")
+
+class TokenRefresher:
+    """在主账号令牌过期前后台运行 auth.py，并把新令牌热替换进凭据缓存。
+
+    正在进行的流式请求已经带着旧的请求头发出，不受影响；之后的请求直接使用新令牌。
+    """
+
+    def __init__(self):
+        self.task = None
+        self.wakeup = asyncio.Event()
+        self.running = False
+        self.refreshes = 0
+        self.failures = 0
+        self.last_refresh = None
+        self.last_error = None
+        self.retry_after = 0.0
+        self.last_duration = None
+
+    def expires_at(self):
+        """当前主账号令牌的过期时间戳，无法解析时返回 None"""
+        return token_expires_at(credential_store.get("JM_TOKEN"))
+
+    def wake(self):
+        """令牌被上游拒绝时立即尝试刷新（仍受失败重试间隔限制）"""
+        self.wakeup.set()
+
+    def due(self, forced: bool) -> bool:
+        if not leader.is_leader or self.running or time.time() < self.retry_after:
+            return False
+        if forced:
+            return True
+        expires_at = self.expires_at()
+        return expires_at is not None and expires_at - time.time() <= TOKEN_REFRESH_LEAD
+
+    async def refresh(self, reason: str) -> bool:
+        """运行 auth.py，成功写入新令牌后重新加载凭据"""
+        if not credential_store.get("XJTLU_USERNAME") or not credential_store.get("XJTLU_PASSWORD"):
+            self.last_error = "XJTLU_USERNAME or XJTLU_PASSWORD not configured"
+            self.retry_after = time.time() + TOKEN_REFRESH_RETRY_INTERVAL
+            logger.warning(f"Token refresh skipped: {self.last_error}")
+            return False
+        old_token = credential_store.get("JM_TOKEN")
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "auth.py")
+        workdir = os.path.dirname(os.path.abspath(credential_store.env_file))
+        logger.info(f"🔄 Refreshing token in background ({reason})")
+        print(f"🔄 [TOKEN] Refreshing token in background ({reason})")
+        self.running = True
+        started = time.time()
+        process = None
+        try:
+            process = await asyncio.create_subprocess_exec(
+                sys.executable, script, cwd=workdir,
+                stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT,
+                env={**os.environ, "PYTHONIOENCODING": "utf-8"},
+            )
+            output, _ = await asyncio.wait_for(process.communicate(), timeout=TOKEN_REFRESH_TIMEOUT)
+            await credential_store.refresh(force=True)
+            new_token = credential_store.get("JM_TOKEN")
+            # auth.py 失败时退出码也是 0，所以以令牌是否变化为准
+            if process.returncode != 0 or not new_token or new_token == old_token:
+                tail = output.decode("utf-8", errors="replace").strip().splitlines()[-3:]
+                raise RuntimeError(f"auth.py exited with {process.returncode} without a new token: {' | '.join(tail)}")
+        except Exception as e:
+            if isinstance(e, asyncio.TimeoutError):
+                e = RuntimeError(f"auth.py did not finish within {TOKEN_REFRESH_TIMEOUT}s")
+            if process and process.returncode is None:
+                process.kill()
+                await process.wait()
+            self.failures += 1
+            self.last_error = str(e)
+            self.retry_after = time.time() + TOKEN_REFRESH_RETRY_INTERVAL
+            logger.error(f"❌ Token refresh failed: {e}")
+            print(f"❌ [TOKEN] Refresh failed, retrying in {TOKEN_REFRESH_RETRY_INTERVAL}s")
+            return False
+        finally:
+            self.running = False
+            self.last_duration = time.time() - started
+        self.refreshes += 1
+        self.last_refresh = time.time()
+        self.last_error = None
+        logger.info(f"✅ Token refreshed in {self.last_duration:.1f}s and swapped in without restart.")
+        print(f"✅ [TOKEN] New token active ({self.last_duration:.1f}s)")
+        return True
+
+    async def run(self):
+        """后台循环：定期检查过期时间，或在令牌被拒绝时被提前唤醒"""
+        while True:
+            try:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout=TOKEN_REFRESH_CHECK_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                forced = self.wakeup.is_set()
+                self.wakeup.clear()
+                if self.due(forced):
+                    await self.refresh("token rejected by upstream" if forced else "token about to expire")
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                logger.error(f"Error in token refresh loop: {e}", exc_info=True)
+
+    def status(self) -> dict:
+        expires_at = self.expires_at()
+        fmt = lambda ts: datetime.fromtimestamp(ts).strftime('%Y-%m-%d %H:%M:%S') if ts else None
+        return {
+            "enabled": ENABLE_TOKEN_REFRESH,
+            "expires_at": fmt(expires_at),
+            "expires_in": int(expires_at - time.time()) if expires_at else None,
+            "running": self.running,
+            "refreshes": self.refreshes,
+            "failures": self.failures,
+            "last_refresh": fmt(self.last_refresh),
+            "last_duration": round(self.last_duration, 1) if self.last_duration is not None else None,
+            "last_error": self.last_error,
+        }
+
+token_refresher = TokenRefresher()
+
+class StartupTimer:
+    """记录冷启动各阶段的耗时（毫秒）"""
+
+    def __init__(self, started: float):
+        self.started = started
+        self.last_mark = started
+        self.phases = {}
+        self.ready_ms = None
+        self.probe_ms = None
+        self.probe_results = {}
+
+    def mark(self, phase: str):
+        now = time.perf_counter()
+        self.phases[phase] = round((now - self.last_mark) * 1000, 1)
+        self.last_mark = now
+
+    def ready(self):
+        self.ready_ms = round((time.perf_counter() - self.started) * 1000, 1)
+
+    def status(self) -> dict:
+        return {
+            "phases_ms": dict(self.phases),
+            "ready_ms": self.ready_ms,
+            "probe_ms": self.probe_ms,
+            "probe": dict(self.probe_results),
+            "probe_running": startup_probe_task is not None and not startup_probe_task.done(),
+        }
+
+startup_timer = StartupTimer(STARTUP_STARTED)
+
+async def probe_account(account: "Account") -> str:
+    """启动时检查账号：令牌按 exp 明确有效时直接沿用 .env 中的心跳会话，否则经心跳会话做一次网络探测"""
+    existing = credential_store.get(account.key("HEARTBEAT_SESSION_ID"))
+    expires_at = token_expires_at(credential_store.get(account.key("JM_TOKEN")))
+    if existing and expires_at is not None and expires_at - time.time() > STARTUP_PROBE_MIN_VALIDITY:
+        account.set_heartbeat_session(existing)
+        # 视同刚验证过，第一次心跳在一个完整间隔之后
+        account.last_heartbeat = time.time()
+        return "skipped (token valid locally)"
+    await create_heartbeat_session(account)
+    return "probed" if account.heartbeat_session_id else "failed"
+
+async def startup_probe():
+    """与应用启动并发进行的账号探测，完成后启动心跳循环；不阻塞第一个请求"""
+    global heartbeat_task
+    started = time.perf_counter()
+    accounts = account_pool.active()
+    results = await asyncio.gather(*(probe_account(a) for a in accounts), return_exceptions=True)
+    for account, result in zip(accounts, results):
+        if isinstance(result, Exception):
+            logger.error(f"[{account.name}] Startup probe failed: {result}")
+            result = f"error: {result}"
+        startup_timer.probe_results[account.name] = result
+    startup_timer.probe_ms = round((time.perf_counter() - started) * 1000, 1)
+    logger.info(f"🔎 Startup probe finished in {startup_timer.probe_ms} ms: {startup_timer.probe_results}")
+    print(f"🔎 Startup probe finished in {startup_timer.probe_ms:.0f} ms: {startup_timer.probe_results}")
+    heartbeat_task = asyncio.create_task(heartbeat_loop())
 
 @app.on_event("startup")
 async def startup_event():
-    global heartbeat_task
+    global heartbeat_task, startup_probe_task, loop_lag_task, prewarm_task
+    startup_timer.mark("server_boot")
     
     logger.info("Starting XJTLU GenAI Adapter (v12 - With Heartbeat)...")
     print("🚀 XJTLU GenAI Adapter v12 Starting...")
     print(f"⚙️  Auto-deletion: {'Enabled' if ENABLE_AUTO_DELETION else 'Disabled'}")
     print(f"💓 Heartbeat: {'Enabled' if ENABLE_HEARTBEAT else 'Disabled'}")
+    print(f"♨️  Session pool: {'Enabled' if ENABLE_SESSION_POOL else 'Disabled'}")
+    
+    print(f"🔑 Upstream accounts: {', '.join(a.name for a in account_pool.accounts.values()) or 'None'}")
+    if shared_state is not None:
+        await leader.renew()
+        leader.task = asyncio.create_task(leader.run())
+        print(f"👥 Multi-worker mode: {WORKERS} workers, this worker is {'the leader' if leader.is_leader else 'a follower'}")
     
+    credential_store.task = asyncio.create_task(credential_store.watch_loop())
+    if ENABLE_TOKEN_REFRESH:
+        token_refresher.task = asyncio.create_task(token_refresher.run())
+        expires_in = token_refresher.status()["expires_in"]
+        print(f"🔄 Token refresh: Enabled (token expires in {expires_in // 60 if expires_in is not None else '?'} min)")
+    loop_lag_task = asyncio.create_task(loop_lag_monitor())
+    if ENABLE_CONNECTION_PREWARM:
+        prewarm_task = asyncio.create_task(prewarm_loop())
+    print(f"🔌 Upstream transport: {'HTTP/2' if upstream.http2 else 'HTTP/1.1'}, up to {UPSTREAM_MAX_CONNECTIONS} connections")
+    if traffic_capture:
+        print(f"📼 Traffic capture: {traffic_capture.path} (prompts {'included' if CAPTURE_PROMPTS else 'redacted'})")
+    account_pool.start()
+    if ENABLE_BATCHES:
+        batch_runner.task = asyncio.create_task(batch_runner.run())
+    startup_timer.mark("background_tasks")
+
     if ENABLE_HEARTBEAT:
-        # 创建心跳会话
-        await create_heartbeat_session()
-        # 启动心跳任务
-        heartbeat_task = asyncio.create_task(heartbeat_loop())
+        if leader.is_leader:
+            # 探测（需要时创建心跳会话）在后台进行，完成后再启动心跳任务
+            startup_probe_task = asyncio.create_task(startup_probe())
+        else:
+            # 多进程模式下只由领导者探测和创建心跳会话，其他进程沿用 .env 中的ID
+            for account in account_pool.active():
+                account.heartbeat_session_id = credential_store.get(account.key("HEARTBEAT_SESSION_ID"))
+            heartbeat_task = asyncio.create_task(heartbeat_loop())
+    startup_timer.mark("heartbeat_setup")
+    startup_timer.ready()
+    logger.info(f"✅ Ready to serve in {startup_timer.ready_ms} ms: {startup_timer.phases}")
+    print(f"✅ Ready to serve in {startup_timer.ready_ms:.0f} ms ({', '.join(f'{k} {v:.0f} ms' for k, v in startup_timer.phases.items())})")
 
-@app.on_event("shutdown")
-async def shutdown_event():
-    global heartbeat_task
-    
-    if heartbeat_task:
-        heartbeat_task.cancel()
+async def cancel_task(task):
+    """取消后台任务并等待其结束"""
+    if task:
+        task.cancel()
         try:
-            await heartbeat_task
+            await task
         except asyncio.CancelledError:
             pass
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await cancel_task(startup_probe_task)
+    await cancel_task(heartbeat_task)
+    await cancel_task(credential_store.task)
+    await cancel_task(token_refresher.task)
+    await cancel_task(loop_lag_task)
+    await cancel_task(prewarm_task)
+    await cancel_task(batch_runner.task)
+    await cancel_task(leader.task)
+    await leader.release()
+    await account_pool.stop()
     
-    await client.aclose()
+    await upstream.aclose()
     logger.info("Adapter shut down.")
+    if shared_state is not None:
+        shared_state.close()
+    if traffic_capture:
+        traffic_capture.stop()
+    log_listener.stop()
     print("👋 Adapter shut down.")
 
 @app.get("/v1/models")
 async def list_models():
     update_user_activity()  # 记录用户活动
-    logger.info("Received request for model list.")
+    if log_sampled("/v1/models"):
+        logger.info("Received request for model list.")
     model_list = [{"id": model_id, "object": "model", "created": int(time.time()), "owned_by": "XJTLU"} for model_id in AVAILABLE_MODELS]
     return JSONResponse(content={"object": "list", "data": model_list})
 
+class ResponseCache:
+    """确定性请求的响应缓存：LRU 淘汰，带总字节上限和 TTL。
+
+    缓存的是上游返回的文本片段列表，命中时可按原样以流式或非流式返回。
+    """
+
+    def __init__(self):
+        self.entries = OrderedDict()   # key -> (deltas, size, expires_at)
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+
+    def is_cacheable(self, openai_request: dict, request: Request) -> bool:
+        """只缓存低温度的请求；客户端可用 Cache-Control: no-cache 跳过缓存"""
+        if not ENABLE_RESPONSE_CACHE or bypasses_cache(request):
+            return False
+        return is_deterministic(openai_request)
+
+    def get(self, key: str):
+        entry = self.entries.get(key)
+        if entry is None or entry[2] < time.time():
+            if entry is not None:
+                self._remove(key)
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, key: str, deltas: list):
+        size = sum(len(d.encode("utf-8")) for d in deltas)
+        if size > RESPONSE_CACHE_MAX_BYTES:
+            return
+        if key in self.entries:
+            self._remove(key)
+        self.entries[key] = (tuple(deltas), size, time.time() + RESPONSE_CACHE_TTL)
+        self.total_bytes += size
+        self.stores += 1
+        while len(self.entries) > RESPONSE_CACHE_MAX_ENTRIES or self.total_bytes > RESPONSE_CACHE_MAX_BYTES:
+            self._remove(next(iter(self.entries)))
+            self.evictions += 1
+
+    def _remove(self, key: str):
+        _, size, _ = self.entries.pop(key)
+        self.total_bytes -= size
+
+    async def record(self, key: str, deltas):
+        """透传文本片段，完整结束且非空时存入缓存"""
+        collected = []
+        async for data_content in deltas:
+            collected.append(data_content)
+            yield data_content
+        if collected:
+            self.put(key, collected)
+
+    def status(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "enabled": ENABLE_RESPONSE_CACHE,
+            "entries": len(self.entries),
+            "bytes": self.total_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "stores": self.stores,
+            "evictions": self.evictions,
+        }
+
+response_cache = ResponseCache()
+
+def is_deterministic(openai_request: dict) -> bool:
+    """temperature 不高于 RESPONSE_CACHE_MAX_TEMPERATURE 的请求视为确定性请求，可以缓存和合并"""
+    temperature = openai_request.get("temperature", 0.7)
+    return isinstance(temperature, (int, float)) and temperature <= RESPONSE_CACHE_MAX_TEMPERATURE
+
+def bypasses_cache(request: Request) -> bool:
+    """客户端要求跳过缓存和请求合并"""
+    return "no-cache" in request.headers.get("cache-control", "").lower()
+
+def response_cache_key(session_config: dict, messages: list) -> str:
+    """模型、会话参数和消息的规范化哈希，决定了上游收到的全部内容"""
+    canonical = json.dumps({"config": session_config, "messages": messages}, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+async def replay_deltas(deltas):
+    """把缓存的文本片段重新作为异步迭代器产出"""
+    for data_content in deltas:
+        yield data_content
+
+_FLIGHT_END = object()
+
+class InflightGeneration:
+    """一次正在进行的上游生成。
+
+    由后台任务驱动上游数据流，每个订阅者（首个请求和后来合并进来的请求）
+    各有一个独立的队列，加入时先补发已经产生的片段。所有订阅者都离开后取消生成。
+    """
+
+    def __init__(self, key: str, group: "SingleFlight"):
+        self.key = key
+        self.group = group
+        self.chunks = []
+        self.subscribers = set()
+        self.done = False
+        self.error = None
+        self.task = None
+        self.ready = asyncio.Event()    # 开始生成、失败或被放弃时置位
+        self.abandoned = False
+
+    def start(self, deltas: "LeasedDeltas"):
+        self.task = asyncio.create_task(self._pump(deltas))
+        self.task.add_done_callback(lambda task: self._stopped(deltas))
+        self.ready.set()
+
+    def _stopped(self, deltas: "LeasedDeltas"):
+        """后台任务在第一次运行之前就被取消时 _pump 一行都没有执行，由这里结束并归还资源"""
+        if not self.done:
+            self._finish(HTTPException(status_code=503, detail="Generation was cancelled."))
+        asyncio.ensure_future(deltas.release_unused())
+
+    async def _pump(self, deltas):
+        try:
+            async for data_content in deltas:
+                self.chunks.append(data_content)
+                for queue in self.subscribers:
+                    queue.put_nowait(data_content)
+            self._finish(None)
+        except asyncio.CancelledError:
+            self._finish(HTTPException(status_code=503, detail="Generation was cancelled."))
+            raise
+        except Exception as e:
+            self._finish(e)
+
+    def _finish(self, error):
+        self.done = True
+        self.error = error
+        self.group.remove(self)
+        self.ready.set()
+        for queue in self.subscribers:
+            queue.put_nowait(_FLIGHT_END)
+
+    def fail(self, error: Exception):
+        """首个请求在开始生成之前就失败了（例如创建会话失败），等待中的请求得到同样的错误"""
+        self._finish(error)
+
+    def abandon(self):
+        """首个请求因为只属于它自己的原因（被准入拒绝、客户端断开）没有开始生成，等待中的请求重新竞争"""
+        self.abandoned = True
+        self._finish(None)
+
+    def subscribe(self) -> "LeasedDeltas":
+        """订阅从创建时就计入；还没被读取就被丢弃（客户端在响应开始前断开）时同样退出"""
+        queue = asyncio.Queue()
+        for data_content in self.chunks:
+            queue.put_nowait(data_content)
+        if self.done:
+            queue.put_nowait(_FLIGHT_END)
+        self.subscribers.add(queue)
+        return LeasedDeltas(self._drain(queue), lambda: self._leave(queue))
+
+    async def _drain(self, queue: asyncio.Queue):
+        try:
+            while True:
+                item = await queue.get()
+                if item is _FLIGHT_END:
+                    if self.error:
+                        raise self.error
+                    return
+                yield item
+        finally:
+            await self._leave(queue)
+
+    async def _leave(self, queue: asyncio.Queue):
+        self.subscribers.discard(queue)
+        if not self.subscribers and not self.done and self.task:
+            self.task.cancel()
+
+class SingleFlight:
+    """按请求哈希合并并发的相同请求"""
+
+    def __init__(self):
+        self.flights = {}
+        self.leaders = 0
+        self.followers = 0
+
+    def join(self, key: str):
+        """返回 (generation, is_leader)；没有进行中的相同请求时当前请求成为 leader"""
+        flight = self.flights.get(key)
+        if flight:
+            self.followers += 1
+            return flight, False
+        flight = InflightGeneration(key, self)
+        self.flights[key] = flight
+        self.leaders += 1
+        return flight, True
+
+    def remove(self, flight: InflightGeneration):
+        if self.flights.get(flight.key) is flight:
+            del self.flights[flight.key]
+
+    def status(self) -> dict:
+        return {
+            "enabled": ENABLE_REQUEST_COALESCING,
+            "in_flight": len(self.flights),
+            "subscribers": sum(len(f.subscribers) for f in self.flights.values()),
+            "leaders": self.leaders,
+            "followers": self.followers,
+        }
+
+single_flight = SingleFlight()
+
+def conversation_fingerprints(session_config: dict, messages: list) -> list:
+    """对话历史每个前缀的指纹：结果第 i 项对应 messages[:i+1]（增量哈希，总开销与历史长度成正比）"""
+    hasher = hashlib.sha256(json.dumps(session_config, sort_keys=True).encode("utf-8"))
+    fingerprints = []
+    for msg in messages:
+        content = msg.get("content", "")
+        if isinstance(content, str):
+            # 客户端回传助手回复时常会去掉首尾空白
+            content = content.strip()
+        hasher.update(json.dumps([msg.get("role", "user"), content], ensure_ascii=False, sort_keys=True).encode("utf-8") + b"\n")
+        fingerprints.append(hasher.copy().hexdigest())
+    return fingerprints
+
+class ConversationAffinity:
+    """对话保持：把完成一轮对话的上游会话按历史指纹保留下来，下一轮只发送新增的消息。
+
+    一个会话同一时间只服务一个请求：命中时从表中取出，回答正常结束后以新的历史指纹放回；
+    出错或被中断时会话里的历史已不可信，直接归还删除。
+    """
+
+    def __init__(self):
+        self.entries = OrderedDict()   # 指纹 -> (account, session_id, session_config, 保留时间)
+        self.pinned = set()            # 正在被对话保持请求使用的会话
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        self.saved_chars = 0
+
+    def is_pinned(self, session_id: str) -> bool:
+        return session_id in self.pinned
+
+    async def take(self, session_config: dict, messages: list):
+        """找到保存了 messages 最长前缀的会话，返回 (account, session_id, 新增消息)；没有则返回 None"""
+        await self._expire()
+        if len(messages) < 2 or messages[-1].get("role") != "user":
+            return None
+        fingerprints = conversation_fingerprints(session_config, messages)
+        for k in range(len(messages) - 1, 0, -1):
+            entry = self.entries.pop(fingerprints[k - 1], None)
+            if entry is None:
+                continue
+            account, session_id, _, _ = entry
+            if not account.is_available():
+                await self._release(account, session_id, session_config)
+                continue
+            self.hits += 1
+            self.saved_chars += sum(len(str(m.get("content", ""))) for m in messages[:k])
+            logger.info(f"🧵 Conversation affinity hit: Session ID {session_id} ({account.name}), sending {len(messages) - k} new message(s).")
+            return account, session_id, messages[k:]
+        self.misses += 1
+        return None
+
+    def record(self, account: "Account", session_id: str, session_config: dict, messages: list, deltas):
+        """包装上游片段流：正常结束时以 (历史 + 本次回答) 的指纹保留会话"""
+        self.pinned.add(session_id)
+
+        async def recorder():
+            parts = []
+            completed = False
+            try:
+                async for data_content in deltas:
+                    parts.append(data_content)
+                    yield data_content
+                completed = True
+            finally:
+                if completed and account.is_available():
+                    history = messages + [{"role": "assistant", "content": "".join(parts)}]
+                    fingerprint = conversation_fingerprints(session_config, history)[-1]
+                    self.entries[fingerprint] = (account, session_id, session_config, time.time())
+                    self.pinned.discard(session_id)
+                    await self._enforce_limit(account)
+                else:
+                    await self._release(account, session_id, session_config)
+        return recorder()
+
+    async def _release(self, account: "Account", session_id: str, session_config: dict):
+        """保留的会话都带着对话记录，归还时不能再放回会话池"""
+        self.pinned.discard(session_id)
+        await account.pool.release(session_id, session_config, generated=True)
+
+    async def _evict(self, fingerprint: str):
+        account, session_id, session_config, _ = self.entries.pop(fingerprint)
+        self.evicted += 1
+        await self._release(account, session_id, session_config)
+
+    async def _expire(self):
+        now = time.time()
+        for fingerprint, (_, _, _, retained_at) in list(self.entries.items()):
+            if now - retained_at > AFFINITY_TTL:
+                await self._evict(fingerprint)
+
+    async def _enforce_limit(self, account: "Account"):
+        """每个账号保留的会话数不超过 AFFINITY_MAX_SESSIONS，按保留时间先后淘汰"""
+        owned = [fp for fp, entry in self.entries.items() if entry[0] is account]
+        for fingerprint in owned[:max(0, len(owned) - AFFINITY_MAX_SESSIONS)]:
+            await self._evict(fingerprint)
+
+    async def evict_account(self, account: "Account"):
+        """释放某个账号保留的全部对话会话（关闭服务时）"""
+        for fingerprint in [fp for fp, entry in self.entries.items() if entry[0] is account]:
+            await self._evict(fingerprint)
+
+    async def evict_for_quota(self, account: "Account"):
+        """账号的存活会话接近配额上限时，释放它最久未用的对话会话"""
+        excess = account.live_sessions - (SESSION_QUOTA - DELETE_QUOTA_MARGIN) + 1
+        owned = [fp for fp, entry in self.entries.items() if entry[0] is account]
+        for fingerprint in owned[:max(0, excess)]:
+            logger.warning(f"[{account.name}] Near session quota, releasing retained conversation session.")
+            await self._evict(fingerprint)
+
+    def status(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "enabled": ENABLE_CONVERSATION_AFFINITY,
+            "retained": len(self.entries),
+            "in_use": len(self.pinned),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+            "evicted": self.evicted,
+            "history_chars_not_resent": self.saved_chars,
+        }
+
+conversation_affinity = ConversationAffinity()
+
+class AdmissionTicket:
+    """一个已放行的上游生成名额；release 可以重复调用，只生效一次"""
+
+    def __init__(self, controller: "AdmissionController"):
+        self.controller = controller
+        self.started = time.perf_counter()
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.controller.release(time.perf_counter() - self.started)
+
+class AdmissionController:
+    """限制同时进行的上游生成数。
+
+    名额用完后请求按优先级排队，同一优先级内按客户端轮转放行，一个客户端的突发请求
+    不会饿死其他客户端。队列满或排队超时直接拒绝，并根据平均生成时长给出 Retry-After。
+    """
+
+    def __init__(self):
+        self.active = 0
+        self.queues = {name: OrderedDict() for name in ADMISSION_PRIORITIES}   # priority -> client -> deque of futures
+        self.client_waiting = {}
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = {}
+        self.avg_generation = None
+
+    @staticmethod
+    def client_of(request: Request) -> str:
+        """按 API key 区分客户端，没有时用来源 IP"""
+        auth = request.headers.get("authorization")
+        if auth:
+            return "key:" + hashlib.sha256(auth.encode("utf-8")).hexdigest()[:12]
+        return "ip:" + (request.client.host if request.client else "unknown")
+
+    @staticmethod
+    def priority_of(request: Request) -> str:
+        name = request.headers.get(ADMISSION_PRIORITY_HEADER, "normal").strip().lower()
+        return name if name in ADMISSION_PRIORITIES else "normal"
+
+    def queued(self, priority: str) -> int:
+        return sum(len(waiters) for waiters in self.queues[priority].values())
+
+    def retry_after(self) -> int:
+        """排在队尾的请求大约要等多久（秒）；还没有完成过生成时按 10 秒一次估算"""
+        per_generation = self.avg_generation or 10.0
+        return max(1, math.ceil((self.waiting + 1) / ADMISSION_MAX_IN_FLIGHT * per_generation))
+
+    def reject(self, status_code: int, reason: str, detail: str) -> HTTPException:
+        self.rejected[reason] = self.rejected.get(reason, 0) + 1
+        ADMISSION_REJECTED.inc(reason=reason)
+        logger.warning(f"🚦 Admission rejected ({reason}): {self.active} in flight, {self.waiting} queued.")
+        return HTTPException(status_code=status_code, detail=detail, headers={"Retry-After": str(self.retry_after())})
+
+    async def acquire(self, client: str, priority: str) -> AdmissionTicket:
+        """等到一个生成名额；队列满或排队超时时抛出 429/503"""
+        started = time.perf_counter()
+        if self.active < ADMISSION_MAX_IN_FLIGHT and not self.waiting:
+            self.active += 1
+            return self._ticket(priority, started)
+        if self.waiting >= ADMISSION_MAX_QUEUE:
+            raise self.reject(503, "queue_full", "Server is busy: too many requests are queued. Please retry later.")
+        if self.client_waiting.get(client, 0) >= ADMISSION_MAX_QUEUE_PER_CLIENT:
+            raise self.reject(429, "client_queue_full", "Too many queued requests from this client. Please retry later.")
+
+        future = asyncio.get_running_loop().create_future()
+        self.queues[priority].setdefault(client, deque()).append(future)
+        self.client_waiting[client] = self.client_waiting.get(client, 0) + 1
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(asyncio.shield(future), ADMISSION_QUEUE_TIMEOUT)
+        except asyncio.TimeoutError:
+            if not self._abandon(client, priority, future):
+                raise self.reject(503, "queue_timeout", "Server is busy: timed out waiting in the queue. Please retry later.")
+        except asyncio.CancelledError:
+            if self._abandon(client, priority, future):
+                self.release(None)
+            raise
+        return self._ticket(priority, started)
+
+    def _ticket(self, priority: str, started: float) -> AdmissionTicket:
+        ADMISSION_WAIT_SECONDS.observe(time.perf_counter() - started, priority=priority)
+        self.admitted += 1
+        return AdmissionTicket(self)
+
+    def _abandon(self, client: str, priority: str, future) -> bool:
+        """排队的请求放弃等待；返回 True 表示名额其实已经分给了它"""
+        if future.done():
+            return True
+        waiters = self.queues[priority][client]
+        waiters.remove(future)
+        if not waiters:
+            del self.queues[priority][client]
+        self._forget(client)
+        future.cancel()
+        return False
+
+    def _forget(self, client: str):
+        self.waiting -= 1
+        self.client_waiting[client] -= 1
+        if not self.client_waiting[client]:
+            del self.client_waiting[client]
+
+    def release(self, duration):
+        """归还名额并放行下一个排队的请求；duration 用于估算 Retry-After"""
+        self.active -= 1
+        if duration is not None:
+            self.avg_generation = duration if self.avg_generation is None else 0.8 * self.avg_generation + 0.2 * duration
+        while self.active < ADMISSION_MAX_IN_FLIGHT and self.waiting:
+            self._next_waiter().set_result(None)
+            self.active += 1
+
+    def _next_waiter(self):
+        """优先级最高的非空队列里，轮到的那个客户端的最早一个请求"""
+        for name in sorted(self.queues, key=ADMISSION_PRIORITIES.get):
+            clients = self.queues[name]
+            if clients:
+                client, waiters = next(iter(clients.items()))
+                future = waiters.popleft()
+                if waiters:
+                    clients.move_to_end(client)
+                else:
+                    del clients[client]
+                self._forget(client)
+                return future
+
+    async def hold(self, ticket: AdmissionTicket, deltas):
+        """生成结束时归还名额（数据流没有被迭代过时由 LeasedDeltas 的 release_unused 归还）"""
+        try:
+            async for data_content in deltas:
+                yield data_content
+        finally:
+            ticket.release()
+
+    def status(self) -> dict:
+        return {
+            "enabled": ENABLE_ADMISSION_CONTROL,
+            "max_in_flight": ADMISSION_MAX_IN_FLIGHT,
+            "in_flight": self.active,
+            "queued": self.waiting,
+            "queued_by_priority": {name: self.queued(name) for name in ADMISSION_PRIORITIES},
+            "queued_clients": len(self.client_waiting),
+            "admitted": self.admitted,
+            "rejected": dict(self.rejected),
+            "avg_generation_seconds": round(self.avg_generation, 2) if self.avg_generation is not None else None,
+            "retry_after": self.retry_after(),
+        }
+
+admission = AdmissionController()
+
+async def completion_deltas(account: Account, session_id: str, session_config: dict, xjtlu_payload: dict):
+    """调用 completions 并逐个产出上游返回的文本片段，结束后归还会话"""
+    model = session_config.get("model")
+    first_chunk_at = None
+    aborted = False
+    failed_kind = None
+    try:
+        waited = await account.scheduler.acquire("completions")
+        STAGE_SECONDS.observe(waited, stage="scheduler_wait", model=model)
+        sent_at = time.perf_counter()
+        async with upstream.stream("POST", CHAT_API_URL, json=xjtlu_payload, headers=account.headers()) as response:
+            if response.status_code >= 400 or "application/json" in response.headers.get("content-type", ""):
+                # 出错时上游返回的是 JSON 而不是 SSE（例如 "Request too fast"），读完后按分类抛出
+                await response.aread()
+                account.record_response(response, "completions")
+                raise upstream_error(response, "completions")
+            account.record_status(response.status_code)
+            parser = UpstreamSSEParser()
+            async for raw in raw_byte_stream(response):
+                for data_content in parser.feed(raw):
+                    if first_chunk_at is None:
+                        first_chunk_at = time.perf_counter()
+                        STAGE_SECONDS.observe(first_chunk_at - sent_at, stage="upstream_ttft", model=model)
+                    STREAM_CHUNKS.inc(model=model)
+                    STREAM_CHARS.inc(len(data_content), model=model)
+                    yield data_content
+            for data_content in parser.close():
+                STREAM_CHUNKS.inc(model=model)
+                STREAM_CHARS.inc(len(data_content), model=model)
+                yield data_content
+    except UpstreamError as e:
+        failed_kind = e.kind
+        raise
+    except httpx.TransportError as e:
+        account.record_error(type(e).__name__)
+        if first_chunk_at is None:
+            # 还没有输出任何内容，交给调用方按分类重试
+            failed_kind = "timeout" if isinstance(e, httpx.TimeoutException) else "network"
+            raise transport_error(e, "completions") from e
+        raise
+    except (asyncio.CancelledError, GeneratorExit):
+        # 客户端断开（或合并的请求全部离开）：退出 async with 时上游连接随之关闭
+        aborted = True
+        raise
+    finally:
+        if first_chunk_at is not None:
+            STAGE_SECONDS.observe(time.perf_counter() - first_chunk_at, stage="stream", model=model)
+        account.in_flight -= 1
+        if aborted:
+            GENERATIONS_ABORTED.inc(model=model)
+            logger.info(f"✂️ Upstream generation on session {session_id} ({account.name}) aborted.")
+            account.pool.discard(session_id)
+        elif failed_kind not in (None, "rate_limited", "token"):
+            # 上游可能已经处理了一部分，会话状态不明，不再复用
+            account.pool.discard(session_id)
+        else:
+            await account.pool.release(session_id, session_config, generated=failed_kind is None)
+
+class ClientDisconnected(HTTPException):
+    """客户端已经断开连接，响应不会再被读取"""
+
+    def __init__(self):
+        super().__init__(status_code=499, detail="Client closed request.")
+
+async def wait_for_disconnect(request: Request):
+    """请求体读完之后，receive() 只会在客户端断开（或响应发送完毕）时返回"""
+    while True:
+        message = await request.receive()
+        if message["type"] == "http.disconnect":
+            return
+
+async def unless_disconnected(request: Request, awaitable):
+    """等待 awaitable；客户端先断开时取消它，等取消完成（会话和名额已归还）后抛出 ClientDisconnected"""
+    task = asyncio.ensure_future(awaitable)
+    watcher = asyncio.create_task(wait_for_disconnect(request))
+    try:
+        done, _ = await asyncio.wait((task, watcher), return_when=asyncio.FIRST_COMPLETED)
+    except asyncio.CancelledError:
+        task.cancel()
+        watcher.cancel()
+        raise
+    if task in done:
+        watcher.cancel()
+        return task.result()
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+    raise ClientDisconnected()
+
+async def collect_deltas(deltas) -> list:
+    return [data_content async for data_content in deltas]
+
+class LeasedDeltas:
+    """包装已经占用了会话、名额等资源的片段流。
+
+    开始迭代之后由内层的生成器负责归还资源；客户端在响应开始发送之前就断开时，
+    数据流一次都不会被迭代，内层生成器的 finally 也就不会执行，这时由 release_unused 归还。
+    """
+
+    def __init__(self, deltas, on_unused):
+        self.deltas = deltas
+        self.on_unused = on_unused
+        self.started = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        self.started = True
+        return await self.deltas.__anext__()
+
+    async def release_unused(self):
+        """数据流没有被迭代过时归还资源，之后不能再迭代；已经开始迭代时什么都不做"""
+        if not self.started:
+            self.started = True
+            await self.deltas.aclose()
+            await self.on_unused()
+
+    async def aclose(self):
+        await self.release_unused()
+        await self.deltas.aclose()
+
+class LeasedStreamingResponse(StreamingResponse):
+    """响应结束后（包括还没开始发送客户端就断开）归还没有用上的会话和名额"""
+
+    def __init__(self, content, leased: LeasedDeltas, **kwargs):
+        super().__init__(content, **kwargs)
+        self.leased = leased
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            await self.leased.release_unused()
+
+_NO_CHUNKS = object()
+
+async def lease_generation(session_config: dict):
+    """挑选负载最低的账号并租用一个会话，返回 (account, session_id, is_warm)"""
+    account = account_pool.pick()
+    account.in_flight += 1
+    account.requests += 1
+    try:
+        lease_started = time.perf_counter()
+        session_id, is_warm = await account.pool.lease(session_config)
+        STAGE_SECONDS.observe(time.perf_counter() - lease_started, stage="session_lease", model=session_config.get("model"))
+    except BaseException:
+        account.in_flight -= 1
+        raise
+    return account, session_id, is_warm
+
+async def first_chunk(deltas, started: float):
+    """取出第一个片段并记录从发起到首字的耗时；流为空时返回 _NO_CHUNKS"""
+    try:
+        data_content = await deltas.__anext__()
+    except StopAsyncIteration:
+        return _NO_CHUNKS
+    retry_policy.observe_ttft(time.perf_counter() - started)
+    return data_content
+
+def start_attempt(account: Account, session_id: str, session_config: dict, text: str):
+    """在给定会话上发起一次 completions，返回 (片段流, 等待第一个片段的任务)"""
+    deltas = completion_deltas(account, session_id, session_config, {"text": text, "files": [], "sessionId": session_id})
+    return deltas, asyncio.create_task(first_chunk(deltas, time.perf_counter()))
+
+async def abandon_attempt(deltas, task):
+    """取消一次不再需要的尝试；completion_deltas 会把它当作中止处理并删除会话"""
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+    await deltas.aclose()
+
+async def hedge_attempt(session_config: dict, text: str):
+    """备份请求：在另一个会话上发起同样的 completions，返回 (片段流, 第一个片段)"""
+    lease = asyncio.ensure_future(lease_generation(session_config))
+    try:
+        account, session_id, _ = await asyncio.shield(lease)
+    except asyncio.CancelledError:
+        # 正在创建的会话不能半途取消，创建完成后直接归还
+        def return_lease(done):
+            if not done.cancelled() and done.exception() is None:
+                leased_account, leased_id, _ = done.result()
+                leased_account.in_flight -= 1
+                asyncio.create_task(leased_account.pool.release(leased_id, session_config))
+        lease.add_done_callback(return_lease)
+        raise
+    deltas, task = start_attempt(account, session_id, session_config, text)
+    try:
+        return deltas, await task
+    except asyncio.CancelledError:
+        await deltas.aclose()
+        raise
+
+async def first_chunk_with_hedge(account: Account, session_id: str, session_config: dict, text: str, can_hedge: bool):
+    """等待第一个片段；超过首字延迟的分位数时发起对冲，先出首字的一方胜出"""
+    deltas, task = start_attempt(account, session_id, session_config, text)
+    delay = retry_policy.hedge_delay() if ENABLE_HEDGING and can_hedge else None
+    if delay is None:
+        return deltas, await task
+    done, _ = await asyncio.wait({task}, timeout=delay)
+    if done or not retry_policy.take_hedge():
+        return deltas, await task
+
+    logger.info(f"🪁 No first token after {delay:.2f}s on session {session_id}, launching a hedged request.")
+    backup = asyncio.create_task(hedge_attempt(session_config, text))
+    try:
+        pending = {task, backup}
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            if task in done and task.exception() is None:
+                backup.cancel()
+                await asyncio.gather(backup, return_exceptions=True)
+                if not backup.cancelled() and backup.exception() is None:
+                    await backup.result()[0].aclose()
+                retry_policy.record_hedge("primary_won")
+                return deltas, task.result()
+            if backup in done and backup.exception() is None:
+                await abandon_attempt(deltas, task)
+                retry_policy.record_hedge("backup_won")
+                return backup.result()
+        # 两边都失败了，按原请求的错误处理
+        retry_policy.record_hedge("both_failed")
+        return deltas, task.result()
+    except asyncio.CancelledError:
+        backup.cancel()
+        await abandon_attempt(deltas, task)
+        raise
+
+async def resilient_deltas(account: Account, session_id: str, session_config: dict, text: str, can_switch: bool):
+    """completions 的重试与对冲：只在第一个片段之前生效，开始输出之后不再重试。
+
+    can_switch 为 False（对话保持模式，会话里已有历史）时只在同一会话上重试限速错误，也不对冲。
+    """
+    retry_policy.deposit()
+    attempt = 1
+    while True:
+        try:
+            deltas, first = await first_chunk_with_hedge(account, session_id, session_config, text, can_switch)
+            break
+        except UpstreamError as e:
+            if e.kind == "token":
+                # 令牌失效的账号已退出轮换，还有其他可用账号时换一个账号重试
+                retryable = can_switch and bool(account_pool.active())
+            else:
+                retryable = e.kind in RETRYABLE_ERRORS and (can_switch or e.kind == "rate_limited")
+            if not retry_policy.allow(e, attempt, "completions", retryable):
+                raise
+            delay = retry_policy.backoff(attempt)
+            logger.warning(f"🔁 completions on session {session_id} failed before the first chunk ({e.kind}), "
+                           f"retrying in {delay:.2f}s (attempt {attempt + 1}/{RETRY_MAX_ATTEMPTS}).")
+            await asyncio.sleep(delay)
+            attempt += 1
+            if can_switch:
+                account, session_id, _ = await lease_generation(session_config)
+            else:
+                account.in_flight += 1
+                account.requests += 1
+    if first is _NO_CHUNKS:
+        return
+    try:
+        yield first
+        async for data_content in deltas:
+            yield data_content
+    finally:
+        await deltas.aclose()
+
+async def openai_stream(deltas, model: str):
+    """把文本片段包装成 OpenAI 格式的 SSE 数据流（字节）"""
+    writer = OpenAIChunkWriter(model)
+    async for data_content in deltas:
+        yield writer.content(data_content)
+    yield writer.finish()
+
+async def timed_deltas(deltas, model: str, started: float, capture: Optional["TrafficRecord"] = None):
+    """记录客户端视角的首字延迟和整个请求的耗时（开启流量录制时也记下每个片段的时间）"""
+    first = True
+    try:
+        async for data_content in deltas:
+            if first:
+                first = False
+                STAGE_SECONDS.observe(time.perf_counter() - started, stage="ttft", model=model)
+            if capture:
+                capture.chunk(data_content)
+            yield data_content
+    except BaseException as e:
+        if capture:
+            capture.fail(e)
+        raise
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - started, stage="request", model=model)
+        if capture:
+            capture.finish()
+
+def coalesce_window(request: Request) -> float:
+    """本次请求的合并窗口（秒）：请求头（毫秒）优先，否则用全局配置"""
+    value = request.headers.get(STREAM_COALESCE_HEADER)
+    if value is None:
+        return STREAM_COALESCE_WINDOW
+    try:
+        window = float(value) / 1000
+    except ValueError:
+        return STREAM_COALESCE_WINDOW
+    return min(max(0.0, window), STREAM_COALESCE_MAX_WINDOW)
+
+def coalesced_deltas(deltas, model: str, window: float):
+    """按窗口合并文本片段，并记录事件数、每个事件包含的片段数和合并带来的额外延迟"""
+    if window <= 0:
+        return deltas
+    label = f"{window * 1000:g}ms"
+
+    def on_flush(count: int, held: float):
+        STREAM_EVENTS.inc(model=model, window=label)
+        STREAM_EVENT_DELTAS.inc(count, model=model, window=label)
+        COALESCE_HOLD_SECONDS.observe(held, window=label)
+    return coalesce_deltas(deltas, window, STREAM_COALESCE_MAX_BYTES, on_flush)
+
+def openai_completion(full_content: str, model: str) -> dict:
+    """构造标准的 OpenAI 非流式响应对象"""
+    return {
+        "id": f"chatcmpl-{uuid.uuid4()}", "object": "chat.completion",
+        "created": int(time.time()), "model": model,
+        "choices": [{
+            "index": 0, "message": {"role": "assistant", "content": full_content},
+            "finish_reason": "stop"
+        }],
+        "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+    }
+
 @app.post("/v1/chat/completions")
 async def chat_proxy(request: Request):
     update_user_activity()  # Record user activity
+    started = time.perf_counter()
 
     try:
         openai_request = await request.json()
-        logger.info(f"\n--- CLIENT REQ ---\n{json.dumps(openai_request, indent=2, ensure_ascii=False)}\n------------------")
+        log_details = log_sampled(request.url.path)
+        if log_details:
+            logger.info(f"CLIENT REQ {request_log_record(openai_request)}")
     except Exception as e:
         logger.error(f"Failed to parse request JSON: {e}", exc_info=True)
         raise HTTPException(status_code=400, detail=f"Invalid JSON in request body: {e}")
 
+    capture = traffic_capture.begin(openai_request) if traffic_capture else None
+    try:
+        return await handle_chat(request, openai_request, started, log_details, capture)
+    except BaseException as e:
+        if capture:
+            capture.fail(e)
+            capture.finish()
+        raise
+
+async def handle_chat(request: Request, openai_request: dict, started: float, log_details: bool, capture: Optional["TrafficRecord"]):
     # Check if the client requested a streaming response. Default to False.
     is_streaming = openai_request.get("stream", False)
-
-    # Step 1: Create a new, fully configured session
-    session_id_to_use = await create_new_session(openai_request)
-    
-    # Step 2: Process messages and create the full prompt
+    model = openai_request.get("model")
     messages = openai_request.get("messages", [])
     if not messages:
-        if ENABLE_AUTO_DELETION:
-            asyncio.create_task(delete_session(session_id_to_use))
         raise HTTPException(status_code=400, detail="No 'messages' in request.")
-    
-    full_prompt = process_and_format_prompt(messages)
-    
-    # Step 3: Add the critical delay to avoid rate-limiting
-    await asyncio.sleep(INTER_REQUEST_DELAY)
+    problem = invalid_messages(messages)
+    if problem:
+        raise HTTPException(status_code=400, detail=problem)
+    session_config = build_session_config(openai_request)
+
+    # Step 0: Serve deterministic repeats straight from the response cache
+    cache_key = None
+    if response_cache.is_cacheable(openai_request, request):
+        cache_key = response_cache_key(session_config, messages)
+        cached_deltas = response_cache.get(cache_key)
+        if cached_deltas is not None:
+            logger.info(f"📦 Response cache hit ({cache_key[:12]}), replaying {len(cached_deltas)} chunks.")
+            REQUESTS_TOTAL.inc(model=model, source="cache")
+            if capture:
+                capture.source = "cache"
+            if is_streaming:
+                return StreamingResponse(openai_stream(coalesced_deltas(timed_deltas(replay_deltas(cached_deltas), model, started, capture), model, coalesce_window(request)), model), media_type="text/event-stream")
+            if capture:
+                for data_content in cached_deltas:
+                    capture.chunk(data_content)
+                capture.finish()
+            return JSONResponse(content=openai_completion("".join(cached_deltas), model))
+
+    # Step 0.5: Attach to an identical generation that is already in flight
+    flight = None
+    deltas = None
+    if ENABLE_REQUEST_COALESCING and not bypasses_cache(request) and is_deterministic(openai_request):
+        flight_key = cache_key or response_cache_key(session_config, messages)
+        while True:
+            flight, is_leader = single_flight.join(flight_key)
+            if is_leader:
+                break
+            # 等首个请求真正开始生成；它因为自己的原因放弃时，由等待中的请求接替成为新的首个请求
+            await unless_disconnected(request, flight.ready.wait())
+            if not flight.abandoned:
+                logger.info(f"🔗 Attaching to in-flight generation {flight.key[:12]} ({len(flight.chunks)} chunks so far).")
+                deltas = flight.subscribe()
+                label = f"coalesced request {flight.key[:12]}"
+                REQUESTS_TOTAL.inc(model=model, source="coalesced")
+                if capture:
+                    capture.source = "coalesced"
+                break
+            flight = None
+
+    if deltas is None:
+        # Step 1: Wait for an upstream generation slot, then continue on the upstream session that
+        # already holds this conversation, or pick the least-loaded account and lease a session
+        ticket = None
+        account = None
+        admitted = False
 
-    # Step 4: Prepare the payload for the upstream XJTLU service
-    xjtlu_payload = {"text": full_prompt, "files": [], "sessionId": session_id_to_use}
+        async def release_unused():
+            # 生成还没开始（deltas 没有被迭代过），名额和会话都由这里归还
+            if ticket:
+                ticket.release()
+            if account:
+                account.in_flight -= 1
+                conversation_affinity.pinned.discard(session_id_to_use)
+                # 对话保持的会话里已经有历史，不能当作干净的会话放回池中
+                await account.pool.release(session_id_to_use, session_config, generated=bool(affinity))
+
+        try:
+            if ENABLE_ADMISSION_CONTROL:
+                ticket = await unless_disconnected(
+                    request, admission.acquire(admission.client_of(request), admission.priority_of(request)))
+            admitted = True
+            affinity = await conversation_affinity.take(session_config, messages) if ENABLE_CONVERSATION_AFFINITY else None
+            if affinity:
+                account, session_id_to_use, new_messages = affinity
+                is_warm = True
+                account.in_flight += 1
+                account.requests += 1
+            else:
+                account, session_id_to_use, is_warm = await lease_generation(session_config)
+            if await request.is_disconnected():
+                # 客户端在排队或准备会话期间离开：会话还没用过，在下面直接归还
+                raise ClientDisconnected()
+            label = f"Session ID: {session_id_to_use} ({account.name})"
+
+            # Step 2: Process messages and create the full prompt (only the new turn when the session already has the history)
+            full_prompt = process_and_format_prompt(new_messages if affinity else messages, log_details)
+
+            # Step 3: The critical delay to avoid rate-limiting is now enforced by the account's scheduler,
+            # which spaces this completions call from every other upstream call made with the same account.
+            if is_warm:
+                logger.info(f"Warm session {session_id_to_use}, no saveSession needed before completions.")
+
+            # Step 4: Call completions; failures before the first chunk are retried (on a fresh session
+            # unless the session holds the conversation), and a slow first token can be hedged
+            deltas = resilient_deltas(account, session_id_to_use, session_config, full_prompt, can_switch=not affinity)
+            if ticket:
+                deltas = admission.hold(ticket, deltas)
+            if ENABLE_CONVERSATION_AFFINITY:
+                deltas = conversation_affinity.record(account, session_id_to_use, session_config, messages, deltas)
+            if cache_key:
+                deltas = response_cache.record(cache_key, deltas)
+            deltas = LeasedDeltas(deltas, release_unused)
+            if flight:
+                flight.start(deltas)
+                deltas = flight.subscribe()
+        except BaseException as e:
+            await release_unused()
+            if isinstance(e, ClientDisconnected):
+                CLIENT_DISCONNECTS.inc(stage="before_upstream")
+                logger.info("🔌 Client disconnected before the upstream generation started.")
+            if flight:
+                if not admitted or not isinstance(e, Exception) or isinstance(e, ClientDisconnected):
+                    # 准入拒绝（例如本客户端超过排队上限）和客户端断开只属于首个请求，不传给等待中的请求
+                    flight.abandon()
+                else:
+                    flight.fail(e)
+            raise
+        REQUESTS_TOTAL.inc(model=model, source="affinity" if affinity else "warm" if is_warm else "cold")
+        if capture:
+            capture.source = "affinity" if affinity else "warm" if is_warm else "cold"
 
     # === Logic to handle STREAMING vs. NON-STREAMING ===
+    leased = deltas
+    deltas = timed_deltas(leased, model, started, capture)
     
     if is_streaming:
-        # Use the existing generator for streaming responses
+        window = coalesce_window(request)
+
         async def stream_generator():
+            logger.info(f"Streaming response for {label}")
+            chunks = openai_stream(coalesced_deltas(deltas, model, window), model)
             try:
-                logger.info(f"Streaming response for Session ID: {session_id_to_use}")
-                async with client.stream("POST", CHAT_API_URL, json=xjtlu_payload, headers=get_dynamic_headers()) as response:
-                    response.raise_for_status()
-                    async for line in response.aiter_lines():
-                        if line.startswith("data:"):
-                            chunk_str = line[len("data:"):].strip()
-                            if not chunk_str or chunk_str == "[DONE]": continue
-                            try:
-                                xjtlu_chunk = json.loads(chunk_str)
-                                data_content = xjtlu_chunk.get("data")
-                                if not isinstance(data_content, str): continue
-                                openai_chunk = {"id": f"chatcmpl-{uuid.uuid4()}", "object": "chat.completion.chunk", "created": int(time.time()), "model": openai_request.get("model"), "choices": [{"index": 0, "delta": {"content": data_content}, "finish_reason": None}]}
-                                yield f"data: {json.dumps(openai_chunk)}\n\n"
-                            except json.JSONDecodeError: continue
-                    done_chunk = {"id": f"chatcmpl-{uuid.uuid4()}", "object": "chat.completion.chunk", "created": int(time.time()), "model": openai_request.get("model"), "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}
-                    yield f"data: {json.dumps(done_chunk)}\n\n"
-                    yield "data: [DONE]\n\n"
-                    logger.info(f"Stream finished for Session ID: {session_id_to_use}.")
+                async for chunk in chunks:
+                    yield chunk
+            except (asyncio.CancelledError, GeneratorExit):
+                # Starlette 监听到 http.disconnect 后会取消发送任务
+                CLIENT_DISCONNECTS.inc(stage="streaming")
+                logger.info(f"🔌 Client disconnected, aborting stream for {label}.")
+                raise
             finally:
-                if ENABLE_AUTO_DELETION:
-                    logger.info(f"Scheduling session {session_id_to_use} for deletion.")
-                    asyncio.create_task(delete_session(session_id_to_use))
+                # 先关闭合并层（它可能还在等下一个片段），再关闭上游的生成器
+                await chunks.aclose()
+                await deltas.aclose()
+            logger.info(f"Stream finished for {label}.")
         
-        return StreamingResponse(stream_generator(), media_type="text/event-stream")
+        return LeasedStreamingResponse(stream_generator(), leased, media_type="text/event-stream")
 
     else:
         # Handle the non-streaming request for Dify's validation
-        full_content = ""
+        logger.info(f"Non-streaming response for {label}")
         try:
-            logger.info(f"Non-streaming response for Session ID: {session_id_to_use}")
-            async with client.stream("POST", CHAT_API_URL, json=xjtlu_payload, headers=get_dynamic_headers()) as response:
-                response.raise_for_status()
-                async for line in response.aiter_lines():
-                    if line.startswith("data:"):
-                        chunk_str = line[len("data:"):].strip()
-                        if not chunk_str or chunk_str == "[DONE]": continue
-                        try:
-                            xjtlu_chunk = json.loads(chunk_str)
-                            data_content = xjtlu_chunk.get("data")
-                            if isinstance(data_content, str):
-                                full_content += data_content
-                        except json.JSONDecodeError: continue
-
-            # Construct the standard OpenAI non-streaming response object
-            response_json = {
-                "id": f"chatcmpl-{uuid.uuid4()}", "object": "chat.completion",
-                "created": int(time.time()), "model": openai_request.get("model"),
-                "choices": [{
-                    "index": 0, "message": {"role": "assistant", "content": full_content},
-                    "finish_reason": "stop"
-                }],
-                "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
-            }
-            logger.info(f"Non-streaming response assembled for Session ID: {session_id_to_use}.")
-            return JSONResponse(content=response_json)
+            full_content = "".join(await unless_disconnected(request, collect_deltas(deltas)))
+        except ClientDisconnected:
+            CLIENT_DISCONNECTS.inc(stage="non_streaming")
+            logger.info(f"🔌 Client disconnected, aborting {label}.")
+            raise
         finally:
-            if ENABLE_AUTO_DELETION:
-                logger.info(f"Scheduling session {session_id_to_use} for deletion.")
-                asyncio.create_task(delete_session(session_id_to_use))
+            await leased.release_unused()
+        logger.info(f"Non-streaming response assembled for {label}.")
+        return JSONResponse(content=openai_completion(full_content, model))
+
+# --- Batch jobs (/v1/files + /v1/batches) ---
+def parse_upload(content_type: str, body: bytes, params) -> tuple:
+    """取出上传的文件内容、文件名和 purpose。
+
+    支持 OpenAI SDK 使用的 multipart/form-data（用标准库 email 解析，不依赖 python-multipart），
+    也支持直接把 JSONL 作为请求体、filename 和 purpose 放在查询参数里。
+    """
+    if not content_type.startswith("multipart/form-data"):
+        return body, params.get("filename", "upload.jsonl"), params.get("purpose", "batch")
+    message = BytesParser(policy=email_policy.HTTP).parsebytes(
+        b"Content-Type: " + content_type.encode("latin-1") + b"\r\n\r\n" + body)
+    if not message.is_multipart():
+        raise HTTPException(status_code=400, detail="Malformed multipart body.")
+    content, filename, purpose = None, "upload.jsonl", params.get("purpose", "batch")
+    for part in message.iter_parts():
+        name = part.get_param("name", header="content-disposition")
+        if name == "file":
+            content = part.get_payload(decode=True) or b""
+            filename = part.get_filename() or filename
+        elif name == "purpose":
+            purpose = (part.get_payload(decode=True) or b"").decode("utf-8").strip()
+    if content is None:
+        raise HTTPException(status_code=400, detail="Missing 'file' field.")
+    return content, filename, purpose
+
+def validate_batch_input(lines: list, endpoint: str) -> list:
+    """逐行检查批量输入，返回 OpenAI 格式的错误列表（为空表示通过）"""
+    errors = []
+    seen = set()
+
+    def error(code: str, message: str, line: int):
+        errors.append({"code": code, "message": message, "param": None, "line": line})
+
+    if not lines:
+        error("empty_file", "The input file has no requests.", None)
+    if len(lines) > BATCH_MAX_REQUESTS:
+        error("too_many_requests", f"At most {BATCH_MAX_REQUESTS} requests per batch.", None)
+    for number, raw in enumerate(lines, start=1):
+        if len(errors) >= 100:
+            break
+        try:
+            line = json.loads(raw)
+        except ValueError:
+            error("invalid_json_line", "Line is not valid JSON.", number)
+            continue
+        if not isinstance(line, dict):
+            error("invalid_request", "Each line must be a JSON object.", number)
+            continue
+        custom_id = line.get("custom_id")
+        if not isinstance(custom_id, str) or not custom_id:
+            error("missing_custom_id", "Each request needs a string 'custom_id'.", number)
+        elif custom_id in seen:
+            error("duplicate_custom_id", f"Duplicate custom_id '{custom_id}'.", number)
+        else:
+            seen.add(custom_id)
+        if line.get("method", "POST") != "POST" or line.get("url") != endpoint:
+            error("invalid_url", f"Only POST {endpoint} is supported.", number)
+        body = line.get("body")
+        if not isinstance(body, dict) or not body.get("messages"):
+            error("invalid_body", "'body' must be a chat completion request with 'messages'.", number)
+        elif invalid_messages(body["messages"]):
+            error("invalid_body", invalid_messages(body["messages"]), number)
+        elif body.get("stream"):
+            error("invalid_body", "Streaming is not supported in batches.", number)
+    return errors
+
+class BatchRunner:
+    """在后台处理批量任务，只在领导者进程中运行。
+
+    每个请求以 BATCH_PRIORITY 优先级经过准入控制、会话租用和重试层，和交互请求共用账号的限速调度器；
+    只有调度器没有积压、准入队列为空时才发出下一个请求，上游保持在安全的最高速率，交互请求不受影响。
+    """
+
+    def __init__(self, store: BatchStore):
+        self.store = store
+        self.task = None
+        self.wakeup = asyncio.Event()
+        self.in_flight = 0
+        self.current = None            # 正在处理的任务，状态和计数以这里为准，定期写回磁盘
+        self.queued = []               # 最近一次检查时尚未结束的任务
+        self.results = []              # 还没写盘的 (record, failed)
+        self.saved_at = 0.0
+        self.save_lock = asyncio.Lock()
+        self.processed = {"completed": 0, "failed": 0}
+
+    def wake(self):
+        self.wakeup.set()
+
+    async def run(self):
+        while True:
+            try:
+                self.wakeup.clear()
+                batches = await asyncio.to_thread(self.store.active_batches) if leader.is_leader else []
+                self.queued = [b["id"] for b in batches]
+                if not batches:
+                    try:
+                        await asyncio.wait_for(self.wakeup.wait(), timeout=BATCH_POLL_INTERVAL)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                await self.process(batches[0])
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                logger.error(f"Error in batch runner: {e}", exc_info=True)
+                await asyncio.sleep(BATCH_POLL_INTERVAL)
+
+    def has_capacity(self) -> bool:
+        """上游没有积压：批量请求未满、准入队列为空、每个可用账号的调度器都没有在排队的调用"""
+        accounts = account_pool.active()
+        return (self.in_flight < BATCH_MAX_IN_FLIGHT and not admission.waiting and bool(accounts)
+                and not any(a.scheduler.waiting for a in accounts))
+
+    def should_stop(self, batch: dict) -> bool:
+        return batch["status"] == "cancelling" or time.time() > batch["expires_at"] or not leader.is_leader
+
+    def cancel(self, batch_id: str):
+        """本进程收到的取消请求直接作用于内存中的任务，不用等下一次写盘"""
+        if self.current and self.current["id"] == batch_id and self.current["status"] in ("validating", "in_progress"):
+            self.current["status"], self.current["cancelling_at"] = "cancelling", int(time.time())
+
+    def load(self, batch: dict):
+        """读取输入文件和已有的结果（在线程中运行）"""
+        lines = [json.loads(raw) for raw in self.store.read_input(batch["input_file_id"])]
+        return lines, self.store.finished_ids(batch)
+
+    async def save(self, batch: dict):
+        """把攒下的结果和计数写回磁盘，并取回其他进程写入的取消状态"""
+        async with self.save_lock:
+            results, self.results = self.results, []
+            counts = dict(batch["request_counts"])
+
+            def merge(b):
+                b["request_counts"] = counts
+                if batch["status"] == "cancelling" and b["status"] in ("validating", "in_progress"):
+                    b["status"], b["cancelling_at"] = "cancelling", batch["cancelling_at"]
+
+            def write():
+                self.store.append_results(batch, results)
+                return self.store.update_batch(batch["id"], merge)
+            saved = await asyncio.to_thread(write)
+            self.saved_at = time.monotonic()
+            if saved["status"] == "cancelling" and batch["status"] != "cancelling":
+                batch["status"], batch["cancelling_at"] = "cancelling", saved["cancelling_at"]
+
+    async def save_if_due(self, batch: dict):
+        if len(self.results) >= BATCH_SAVE_LINES or time.monotonic() - self.saved_at >= BATCH_SAVE_INTERVAL:
+            await self.save(batch)
+
+    async def process(self, batch: dict):
+        batch_id = batch["id"]
+        try:
+            lines, finished = await asyncio.to_thread(self.load, batch)
+        except OSError as e:
+            # 输入文件已经不在了，任务不可能完成；不标记为 failed 的话它会一直挡住后面的任务
+            await self.fail(batch_id, "missing_input_file", f"Cannot read input file {batch['input_file_id']}: {e.strerror}")
+            return
+        done = finished["completed"] | finished["failed"]
+        # 计数以结果文件为准（上次可能在写完结果、更新计数之前退出）
+        batch["request_counts"].update(completed=len(finished["completed"]), failed=len(finished["failed"]))
+        if done:
+            logger.info(f"📦 Resuming batch {batch_id}: {len(done)}/{len(lines)} requests already done.")
+        else:
+            logger.info(f"📦 Starting batch {batch_id}: {len(lines)} requests.")
+        self.current = batch
+        self.results = []
+        tasks = set()
+        try:
+            await self.save(batch)
+            for line in lines:
+                if line["custom_id"] in done:
+                    continue
+                while not self.has_capacity() and not self.should_stop(batch):
+                    await asyncio.sleep(BATCH_CAPACITY_CHECK_INTERVAL)
+                    await self.save_if_due(batch)
+                if self.should_stop(batch):
+                    break
+                self.in_flight += 1
+                task = asyncio.create_task(self.run_line(batch, line))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+                await self.save_if_due(batch)
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        finally:
+            # 已经拿到的结果即使在退出时也写回磁盘
+            try:
+                await asyncio.shield(self.save(batch))
+            finally:
+                self.current = None
+        if leader.is_leader:
+            await self.finish(batch_id)
+
+    async def fail(self, batch_id: str, code: str, message: str):
+        def mark(batch):
+            batch["status"], batch["failed_at"] = "failed", int(time.time())
+            batch["errors"] = {"object": "list", "data": [{"code": code, "message": message, "param": None, "line": None}]}
+        await asyncio.to_thread(self.store.update_batch, batch_id, mark)
+        logger.error(f"📦 Batch {batch_id} failed: {message}")
+
+    async def finish(self, batch_id: str):
+        def close(batch):
+            now = int(time.time())
+            counts = batch["request_counts"]
+            if counts["completed"] + counts["failed"] >= counts["total"]:
+                batch["status"], batch["finalizing_at"], batch["completed_at"] = "completed", now, now
+            elif batch["status"] == "cancelling":
+                batch["status"], batch["cancelled_at"] = "cancelled", now
+            elif now > batch["expires_at"]:
+                batch["status"], batch["expired_at"] = "expired", now
+        batch = await asyncio.to_thread(self.store.update_batch, batch_id, close)
+        logger.info(f"📦 Batch {batch_id} {batch['status']}: {batch['request_counts']}")
+
+    async def run_line(self, batch: dict, line: dict):
+        """处理一行请求，结果先留在内存里按组写盘；被取消时不记结果，重启后会重新处理"""
+        try:
+            record = {"id": f"batch_req_{uuid.uuid4().hex[:24]}", "custom_id": line["custom_id"]}
+            try:
+                body = await self.complete(line["body"], batch["id"])
+                record["response"] = {"status_code": 200, "request_id": body["id"], "body": body}
+                record["error"] = None
+                failed = False
+            except Exception as e:
+                code = getattr(e, "kind", None) or (str(e.status_code) if isinstance(e, HTTPException) else type(e).__name__)
+                record["response"] = None
+                record["error"] = {"code": code, "message": str(e.detail) if isinstance(e, HTTPException) else str(e)}
+                failed = True
+                logger.warning(f"📦 Batch request {line['custom_id']} failed: {record['error']}")
+            outcome = "failed" if failed else "completed"
+            self.results.append((record, failed))
+            batch["request_counts"][outcome] += 1
+            self.processed[outcome] += 1
+            BATCH_REQUESTS.inc(outcome=outcome)
+        finally:
+            self.in_flight -= 1
+
+    async def complete(self, body: dict, batch_id: str) -> dict:
+        """走和 /v1/chat/completions 相同的上游路径（准入、租用会话、重试），返回非流式的响应"""
+        model = body.get("model")
+        session_config = build_session_config(body)
+        # 提示词在租用会话之前组装好，出错时没有需要归还的会话
+        full_prompt = process_and_format_prompt(body["messages"], False)
+        ticket = None
+        while ENABLE_ADMISSION_CONTROL and ticket is None:
+            try:
+                ticket = await admission.acquire(f"batch:{batch_id}", BATCH_PRIORITY)
+            except HTTPException as e:
+                # 排队已满或超时不算请求失败，按 Retry-After 等待后重新排队
+                if e.status_code not in (429, 503):
+                    raise
+                await asyncio.sleep(float((e.headers or {}).get("Retry-After", 1)))
+        try:
+            account, session_id, _ = await lease_generation(session_config)
+        except BaseException:
+            if ticket:
+                ticket.release()
+            raise
+        REQUESTS_TOTAL.inc(model=model, source="batch")
+        deltas = resilient_deltas(account, session_id, session_config, full_prompt, can_switch=True)
+        if ticket:
+            deltas = admission.hold(ticket, deltas)
+        try:
+            return openai_completion("".join(await collect_deltas(deltas)), model)
+        finally:
+            await deltas.aclose()
+
+    def status(self) -> dict:
+        return {
+            "enabled": ENABLE_BATCHES,
+            "running": leader.is_leader and self.task is not None,
+            "current_batch": self.current and self.current["id"],
+            "in_flight": self.in_flight,
+            "max_in_flight": BATCH_MAX_IN_FLIGHT,
+            "unsaved_results": len(self.results),
+            "processed": dict(self.processed),
+            "active_batches": list(self.queued),
+        }
+
+batch_store = BatchStore(BATCH_DIR)
+batch_runner = BatchRunner(batch_store)
+
+def require_batches():
+    if not ENABLE_BATCHES:
+        raise HTTPException(status_code=404, detail="Batch API is disabled (ENABLE_BATCHES).")
+
+@app.post("/v1/files")
+async def upload_file(request: Request):
+    """上传批量输入文件（JSONL）"""
+    require_batches()
+    body = await request.body()
+    if len(body) > BATCH_MAX_FILE_BYTES:
+        raise HTTPException(status_code=413, detail=f"File larger than {BATCH_MAX_FILE_BYTES} bytes.")
+    content, filename, purpose = parse_upload(request.headers.get("content-type", ""), body, request.query_params)
+    if purpose != "batch":
+        raise HTTPException(status_code=400, detail="Only purpose 'batch' is supported.")
+    info = await asyncio.to_thread(batch_store.create_file, content, filename, purpose)
+    logger.info(f"📁 Uploaded {info['id']} ({filename}, {len(content)} bytes).")
+    return info
+
+@app.get("/v1/files")
+async def list_files():
+    require_batches()
+    return {"object": "list", "data": await asyncio.to_thread(batch_store.files)}
+
+@app.get("/v1/files/{file_id}")
+async def get_file(file_id: str):
+    require_batches()
+    info = await asyncio.to_thread(batch_store.file, file_id)
+    if not info:
+        raise HTTPException(status_code=404, detail=f"No such file: {file_id}")
+    return info
+
+@app.get("/v1/files/{file_id}/content")
+async def get_file_content(file_id: str):
+    """下载文件内容；结果文件在任务进行中也可以下载已完成的部分"""
+    info = await get_file(file_id)
+    return FileResponse(batch_store.file_path(file_id), media_type="application/jsonl", filename=info["filename"])
+
+@app.delete("/v1/files/{file_id}")
+async def delete_file(file_id: str):
+    require_batches()
+    if file_id in await asyncio.to_thread(batch_store.files_in_use):
+        raise HTTPException(status_code=409, detail=f"File {file_id} is used by a batch that has not finished.")
+    if not await asyncio.to_thread(batch_store.delete_file, file_id):
+        raise HTTPException(status_code=404, detail=f"No such file: {file_id}")
+    return {"id": file_id, "object": "file", "deleted": True}
+
+@app.post("/v1/batches")
+async def create_batch(request: Request):
+    """校验输入文件并创建批量任务，由后台的 BatchRunner 处理"""
+    require_batches()
+    payload = await request.json()
+    input_file_id = payload.get("input_file_id")
+    endpoint = payload.get("endpoint", "/v1/chat/completions")
+    window = payload.get("completion_window", "24h")
+    if endpoint != "/v1/chat/completions":
+        raise HTTPException(status_code=400, detail="Only the /v1/chat/completions endpoint is supported.")
+    if window not in BATCH_COMPLETION_WINDOWS:
+        raise HTTPException(status_code=400, detail=f"completion_window must be one of {list(BATCH_COMPLETION_WINDOWS)}.")
+    if not input_file_id or not await asyncio.to_thread(batch_store.file, input_file_id):
+        raise HTTPException(status_code=404, detail=f"No such file: {input_file_id}")
+
+    def create():
+        # 读取和校验最大 BATCH_MAX_FILE_BYTES 的输入文件，不在事件循环里做
+        lines = batch_store.read_input(input_file_id)
+        errors = validate_batch_input(lines, endpoint)
+        return lines, errors, batch_store.create_batch(input_file_id, endpoint, window, BATCH_COMPLETION_WINDOWS[window],
+                                                       payload.get("metadata"), len(lines), errors)
+    lines, errors, batch = await asyncio.to_thread(create)
+    if errors:
+        logger.warning(f"📦 Batch {batch['id']} rejected: {len(errors)} invalid lines.")
+    else:
+        logger.info(f"📦 Batch {batch['id']} created with {len(lines)} requests.")
+        batch_runner.wake()
+    return batch
+
+@app.get("/v1/batches")
+async def list_batches(limit: int = 20):
+    require_batches()
+    return {"object": "list", "data": (await asyncio.to_thread(batch_store.batches))[:limit]}
+
+@app.get("/v1/batches/{batch_id}")
+async def get_batch(batch_id: str):
+    """任务状态和进度（request_counts）"""
+    require_batches()
+    if batch_runner.current and batch_runner.current["id"] == batch_id:
+        return batch_runner.current    # 正在处理的任务以内存中的进度为准
+    batch = await asyncio.to_thread(batch_store.batch, batch_id)
+    if not batch:
+        raise HTTPException(status_code=404, detail=f"No such batch: {batch_id}")
+    return batch
+
+@app.post("/v1/batches/{batch_id}/cancel")
+async def cancel_batch(batch_id: str):
+    """取消任务：不再发出新请求，正在处理的请求完成后任务变为 cancelled"""
+    await get_batch(batch_id)
+
+    def cancel(batch):
+        if batch["status"] in ("validating", "in_progress"):
+            batch["status"], batch["cancelling_at"] = "cancelling", int(time.time())
+    await asyncio.to_thread(batch_store.update_batch, batch_id, cancel)
+    batch_runner.cancel(batch_id)
+    batch_runner.wake()
+    return await get_batch(batch_id)
+
+@app.get("/batches/status")
+async def batches_status():
+    """查询批量任务处理器状态"""
+    return batch_runner.status()
 
 # 添加心跳状态查询端点
 @app.get("/heartbeat/status")
 async def heartbeat_status():
     """查询心跳状态"""
-    global heartbeat_session_id, last_user_activity
-    
     return {
         "enabled": ENABLE_HEARTBEAT,
         "interval": HEARTBEAT_INTERVAL,
-        "session_id": heartbeat_session_id,
+        "session_ids": {a.name: a.heartbeat_session_id for a in account_pool.accounts.values()},
+        "next_beat_in": {a.name: max(0, int(heartbeat_due(a) - time.time())) for a in account_pool.active()},
         "last_activity": datetime.fromtimestamp(last_user_activity).strftime('%Y-%m-%d %H:%M:%S'),
         "time_since_activity": int(time.time() - last_user_activity)
     }
+
+@app.get("/startup/status")
+async def startup_status():
+    """查询冷启动各阶段耗时和启动探测的结果"""
+    return startup_timer.status()
+
+@app.get("/credentials/status")
+async def credentials_status():
+    """查询凭据缓存和令牌自动刷新状态"""
+    return {**credential_store.status(), "token_refresh": token_refresher.status()}
+
+@app.post("/credentials/refresh")
+async def credentials_refresh():
+    """立即在后台运行 auth.py 刷新令牌（忽略失败后的重试间隔）"""
+    if not token_refresher.task:
+        raise HTTPException(status_code=409, detail="Token refresh is disabled (ENABLE_TOKEN_REFRESH).")
+    token_refresher.retry_after = 0.0
+    token_refresher.wake()
+    # 多进程模式下只有领导者进程会真正执行刷新
+    return {"scheduled": leader.is_leader and not token_refresher.running, **token_refresher.status()}
+
+@app.post("/credentials/reload")
+async def credentials_reload():
+    """强制从 .env 重新加载凭据（例如手动运行 auth.py 之后）"""
+    await credential_store.refresh(force=True)
+    return credential_store.status()
+
+@app.get("/capture/status")
+async def capture_status():
+    """查询流量录制状态"""
+    return traffic_capture.status() if traffic_capture else {"enabled": False}
+
+@app.get("/cache/status")
+async def cache_status():
+    """查询响应缓存的命中情况"""
+    return response_cache.status()
+
+@app.get("/coalescing/status")
+async def coalescing_status():
+    """查询请求合并状态"""
+    return single_flight.status()
+
+@app.get("/affinity/status")
+async def affinity_status():
+    """查询对话保持模式保留的会话和命中情况"""
+    return conversation_affinity.status()
+
+@app.get("/retry/status")
+async def retry_status():
+    """查询重试预算、各原因未重试的次数和对冲情况"""
+    return retry_policy.status()
+
+@app.get("/admission/status")
+async def admission_status():
+    """查询准入控制：进行中的生成数、各优先级排队数和拒绝次数"""
+    return admission.status()
+
+@app.get("/scheduler/status")
+async def scheduler_status():
+    """查询各账号上游限速调度器的当前速率和排队深度"""
+    return {a.name: a.scheduler.status() for a in account_pool.accounts.values()}
+
+@app.get("/pool/status")
+async def pool_status():
+    """查询各账号会话池状态和命中率"""
+    return {a.name: a.pool.status() for a in account_pool.accounts.values()}
+
+@app.get("/accounts/status")
+async def accounts_status():
+    """查询各账号的负载、健康状态和错误统计"""
+    return account_pool.status()
+
+@app.get("/transport/status")
+async def transport_status():
+    """查询上游连接的复用情况、协商到的 HTTP 版本和预热次数"""
+    return upstream.status()
+
+@app.get("/workers/status")
+async def workers_status():
+    """查询多进程模式下本进程的角色和当前的领导者"""
+    return leader.status()
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    """Prometheus 文本格式的分阶段延迟、错误和负载指标"""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+class InFlightMiddleware:
+    """统计正在处理（含流式输出中）的对话请求数，直到响应体完全发送或连接结束"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] != "/v1/chat/completions":
+            return await self.app(scope, receive, send)
+        REQUESTS_IN_FLIGHT.inc()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            REQUESTS_IN_FLIGHT.dec()
+
+app.add_middleware(InFlightMiddleware)
+
+# 模块导入到此结束，之后是 uvicorn 启动服务器到调用 startup 事件
+startup_timer.mark("module_import")
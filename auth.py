@@ -1,6 +1,9 @@
 # auth.py - Automated session token retrieval for XJTLU GenAI (Headless Version)
+import argparse
+import threading
 import time
 import os
+from contextlib import contextmanager
 from seleniumwire import webdriver
 from selenium.common.exceptions import TimeoutException
 from selenium.webdriver.common.by import By
@@ -13,12 +16,67 @@ captured_credentials = {
     "jm_token": None,
     "sdp_session": None
 }
+# Set by the interceptor as soon as both headers have been seen.
+tokens_ready = threading.Event()
 
-def fetch_tokens():
+# Only traffic to these hosts goes through selenium-wire's recorder; everything else is left alone.
+CAPTURE_SCOPES = [r".*xjtlu\.edu\.cn.*"]
+# Resources the login flow does not need; requests for them are aborted in the interceptor.
+BLOCKED_EXTENSIONS = (
+    ".png", ".jpg", ".jpeg", ".gif", ".webp", ".svg", ".ico", ".bmp",
+    ".woff", ".woff2", ".ttf", ".otf", ".eot", ".mp4", ".webm", ".mp3",
+)
+# Maximum time to wait for the tokens after the chat interface is up.
+TOKEN_CAPTURE_TIMEOUT = 8
+
+
+class StageTimer:
+    """Records how long each stage of the login flow takes and prints a summary."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages = []
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.stages.append((name, elapsed))
+            print(f"⏱️  {name}: {elapsed:.2f}s")
+
+    def summary(self):
+        total = time.perf_counter() - self.started
+        print("\n⏱️  Stage timings:")
+        for name, elapsed in self.stages:
+            print(f"  - {name:<24} {elapsed:6.2f}s")
+        print(f"  - {'total':<24} {total:6.2f}s")
+
+
+def wait_or_tokens(driver, condition, timeout):
+    """Wait for a page condition, returning early once the tokens have been captured.
+
+    Returns the element found by `condition`, or None if the tokens arrived first.
+    """
+    def check(d):
+        if tokens_ready.is_set():
+            return True
+        return condition(d)
+    result = WebDriverWait(driver, timeout, poll_frequency=0.2).until(check)
+    return None if result is True and tokens_ready.is_set() else result
+
+
+def fetch_tokens(profile_dir=None):
     """
     Launches a headless browser, performs SSO login, and intercepts network requests
-    using Chrome DevTools Protocol (CDP) to capture dynamic session tokens.
-  
+    to capture dynamic session tokens.
+
+    Capture is event-driven: the flow stops as soon as both headers have been seen.
+    Images, fonts and media are blocked. With `profile_dir` the browser profile
+    (and its SSO cookies) is kept between runs, so the password form is usually skipped.
+
     This function relies on credentials stored in the .env file.
     """
     # Load credentials from .env file
@@ -31,15 +89,18 @@ def fetch_tokens():
         print("Please run 'python configure.py' first to set up your credentials.")
         return None
 
+    timer = StageTimer()
     print("🚀 Initializing headless browser session...")
     print("📝 Running in headless mode - no browser window will appear")
     print(f"👤 Using username: {username[:3]}***{username[-3:] if len(username) > 6 else '***'}")
 
     # Configure selenium-wire to intercept network traffic
     selenium_wire_options = {
-        'disable_encoding': True  # To view raw headers
+        'disable_encoding': True,  # To view raw headers
+        'request_storage': 'memory',
+        'request_storage_max_size': 100,
     }
-  
+
     chrome_options = webdriver.ChromeOptions()
     # Enable headless mode
     chrome_options.add_argument("--headless")
@@ -47,23 +108,38 @@ def fetch_tokens():
     chrome_options.add_argument("--window-size=1920,1080")
     chrome_options.add_argument("--no-sandbox")
     chrome_options.add_argument("--disable-dev-shm-usage")
+    chrome_options.add_argument("--disable-extensions")
+    chrome_options.add_argument("--blink-settings=imagesEnabled=false")
     chrome_options.add_experimental_option('excludeSwitches', ['enable-logging'])
     chrome_options.add_experimental_option('useAutomationExtension', False)
+    chrome_options.add_experimental_option('prefs', {"profile.managed_default_content_settings.images": 2})
+    # Don't wait for every subresource before driver.get() returns; the waits below cover readiness.
+    chrome_options.page_load_strategy = 'eager'
 
     chrome_options.add_argument("--proxy-server=direct://")  # 明确指定直连模式
     chrome_options.add_argument("--disable-proxy-discovery")  # 禁用自动代理检测
 
+    if profile_dir:
+        chrome_options.add_argument(f"--user-data-dir={os.path.abspath(profile_dir)}")
+        print(f"🗂️  Reusing browser profile: {profile_dir}")
+
     driver = None
     try:
         print("🔧 Starting Chrome driver in headless mode...")
-        driver = webdriver.Chrome(
-            seleniumwire_options=selenium_wire_options,
-            options=chrome_options
-        )
+        with timer.stage("browser start"):
+            driver = webdriver.Chrome(
+                seleniumwire_options=selenium_wire_options,
+                options=chrome_options
+            )
+        driver.scopes = CAPTURE_SCOPES
         print("✅ Chrome driver initialized successfully")
 
         # Define a request interceptor to capture headers
         def interceptor(request):
+            if request.path.lower().endswith(BLOCKED_EXTENSIONS):
+                request.abort()
+                return
+
             jm_token_val = request.headers.get('Jm-Token')
             sdp_session_val = request.headers.get('Sdp-App-Session')
 
@@ -75,84 +151,58 @@ def fetch_tokens():
                 captured_credentials["sdp_session"] = sdp_session_val
                 print("🔑 [TOKEN] Successfully intercepted 'Sdp-App-Session'")
 
+            if captured_credentials["jm_token"] and captured_credentials["sdp_session"]:
+                tokens_ready.set()
+
         driver.request_interceptor = interceptor
         print("🕸️  Network interceptor deployed and monitoring requests...")
 
         # --- Automation Flow ---
         print("\n📋 Starting SSO authentication process...")
         print("Step 1/3: 🌐 Navigating to XJTLU GenAI portal...")
-        driver.get("https://xipuai.xjtlu.edu.cn/")
-        print("✅ Successfully loaded login page")
-      
-        # Wait for and fill login form
-        print("⏳ Waiting for login form to appear...")
-        username_field = WebDriverWait(driver, 20).until(
-            EC.visibility_of_element_located((By.ID, "username_show"))
-        )
-        print("📝 Filling in username...")
-        username_field.send_keys(username)
-        
-        print("📝 Filling in password...")
-        driver.find_element(By.ID, "password_show").send_keys(password)
-        
-        print("🔘 Clicking login button...")
-        driver.execute_script("arguments[0].click();", driver.find_element(By.CSS_SELECTOR, "#btn_login input"))
-        print("✅ Login form submitted")
-
-        print("\nStep 2/3: 🔄 Processing post-login navigation...")
-        print("⏳ Waiting for post-login page to load...")
-        chat_link = WebDriverWait(driver, 20).until(
-            EC.element_to_be_clickable((By.CSS_SELECTOR, "a[href='/v3/chat']"))
-        )
-        print("🔗 Found chat link, clicking...")
-        chat_link.click()
-        print("✅ Successfully navigated to chat section")
-
-        print("⏳ Waiting for chat interface to initialize...")
-        chat_button = WebDriverWait(driver, 20).until(
-            EC.element_to_be_clickable((By.CSS_SELECTOR, "button:has(span.n-button__content)"))
-        )
-        print("🔘 Found chat button, clicking...")
-        chat_button.click()
-        print("✅ Chat interface activated")
+        with timer.stage("portal load"):
+            driver.get("https://xipuai.xjtlu.edu.cn/")
+            # With a persistent profile the SSO cookie may take us straight past the login form.
+            landing = wait_or_tokens(driver, EC.any_of(
+                EC.visibility_of_element_located((By.ID, "username_show")),
+                EC.element_to_be_clickable((By.CSS_SELECTOR, "a[href='/v3/chat']")),
+            ), 20)
+        print("✅ Successfully loaded portal")
+
+        if landing is not None and landing.get_attribute("id") == "username_show":
+            with timer.stage("login form"):
+                print("📝 Filling in username...")
+                landing.send_keys(username)
+
+                print("📝 Filling in password...")
+                driver.find_element(By.ID, "password_show").send_keys(password)
+
+                print("🔘 Clicking login button...")
+                driver.execute_script("arguments[0].click();", driver.find_element(By.CSS_SELECTOR, "#btn_login input"))
+                print("✅ Login form submitted")
+        elif landing is not None:
+            print("⚡ Already signed in via saved profile, skipping login form")
+
+        if not tokens_ready.is_set():
+            print("\nStep 2/3: 🔄 Processing post-login navigation...")
+            with timer.stage("post-login navigation"):
+                chat_link = wait_or_tokens(driver, EC.element_to_be_clickable((By.CSS_SELECTOR, "a[href='/v3/chat']")), 20)
+                if chat_link is not None:
+                    print("🔗 Found chat link, clicking...")
+                    chat_link.click()
+                    chat_button = wait_or_tokens(driver, EC.element_to_be_clickable((By.CSS_SELECTOR, "button:has(span.n-button__content)")), 20)
+                    if chat_button is not None:
+                        print("🔘 Found chat button, clicking...")
+                        chat_button.click()
+                        print("✅ Chat interface activated")
 
         print("\nStep 3/3: 🔍 Finalizing token capture...")
-        print("⏳ Waiting for textarea element to confirm page is ready...")
-        WebDriverWait(driver, 30).until(
-            EC.presence_of_element_located((By.CSS_SELECTOR, "textarea"))
-        )
-        print("✅ Chat interface fully loaded")
-        print("🔍 Monitoring network traffic for authentication tokens...")
-      
-        # Allow time for initial API calls to be made and intercepted
-        token_capture_duration = 8
-        print(f"⏰ Waiting up to {token_capture_duration} seconds for token capture...")
-        
-        end_time = time.time() + token_capture_duration
-        progress_counter = 0
-        while time.time() < end_time:
-            if captured_credentials["jm_token"] and captured_credentials["sdp_session"]:
-                print("🎉 All required tokens captured successfully!")
-                break
-            
-            # Show progress every 2 seconds
-            if progress_counter % 4 == 0:
-                remaining = int(end_time - time.time())
-                tokens_status = []
-                if captured_credentials["jm_token"]:
-                    tokens_status.append("Jm-Token ✅")
-                else:
-                    tokens_status.append("Jm-Token ⏳")
-                    
-                if captured_credentials["sdp_session"]:
-                    tokens_status.append("Sdp-Session ✅")
-                else:
-                    tokens_status.append("Sdp-Session ⏳")
-                    
-                print(f"📊 Status: {' | '.join(tokens_status)} | Time remaining: {remaining}s")
-            
-            progress_counter += 1
-            time.sleep(0.5)
+        with timer.stage("token capture"):
+            if not tokens_ready.is_set():
+                print(f"⏰ Waiting up to {TOKEN_CAPTURE_TIMEOUT} seconds for token capture...")
+                tokens_ready.wait(TOKEN_CAPTURE_TIMEOUT)
+        if tokens_ready.is_set():
+            print("🎉 All required tokens captured successfully!")
 
         # --- Verification ---
         print("\n🔍 Verifying token capture results...")
@@ -169,7 +219,7 @@ def fetch_tokens():
             if not captured_credentials["sdp_session"]:
                 missing_tokens.append("'Sdp-App-Session'")
             print(f"📝 Missing tokens: {', '.join(missing_tokens)}")
-            
+
             print("📸 Saving screenshot for debugging...")
             driver.save_screenshot("auth_error.png")
             print("💾 Screenshot saved to 'auth_error.png'")
@@ -194,16 +244,24 @@ def fetch_tokens():
     finally:
         if driver:
             print("🔚 Closing headless browser session...")
-            driver.quit()
+            with timer.stage("browser shutdown"):
+                driver.quit()
             print("✅ Browser session closed successfully")
+        timer.summary()
 
 if __name__ == "__main__":
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Fetch Jm-Token / Sdp-App-Session for the adapter.")
+    parser.add_argument("--profile", default=os.getenv("AUTH_PROFILE_DIR"),
+                        help="persistent Chrome profile directory, keeps SSO cookies between runs (default: $AUTH_PROFILE_DIR)")
+    args = parser.parse_args()
+
     print("=" * 50)
     print("🤖 XJTLU GenAI Token Fetcher (Headless Mode)")
     print("=" * 50)
-  
-    retrieved_tokens = fetch_tokens()
-  
+
+    retrieved_tokens = fetch_tokens(profile_dir=args.profile)
+
     if retrieved_tokens:
         env_file = ".env"
         try:
@@ -218,5 +276,5 @@ if __name__ == "__main__":
         print("\n❌ FAILURE: Token retrieval unsuccessful")
         print("📋 Please check the logs above for detailed error information")
         print("💡 Tip: Check the generated screenshot files for visual debugging")
-        
+
     print("=" * 50)
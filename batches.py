@@ -0,0 +1,172 @@
+# batches.py - 批量任务（OpenAI 风格的 /v1/files 和 /v1/batches）的本地持久化：上传的文件、任务状态和结果文件
+import json
+import os
+import time
+import uuid
+
+# 还没有结束、重启后需要继续处理的任务状态
+ACTIVE_STATUSES = ("validating", "in_progress", "finalizing", "cancelling")
+
+
+class BatchStore:
+    """所有数据都是 root 目录下的普通文件，进程重启后直接从磁盘恢复。
+
+    files/<file_id>.jsonl 是文件内容，files/<file_id>.json 是文件信息；
+    batches/<batch_id>.json 是任务状态，每次更新都整体重写（先写临时文件再替换）。
+    结果文件在处理过程中按组追加，已写入结果的 custom_id 就是已完成的请求。
+    这里的方法都是阻塞的文件操作，adapter 通过 asyncio.to_thread 调用。
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        self.files_dir = os.path.join(root, "files")
+        self.batches_dir = os.path.join(root, "batches")
+        os.makedirs(self.files_dir, exist_ok=True)
+        os.makedirs(self.batches_dir, exist_ok=True)
+        self._finished = set()    # 已经结束的任务不会再变，列出未结束任务时跳过
+
+    @staticmethod
+    def _write_json(path: str, data: dict):
+        tmp = f"{path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp, path)
+
+    @staticmethod
+    def _read_json(path: str):
+        try:
+            with open(path, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    # --- 文件 ---
+    def file_path(self, file_id: str) -> str:
+        return os.path.join(self.files_dir, f"{os.path.basename(file_id)}.jsonl")
+
+    def create_file(self, content: bytes, filename: str, purpose: str) -> dict:
+        file_id = f"file-{uuid.uuid4().hex[:24]}"
+        with open(self.file_path(file_id), "wb") as f:
+            f.write(content)
+        return self._save_file_info(file_id, filename, purpose, len(content))
+
+    def _save_file_info(self, file_id: str, filename: str, purpose: str, size: int) -> dict:
+        info = {"id": file_id, "object": "file", "bytes": size, "created_at": int(time.time()),
+                "filename": filename, "purpose": purpose}
+        self._write_json(os.path.join(self.files_dir, f"{file_id}.json"), info)
+        return info
+
+    def file(self, file_id: str):
+        """文件信息；结果文件的大小随处理进度增长，按当前大小返回"""
+        info = self._read_json(os.path.join(self.files_dir, f"{os.path.basename(file_id)}.json"))
+        if info and os.path.exists(self.file_path(file_id)):
+            info["bytes"] = os.path.getsize(self.file_path(file_id))
+        return info
+
+    def files(self) -> list:
+        infos = [self.file(name[:-5]) for name in os.listdir(self.files_dir) if name.endswith(".json")]
+        return sorted((i for i in infos if i), key=lambda i: i["created_at"], reverse=True)
+
+    def delete_file(self, file_id: str) -> bool:
+        info_path = os.path.join(self.files_dir, f"{os.path.basename(file_id)}.json")
+        if not os.path.exists(info_path):
+            return False
+        os.remove(info_path)
+        if os.path.exists(self.file_path(file_id)):
+            os.remove(self.file_path(file_id))
+        return True
+
+    # --- 任务 ---
+    def _batch_path(self, batch_id: str) -> str:
+        return os.path.join(self.batches_dir, f"{os.path.basename(batch_id)}.json")
+
+    def create_batch(self, input_file_id: str, endpoint: str, completion_window: str, window_seconds: float,
+                     metadata: dict, total: int, errors: list = None) -> dict:
+        """新建任务；输入文件校验失败时 errors 非空，任务直接进入 failed 状态"""
+        batch_id = f"batch_{uuid.uuid4().hex[:24]}"
+        now = int(time.time())
+        output_file_id = f"file-{uuid.uuid4().hex[:24]}"
+        error_file_id = f"file-{uuid.uuid4().hex[:24]}"
+        for file_id, suffix in ((output_file_id, "output"), (error_file_id, "errors")):
+            open(self.file_path(file_id), "wb").close()
+            self._save_file_info(file_id, f"{batch_id}_{suffix}.jsonl", "batch_output", 0)
+        batch = {
+            "id": batch_id, "object": "batch", "endpoint": endpoint,
+            "errors": {"object": "list", "data": errors} if errors else None,
+            "input_file_id": input_file_id, "completion_window": completion_window,
+            "status": "failed" if errors else "in_progress",
+            "output_file_id": output_file_id, "error_file_id": error_file_id,
+            "created_at": now, "in_progress_at": None if errors else now,
+            "expires_at": int(now + window_seconds), "finalizing_at": None,
+            "completed_at": None, "failed_at": now if errors else None, "expired_at": None,
+            "cancelling_at": None, "cancelled_at": None,
+            "request_counts": {"total": total, "completed": 0, "failed": 0},
+            "metadata": metadata or None,
+        }
+        self._write_json(self._batch_path(batch_id), batch)
+        return batch
+
+    def batch(self, batch_id: str):
+        return self._read_json(self._batch_path(batch_id))
+
+    def batches(self) -> list:
+        batches = [self._read_json(os.path.join(self.batches_dir, name))
+                   for name in os.listdir(self.batches_dir) if name.endswith(".json")]
+        return sorted((b for b in batches if b), key=lambda b: b["created_at"], reverse=True)
+
+    def update_batch(self, batch_id: str, func) -> dict:
+        """从磁盘读出最新状态、交给 func 修改后写回（其他进程可能刚把它改成了 cancelling）"""
+        batch = self.batch(batch_id)
+        func(batch)
+        self._write_json(self._batch_path(batch_id), batch)
+        return batch
+
+    def active_batches(self) -> list:
+        """尚未结束的任务，先创建的先处理"""
+        active = []
+        for name in os.listdir(self.batches_dir):
+            if not name.endswith(".json") or name[:-5] in self._finished:
+                continue
+            batch = self._read_json(os.path.join(self.batches_dir, name))
+            if not batch:
+                continue
+            if batch["status"] in ACTIVE_STATUSES:
+                active.append(batch)
+            else:
+                self._finished.add(batch["id"])
+        return sorted(active, key=lambda b: b["created_at"])
+
+    def files_in_use(self) -> set:
+        """尚未结束的任务引用的文件（输入文件和结果文件），删除会让任务无法继续"""
+        return {b[key] for b in self.active_batches() for key in ("input_file_id", "output_file_id", "error_file_id")}
+
+    def read_input(self, file_id: str) -> list:
+        with open(self.file_path(file_id), encoding="utf-8", newline="") as f:
+            # 只按 \n 分行：splitlines() 还会在 JSON 字符串里合法出现的 U+2028 / U+2029 / \x85 处断开
+            return [line.rstrip("\r") for line in f.read().split("\n") if line.strip()]
+
+    def append_results(self, batch: dict, results: list):
+        """追加一组 (record, failed) 结果，每个文件只落盘一次，重启后据此跳过已完成的请求"""
+        for failed, file_id in ((False, batch["output_file_id"]), (True, batch["error_file_id"])):
+            records = [record for record, is_failed in results if is_failed == failed]
+            if not records:
+                continue
+            with open(self.file_path(file_id), "a", encoding="utf-8") as f:
+                f.write("".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records))
+                f.flush()
+                os.fsync(f.fileno())
+
+    def finished_ids(self, batch: dict) -> dict:
+        """已经写入结果的 custom_id，按 completed / failed 分开"""
+        done = {"completed": set(), "failed": set()}
+        for outcome, file_id in (("completed", batch["output_file_id"]), ("failed", batch["error_file_id"])):
+            try:
+                with open(self.file_path(file_id), encoding="utf-8") as f:
+                    for line in f:
+                        try:
+                            done[outcome].add(json.loads(line)["custom_id"])
+                        except (ValueError, KeyError):
+                            continue
+            except OSError:
+                continue
+        return done
@@ -0,0 +1,106 @@
+# bench_load.py - 对运行中的 adapter.py 做并发压测，报告吞吐量以及 TTFT / 端到端延迟的 p50、p99
+#
+# 用法（先启动 mock_upstream.py，并让 adapter 指向它）:
+#   python bench_load.py --requests 200 --concurrency 16 --stream
+import argparse
+import asyncio
+import json
+import time
+
+import httpx
+
+
+def percentile(values: list, p: float) -> float:
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(p / 100 * len(ordered) + 0.5) - 1))
+    return ordered[index]
+
+
+async def one_request(client: httpx.AsyncClient, args, index: int) -> dict:
+    body = {
+        "model": args.model, "stream": args.stream, "temperature": args.temperature,
+        "messages": [{"role": "user", "content": f"[{index}] " + "x" * args.prompt_chars}],
+    }
+    started = time.perf_counter()
+    ttft = None
+    chars = 0
+    try:
+        async with client.stream("POST", f"{args.url}/v1/chat/completions", json=body) as response:
+            if response.status_code != 200:
+                await response.aread()
+                return {"ok": False, "error": str(response.status_code)}
+            if args.stream:
+                async for line in response.aiter_lines():
+                    if not line.startswith("data: ") or line == "data: [DONE]":
+                        continue
+                    content = json.loads(line[6:])["choices"][0]["delta"].get("content")
+                    if content:
+                        ttft = ttft or time.perf_counter() - started
+                        chars += len(content)
+            else:
+                data = json.loads(await response.aread())
+                ttft = time.perf_counter() - started
+                chars = len(data["choices"][0]["message"]["content"])
+    except httpx.HTTPError as e:
+        return {"ok": False, "error": type(e).__name__}
+    return {"ok": True, "ttft": ttft, "total": time.perf_counter() - started, "chars": chars}
+
+
+async def run(args) -> dict:
+    results = []
+    next_index = iter(range(args.requests))
+
+    async def worker(client):
+        for index in next_index:
+            results.append(await one_request(client, args, index))
+
+    async with httpx.AsyncClient(timeout=args.timeout) as client:
+        started = time.perf_counter()
+        await asyncio.gather(*[worker(client) for _ in range(args.concurrency)])
+        elapsed = time.perf_counter() - started
+
+    ok = [r for r in results if r["ok"]]
+    errors = {}
+    for r in results:
+        if not r["ok"]:
+            errors[r["error"]] = errors.get(r["error"], 0) + 1
+    ttfts = [r["ttft"] for r in ok if r["ttft"] is not None]
+    totals = [r["total"] for r in ok]
+    return {
+        "requests": len(results), "succeeded": len(ok), "errors": errors,
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(len(ok) / elapsed, 3),
+        "chars_per_s": round(sum(r["chars"] for r in ok) / elapsed, 1),
+        "ttft_p50_s": round(percentile(ttfts, 50), 3), "ttft_p99_s": round(percentile(ttfts, 99), 3),
+        "latency_p50_s": round(percentile(totals, 50), 3), "latency_p99_s": round(percentile(totals, 99), 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load-test driver for the adapter.")
+    parser.add_argument("--url", default="http://127.0.0.1:8000", help="adapter base URL")
+    parser.add_argument("--requests", type=int, default=100, help="total requests to send")
+    parser.add_argument("--concurrency", type=int, default=8, help="requests in flight at once")
+    parser.add_argument("--model", default="gpt-4.1")
+    parser.add_argument("--temperature", type=float, default=0.7)
+    parser.add_argument("--prompt-chars", type=int, default=200, help="size of each prompt")
+    parser.add_argument("--stream", action="store_true", help="use streaming responses")
+    parser.add_argument("--timeout", type=float, default=300.0)
+    parser.add_argument("--json", action="store_true", help="print the report as one JSON line")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False))
+        return
+    print(f"📊 {report['requests']} requests at concurrency {args.concurrency} ({'stream' if args.stream else 'non-stream'})")
+    print(f"   succeeded {report['succeeded']}, errors {report['errors'] or 'none'}, {report['elapsed_s']}s")
+    print(f"   throughput {report['throughput_rps']} req/s, {report['chars_per_s']} chars/s")
+    print(f"   TTFT     p50 {report['ttft_p50_s']}s  p99 {report['ttft_p99_s']}s")
+    print(f"   latency  p50 {report['latency_p50_s']}s  p99 {report['latency_p99_s']}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+# bench_relay.py - SSE 转发路径的微基准：对比逐行解码的旧路径和基于原始字节的 relay.py
+import argparse
+import json
+import random
+import time
+import uuid
+
+from relay import UpstreamSSEParser, OpenAIChunkWriter
+
+SAMPLE_TOKENS = ["Hello", " world", "，", "你好", " the", " quick", " brown", " fox", "\n", "```python", " \"quoted\"", " 代码", "!"]
+
+
+def build_upstream_body(tokens: int) -> bytes:
+    """构造与上游格式相同的 SSE 响应体"""
+    rng = random.Random(42)
+    events = [f"data:{json.dumps({'data': rng.choice(SAMPLE_TOKENS)}, ensure_ascii=False)}\n\n" for _ in range(tokens)]
+    events.append("data:[DONE]\n\n")
+    return "".join(events).encode("utf-8")
+
+
+def split_network_chunks(body: bytes, size: int) -> list:
+    """按固定大小切块，模拟网络读取时与行边界不对齐的情况"""
+    return [body[i:i + size] for i in range(0, len(body), size)]
+
+
+def legacy_relay(raw_chunks: list, model: str) -> int:
+    """旧路径：解码成文本逐行处理，每个片段新建 uuid/时间戳并整体序列化"""
+    out = 0
+    pending = ""
+    for raw in raw_chunks:
+        pending += raw.decode("utf-8", errors="ignore")
+        *lines, pending = pending.split("\n")
+        for line in lines:
+            if line.startswith("data:"):
+                chunk_str = line[len("data:"):].strip()
+                if not chunk_str or chunk_str == "[DONE]": continue
+                try:
+                    xjtlu_chunk = json.loads(chunk_str)
+                    data_content = xjtlu_chunk.get("data")
+                    if not isinstance(data_content, str): continue
+                    openai_chunk = {"id": f"chatcmpl-{uuid.uuid4()}", "object": "chat.completion.chunk", "created": int(time.time()), "model": model, "choices": [{"index": 0, "delta": {"content": data_content}, "finish_reason": None}]}
+                    out += len(f"data: {json.dumps(openai_chunk)}\n\n")
+                except json.JSONDecodeError: continue
+    return out
+
+
+def relay_path(raw_chunks: list, model: str) -> int:
+    """新路径：原始字节解析 + 预序列化模板"""
+    out = 0
+    parser = UpstreamSSEParser()
+    writer = OpenAIChunkWriter(model)
+    for raw in raw_chunks:
+        for data_content in parser.feed(raw):
+            out += len(writer.content(data_content))
+    for data_content in parser.close():
+        out += len(writer.content(data_content))
+    return out
+
+
+def measure(name: str, func, raw_chunks: list, tokens: int, repeat: int):
+    best_wall = best_cpu = float("inf")
+    for _ in range(repeat):
+        wall, cpu = time.perf_counter(), time.process_time()
+        func(raw_chunks, "gpt-4.1")
+        best_wall = min(best_wall, time.perf_counter() - wall)
+        best_cpu = min(best_cpu, time.process_time() - cpu)
+    print(f"{name:<8} {tokens / best_wall:>14,.0f} chunks/s {best_cpu / tokens * 1e6:>10.2f} µs CPU/token")
+    return best_cpu
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-benchmark for the streaming relay path.")
+    parser.add_argument("--tokens", type=int, default=200_000, help="upstream chunks per run")
+    parser.add_argument("--read-size", type=int, default=4096, help="bytes per simulated network read")
+    parser.add_argument("--repeat", type=int, default=5, help="runs per path, best is reported")
+    args = parser.parse_args()
+
+    raw_chunks = split_network_chunks(build_upstream_body(args.tokens), args.read_size)
+    print(f"📊 {args.tokens:,} upstream chunks, {args.read_size}-byte reads, best of {args.repeat}")
+    legacy_cpu = measure("legacy", legacy_relay, raw_chunks, args.tokens, args.repeat)
+    relay_cpu = measure("relay", relay_path, raw_chunks, args.tokens, args.repeat)
+    print(f"⚡ CPU per token reduced by {(1 - relay_cpu / legacy_cpu) * 100:.1f}%")
+
+
+if __name__ == "__main__":
+    main()
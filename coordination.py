@@ -0,0 +1,189 @@
+# coordination.py - 多个 uvicorn 工作进程之间共享的协调状态（基于 SQLite，无需额外服务）
+import asyncio
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+# 写连接等待其他进程释放写锁的上限（在写线程里等，不影响事件循环）；
+# 读连接在 WAL 模式下不会被写者阻塞，只给一个很短的超时
+WRITE_TIMEOUT = 5.0
+READ_TIMEOUT = 0.05
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS schedulers (
+    scope TEXT PRIMARY KEY,
+    next_slot REAL NOT NULL,
+    interval REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS counters (
+    scope TEXT NOT NULL,
+    name TEXT NOT NULL,
+    value REAL NOT NULL,
+    PRIMARY KEY (scope, name)
+);
+CREATE TABLE IF NOT EXISTS leases (
+    name TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    expires_at REAL NOT NULL
+);
+"""
+
+
+class SharedState:
+    """同一台机器上的所有工作进程通过一个 WAL 模式的 SQLite 文件共享状态。
+
+    写操作要拿跨进程的写锁，其他进程持有时可能要等到 WRITE_TIMEOUT 秒，
+    所以只在专用的写线程里执行：需要结果的用 call() 等待，不需要结果的用 post() 交出去就返回。
+    事件循环里只直接调用读操作（get / scheduler_state / leader），它们用独立的读连接。
+    """
+
+    def __init__(self, path: str, owner: str = None):
+        self.path = path
+        self.owner = owner or f"{os.getpid()}@{time.time():.0f}"
+        self.lock = threading.Lock()
+        self.read_lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.db = sqlite3.connect(path, timeout=WRITE_TIMEOUT, isolation_level=None, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+        self.reader = sqlite3.connect(path, timeout=READ_TIMEOUT, isolation_level=None, check_same_thread=False)
+        self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="shared-state")
+
+    async def call(self, method, *args):
+        """在写线程中执行写操作并等待结果"""
+        return await asyncio.wrap_future(self.writer.submit(method, *args))
+
+    def post(self, method, *args) -> Future:
+        """把不需要结果的写操作交给写线程，立即返回"""
+        return self.writer.submit(method, *args)
+
+    def _transaction(self, func):
+        """在 BEGIN IMMEDIATE 事务中执行 func(cursor)，写锁在进程之间互斥"""
+        with self.lock:
+            cursor = self.db.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            try:
+                result = func(cursor)
+            except BaseException:
+                cursor.execute("ROLLBACK")
+                raise
+            cursor.execute("COMMIT")
+            return result
+
+    # --- 限速调度器 ---
+    def reserve_slot(self, scope: str, default_interval: float, now: float):
+        """预约下一个调用时间槽，返回 (slot, interval)"""
+        def reserve(cursor):
+            row = cursor.execute("SELECT next_slot, interval FROM schedulers WHERE scope = ?", (scope,)).fetchone()
+            next_slot, interval = row if row else (0.0, default_interval)
+            slot = max(now, next_slot)
+            cursor.execute(
+                "INSERT INTO schedulers (scope, next_slot, interval) VALUES (?, ?, ?) "
+                "ON CONFLICT(scope) DO UPDATE SET next_slot = excluded.next_slot",
+                (scope, slot + interval, interval))
+            return slot, interval
+        return self._transaction(reserve)
+
+    def scheduler_state(self, scope: str, default_interval: float):
+        """当前的 (next_slot, interval)"""
+        with self.read_lock:
+            row = self.reader.execute("SELECT next_slot, interval FROM schedulers WHERE scope = ?", (scope,)).fetchone()
+        return row if row else (0.0, default_interval)
+
+    def backoff(self, scope: str, default_interval: float, factor: float, maximum: float, now: float) -> float:
+        """被限速：间隔乘以 factor（不超过 maximum），已预约的槽位之后再空出一个新间隔"""
+        def widen(cursor):
+            next_slot, interval = self._scheduler_row(cursor, scope, default_interval)
+            interval = min(maximum, interval * factor)
+            cursor.execute("UPDATE schedulers SET interval = ?, next_slot = ? WHERE scope = ?",
+                           (interval, max(next_slot, now) + interval, scope))
+            return interval
+        return self._transaction(widen)
+
+    def recover(self, scope: str, default_interval: float, step: float, minimum: float) -> float:
+        """连续成功：间隔缩短一步（不低于 minimum）"""
+        def narrow(cursor):
+            _, interval = self._scheduler_row(cursor, scope, default_interval)
+            interval = max(minimum, interval - step)
+            cursor.execute("UPDATE schedulers SET interval = ? WHERE scope = ?", (interval, scope))
+            return interval
+        return self._transaction(narrow)
+
+    @staticmethod
+    def _scheduler_row(cursor, scope: str, default_interval: float):
+        row = cursor.execute("SELECT next_slot, interval FROM schedulers WHERE scope = ?", (scope,)).fetchone()
+        if row:
+            return row
+        cursor.execute("INSERT INTO schedulers (scope, next_slot, interval) VALUES (?, 0, ?)", (scope, default_interval))
+        return 0.0, default_interval
+
+    # --- 计数器（会话配额等）和时间戳 ---
+    def add(self, scope: str, name: str, delta: float, floor: float = None) -> float:
+        """原子地加上 delta，返回新值；指定 floor 时结果不低于它"""
+        def update(cursor):
+            row = cursor.execute("SELECT value FROM counters WHERE scope = ? AND name = ?", (scope, name)).fetchone()
+            value = (row[0] if row else 0.0) + delta
+            if floor is not None:
+                value = max(floor, value)
+            cursor.execute(
+                "INSERT INTO counters (scope, name, value) VALUES (?, ?, ?) "
+                "ON CONFLICT(scope, name) DO UPDATE SET value = excluded.value", (scope, name, value))
+            return value
+        return self._transaction(update)
+
+    def reserve(self, scope: str, name: str, limit: float) -> bool:
+        """计数低于 limit 时加一并返回 True，否则不变并返回 False；检查和加一在同一个事务里"""
+        def take(cursor):
+            row = cursor.execute("SELECT value FROM counters WHERE scope = ? AND name = ?", (scope, name)).fetchone()
+            value = row[0] if row else 0.0
+            if value >= limit:
+                return False
+            cursor.execute(
+                "INSERT INTO counters (scope, name, value) VALUES (?, ?, ?) "
+                "ON CONFLICT(scope, name) DO UPDATE SET value = excluded.value", (scope, name, value + 1))
+            return True
+        return self._transaction(take)
+
+    def set_max(self, scope: str, name: str, value: float):
+        """只在 value 更大时写入（用于“最近一次”之类的时间戳）"""
+        with self.lock:
+            self.db.execute(
+                "INSERT INTO counters (scope, name, value) VALUES (?, ?, ?) "
+                "ON CONFLICT(scope, name) DO UPDATE SET value = max(value, excluded.value)", (scope, name, value))
+
+    def get(self, scope: str, name: str, default: float = 0.0) -> float:
+        with self.read_lock:
+            row = self.reader.execute("SELECT value FROM counters WHERE scope = ? AND name = ?", (scope, name)).fetchone()
+        return row[0] if row else default
+
+    # --- 领导者选举 ---
+    def try_lead(self, name: str, ttl: float) -> bool:
+        """获取或续租名为 name 的租约；租约过期后其他进程才能接手"""
+        now = time.time()
+        with self.lock:
+            self.db.execute(
+                "INSERT INTO leases (name, owner, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at "
+                "WHERE leases.owner = excluded.owner OR leases.expires_at < ?",
+                (name, self.owner, now + ttl, now))
+            row = self.db.execute("SELECT owner FROM leases WHERE name = ?", (name,)).fetchone()
+        return bool(row) and row[0] == self.owner
+
+    def release(self, name: str):
+        with self.lock:
+            self.db.execute("DELETE FROM leases WHERE name = ? AND owner = ?", (name, self.owner))
+
+    def leader(self, name: str):
+        with self.read_lock:
+            row = self.reader.execute("SELECT owner, expires_at FROM leases WHERE name = ?", (name,)).fetchone()
+        return row[0] if row and row[1] >= time.time() else None
+
+    def close(self):
+        self.writer.shutdown(wait=True)
+        with self.lock:
+            self.db.close()
+        with self.read_lock:
+            self.reader.close()
@@ -0,0 +1,176 @@
+# mock_upstream.py - 本地模拟的 jmapi 上游，用于压测 adapter.py 而不访问真实的 XJTLU 服务
+#
+# 用法:
+#   python mock_upstream.py --port 9100 --chunks 40 --chunk-delay 0.02
+#   XIPUAI_BASE_URL=http://127.0.0.1:9100/api/chat python adapter.py
+import argparse
+import asyncio
+import itertools
+import json
+import random
+import time
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+from expire import decode_jwt
+
+app = FastAPI(title="Mock jmapi upstream")
+
+# 运行参数，由命令行覆盖（见 main）
+settings = argparse.Namespace(
+    quota=50,                # 每个令牌最多持有的会话数
+    min_interval=0.0,        # 同一令牌两次调用的最小间隔（秒），更快时返回 "Request too fast"
+    ttft=0.3,                # completions 首个片段前的延迟（秒）
+    chunks=20,               # 每次回答的片段数
+    chunk_size=4,            # 每个片段的字符数
+    chunk_delay=0.02,        # 片段之间的延迟（秒）
+    drop_rate=0.0,           # 流式输出中途断开的概率
+    error_rate=0.0,          # completions 直接返回 "Request Err!" 的概率
+    slow_rate=0.0,           # completions 首个片段特别慢的概率（模拟长尾）
+    slow_ttft=5.0,           # 慢请求首个片段前的延迟（秒）
+    token_ttl=0.0,           # 令牌首次使用多少秒后失效（0 表示不失效）
+    expired_tokens=(),       # 总是视为已失效的令牌
+)
+
+session_ids = itertools.count(100000)
+sessions = {}       # token -> {str(session_id): 配置}，客户端传字符串或数字都能匹配
+last_call = {}      # token -> 上一次调用的时间
+first_seen = {}     # token -> 首次使用的时间
+stats = {"saveSession": 0, "completions": 0, "delSession": 0, "rate_limited": 0,
+         "quota_exceeded": 0, "token_expired": 0, "dropped": 0,
+         "errors": 0, "slow": 0}
+
+FILLER = "The quick brown fox jumps over the lazy dog. 敏捷的棕色狐狸跳过了懒狗。"
+
+
+def token_expired(token: str) -> bool:
+    if not token or token in settings.expired_tokens:
+        return True
+    first_seen.setdefault(token, time.time())
+    if settings.token_ttl and time.time() - first_seen[token] > settings.token_ttl:
+        return True
+    info = decode_jwt(token)
+    return isinstance(info, dict) and info["time_info"].get("expired", False)
+
+
+def check_request(request: Request, kind: str):
+    """按真实上游的顺序检查令牌和调用频率，返回错误响应或 None"""
+    stats[kind] += 1
+    token = request.headers.get("jm-token", "")
+    if token_expired(token):
+        stats["token_expired"] += 1
+        return JSONResponse({"code": 401, "msg": "token expired, please login again"}, status_code=403)
+    now = time.time()
+    previous = last_call.get(token, 0.0)
+    last_call[token] = now
+    if now - previous < settings.min_interval:
+        stats["rate_limited"] += 1
+        return JSONResponse({"code": 429, "msg": "Request too fast"}, status_code=429)
+    return None
+
+
+@app.post("/api/chat/saveSession")
+async def save_session(request: Request):
+    error = check_request(request, "saveSession")
+    if error:
+        return error
+    body = await request.json()
+    owned = sessions.setdefault(request.headers["jm-token"], {})
+    session_id = body.get("id")
+    if session_id is not None:
+        if str(session_id) not in owned:
+            return {"code": 500, "msg": "Session not found"}
+    elif len(owned) >= settings.quota:
+        stats["quota_exceeded"] += 1
+        return {"code": 500, "msg": f"You have created {settings.quota} sessions, please delete some of them first!"}
+    else:
+        session_id = next(session_ids)
+    owned[str(session_id)] = {k: v for k, v in body.items() if k != "id"}
+    return {"code": 0, "msg": "success", "data": {"id": session_id}}
+
+
+@app.post("/api/chat/delSession")
+async def del_session(request: Request):
+    error = check_request(request, "delSession")
+    if error:
+        return error
+    body = await request.json()
+    owned = sessions.setdefault(request.headers["jm-token"], {})
+    for session_id in body.get("ids", []):
+        owned.pop(str(session_id), None)
+    return {"code": 0, "msg": "success"}
+
+
+@app.post("/api/chat/completions")
+async def completions(request: Request):
+    error = check_request(request, "completions")
+    if error:
+        return error
+    body = await request.json()
+    if str(body.get("sessionId")) not in sessions.get(request.headers["jm-token"], {}):
+        return JSONResponse({"code": 500, "msg": "Session not found"})
+    if random.random() < settings.error_rate:
+        stats["errors"] += 1
+        return JSONResponse({"code": 500, "msg": "Request Err!"})
+    drop_at = random.randrange(settings.chunks) if random.random() < settings.drop_rate else None
+    ttft = settings.ttft
+    if random.random() < settings.slow_rate:
+        stats["slow"] += 1
+        ttft = settings.slow_ttft
+
+    async def generate():
+        await asyncio.sleep(ttft)
+        for i in range(settings.chunks):
+            if i == drop_at:
+                stats["dropped"] += 1
+                raise ConnectionResetError("mock upstream dropped the stream")
+            start = (i * settings.chunk_size) % len(FILLER)
+            text = (FILLER * 2)[start:start + settings.chunk_size]
+            yield f"data:{json.dumps({'data': text}, ensure_ascii=False)}\n\n"
+            if settings.chunk_delay:
+                await asyncio.sleep(settings.chunk_delay)
+        yield "data:[DONE]\n\n"
+
+    return StreamingResponse(generate(), media_type="text/event-stream")
+
+
+@app.get("/mock/stats")
+async def mock_stats():
+    """各接口调用次数、模拟出的错误次数和每个令牌当前持有的会话数"""
+    return {**stats, "live_sessions": {token[-8:]: len(owned) for token, owned in sessions.items()}}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the jmapi upstream.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--quota", type=int, default=settings.quota, help="sessions each token may hold")
+    parser.add_argument("--min-interval", type=float, default=settings.min_interval,
+                        help="answer 'Request too fast' when one token calls faster than this (seconds)")
+    parser.add_argument("--ttft", type=float, default=settings.ttft, help="delay before the first chunk (seconds)")
+    parser.add_argument("--chunks", type=int, default=settings.chunks, help="chunks per answer")
+    parser.add_argument("--chunk-size", type=int, default=settings.chunk_size, help="characters per chunk")
+    parser.add_argument("--chunk-delay", type=float, default=settings.chunk_delay, help="delay between chunks (seconds)")
+    parser.add_argument("--drop-rate", type=float, default=settings.drop_rate,
+                        help="probability that a stream is cut off midway")
+    parser.add_argument("--error-rate", type=float, default=settings.error_rate,
+                        help="probability that completions answers 'Request Err!'")
+    parser.add_argument("--slow-rate", type=float, default=settings.slow_rate,
+                        help="probability that a completion waits --slow-ttft before its first chunk")
+    parser.add_argument("--slow-ttft", type=float, default=settings.slow_ttft, help="first-chunk delay of slow completions (seconds)")
+    parser.add_argument("--token-ttl", type=float, default=settings.token_ttl,
+                        help="reject a token with 403 this many seconds after first use (0 = never)")
+    parser.add_argument("--expired-token", action="append", default=[], help="token that is always rejected")
+    args = parser.parse_args()
+    for name, value in vars(args).items():
+        if hasattr(settings, name):
+            setattr(settings, name, value)
+    settings.expired_tokens = tuple(args.expired_token)
+    print(f"🧪 Mock upstream on http://{args.host}:{args.port}/api/chat")
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,35 @@
 # precheck.py - 环境状态检查和分支决策脚本
 import os
 import sys
-import subprocess
-from dotenv import load_dotenv, find_dotenv
+import time
+from dotenv import load_dotenv, find_dotenv, set_key
+from expire import decode_jwt
+
+# 令牌剩余有效期超过该值（秒）时只做本地检查，不发网络请求；
+# 不足该值时直接重新认证，避免服务刚启动令牌就过期
+TOKEN_MIN_VALIDITY = 600
+
+class PhaseTimer:
+    """记录预检查各阶段的耗时（毫秒）"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = []
+
+    def run(self, name, func, *args):
+        start = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            self.phases.append((name, (time.perf_counter() - start) * 1000))
+
+    def summary(self):
+        print("\n⏱️  各阶段耗时:")
+        for name, elapsed in self.phases:
+            print(f"  • {name}: {elapsed:.1f} ms")
+        print(f"  • 总计: {(time.perf_counter() - self.started) * 1000:.1f} ms")
+
+timer = PhaseTimer()
 
 def print_banner():
     """打印检查横幅"""
@@ -58,29 +85,52 @@ def check_env_status():
     print("\n🔀 检测结果: Branch 3 - 需要检查令牌有效性")
     return 3
 
+def record_expire(expired):
+    """把检查结果写回 EXPIRE（与 tokentest.py 相同），值没变时不写文件"""
+    value = "True" if expired else "False"
+    env_file = find_dotenv()
+    if env_file and os.getenv("EXPIRE") != value:
+        set_key(env_file, "EXPIRE", value)
+        os.environ["EXPIRE"] = value
+
+def check_token_locally():
+    """本地解码 JM_TOKEN 的 exp（与 expire.py 相同）。返回 0 有效、3 需要重新认证、None 无法判断"""
+    print("\n🔍 本地检查令牌有效期...")
+    info = decode_jwt(os.getenv("JM_TOKEN", ""))
+    exp = info["payload"].get("exp") if isinstance(info, dict) else None
+    if exp is None:
+        print("⚠️  无法从令牌中解析出过期时间")
+        return None
+
+    remaining = exp - time.time()
+    if remaining > TOKEN_MIN_VALIDITY:
+        print(f"✅ 令牌还有 {int(remaining // 3600)}小时{int(remaining % 3600 // 60)}分钟过期 - 跳过网络探测")
+        record_expire(False)
+        return 0
+    if remaining > 0:
+        print(f"⚠️  令牌将在 {int(remaining // 60)} 分钟内过期 - 提前重新认证")
+    else:
+        print("⚠️  令牌已过期")
+    record_expire(True)
+    return 3
+
 def check_token_validity():
-    """检查令牌有效性"""
+    """通过心跳会话做一次网络探测（在本进程内调用 tokentest.py 的检测函数）"""
     print("\n🔍 检查令牌有效性...")
     print("-" * 50)
     
     try:
-        # 运行tokentest.py
-        result = subprocess.run([sys.executable, "tokentest.py"], 
-                              capture_output=True, text=True, check=False)
-        
-        # tokentest.py总是返回0，所以我们需要检查EXPIRE环境变量
-        load_dotenv(override=True)
-        expire_status = os.getenv("EXPIRE", "").lower()
-        
-        if expire_status == "false":
+        from tokentest import test_heartbeat_with_existing_session
+        if test_heartbeat_with_existing_session():
             print("✅ 令牌检查完成 - 令牌有效")
             return 0  # 直接启动服务
         else:
             print("⚠️  令牌检查完成 - 令牌已过期")
             return 3  # 需要重新认证
             
-    except Exception as e:
-        print(f"❌ 令牌检查过程出现错误: {e}")
+    except (Exception, SystemExit) as e:
+        # tokentest.py 缺少凭据时会调用 sys.exit(1)，在本进程内调用时不能让它直接结束预检查
+        print(f"❌ 令牌检查过程出现错误: {e!r}")
         print("将假定令牌无效，需要重新认证")
         return 3
 
@@ -90,11 +140,20 @@ def main():
     
     try:
         # 检查环境状态
-        branch_code = check_env_status()
+        branch_code = timer.run("环境配置检查", check_env_status)
         
-        # 如果是Branch 3，需要进一步检查令牌
+        # 如果是Branch 3，先本地检查令牌的过期时间。无法判断时不在这里阻塞启动：
+        # 适配器启动后会在后台经心跳会话探测（startup_probe），只有传入 --probe 时才在这里做网络探测
         if branch_code == 3:
-            branch_code = check_token_validity()
+            local_result = timer.run("本地令牌检查", check_token_locally)
+            if local_result is not None:
+                branch_code = local_result
+            elif "--probe" in sys.argv[1:]:
+                branch_code = timer.run("网络探测", check_token_validity)
+            else:
+                print("➡️  交给适配器启动后在后台探测令牌")
+                branch_code = 0
+        timer.summary()
         
         # 打印最终决策
         print("\n" + "=" * 60)
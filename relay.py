@@ -0,0 +1,146 @@
+# relay.py - 上游 SSE 数据流到 OpenAI 格式的低开销转发
+import asyncio
+import json
+import time
+import uuid
+
+_CONTENT_MARKER = f"__content_{uuid.uuid4().hex}__"
+
+
+class UpstreamSSEParser:
+    """直接在原始字节上解析上游的 `data:` 行，取出每个片段里的 "data" 文本。
+
+    网络分块不一定按行对齐，未结束的半行留在缓冲区里等下一块。
+    """
+
+    def __init__(self):
+        self.buffer = b""
+
+    def feed(self, raw: bytes) -> list:
+        """喂入一块原始字节，返回其中完整行解析出的文本片段"""
+        self.buffer += raw
+        if b"\n" not in self.buffer:
+            return []
+        lines = self.buffer.split(b"\n")
+        self.buffer = lines.pop()
+        return self._parse(lines)
+
+    def close(self) -> list:
+        """上游结束时处理缓冲区中最后一行（没有换行结尾的情况）"""
+        lines, self.buffer = [self.buffer], b""
+        return self._parse(lines)
+
+    @staticmethod
+    def _parse(lines: list) -> list:
+        deltas = []
+        for line in lines:
+            if not line.startswith(b"data:"):
+                continue
+            payload = line[5:].strip()
+            if not payload or payload == b"[DONE]":
+                continue
+            try:
+                chunk = json.loads(payload)
+            except ValueError:
+                continue
+            data_content = chunk.get("data") if isinstance(chunk, dict) else None
+            if isinstance(data_content, str):
+                deltas.append(data_content)
+        return deltas
+
+
+class OpenAIChunkWriter:
+    """一次响应共用一个 completion ID 和预先序列化的 chunk 模板，每个片段只需转义正文"""
+
+    def __init__(self, model: str):
+        self.completion_id = f"chatcmpl-{uuid.uuid4()}"
+        self.created = int(time.time())
+        self.model = model
+        template = json.dumps(self._chunk({"content": _CONTENT_MARKER}, None))
+        head, tail = template.split(json.dumps(_CONTENT_MARKER))
+        self.head = b"data: " + head.encode("utf-8")
+        self.tail = tail.encode("utf-8") + b"\n\n"
+
+    def _chunk(self, delta: dict, finish_reason):
+        return {
+            "id": self.completion_id, "object": "chat.completion.chunk", "created": self.created,
+            "model": self.model, "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+        }
+
+    def content(self, data_content: str) -> bytes:
+        return self.head + json.dumps(data_content).encode("utf-8") + self.tail
+
+    def finish(self) -> bytes:
+        """结束 chunk 加上 [DONE] 标记"""
+        return f"data: {json.dumps(self._chunk({}, 'stop'))}\n\ndata: [DONE]\n\n".encode("utf-8")
+
+
+async def coalesce_deltas(deltas, window: float, max_bytes: int, on_flush=None):
+    """把短时间内到达的文本片段合并成一个再发出，减少 SSE 事件数。
+
+    第一个片段立即发出；之后缓冲区里最早的片段等满 window 秒，或者累计超过 max_bytes 字节时发出，
+    流结束（包括出错）时把剩下的内容也发出。on_flush(片段数, 最早片段的等待秒数) 用于统计。
+    """
+    iterator = deltas.__aiter__()
+    pending = None
+    buffer, size, held_since = [], 0, 0.0
+    first = True
+
+    def flush():
+        nonlocal buffer, size
+        if on_flush:
+            on_flush(len(buffer), time.perf_counter() - held_since)
+        merged, buffer, size = "".join(buffer), [], 0
+        return merged
+
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(iterator.__anext__())
+            if buffer:
+                remaining = held_since + window - time.perf_counter()
+                if remaining > 0:
+                    await asyncio.wait((pending,), timeout=remaining)
+                if not pending.done():
+                    yield flush()
+                    continue
+            try:
+                data_content = await pending
+            except StopAsyncIteration:
+                pending = None
+                break
+            except Exception:
+                pending = None
+                if buffer:
+                    yield flush()
+                raise
+            pending = None
+            if first:
+                first = False
+                if on_flush:
+                    on_flush(1, 0.0)
+                yield data_content
+                continue
+            if not buffer:
+                held_since = time.perf_counter()
+            buffer.append(data_content)
+            size += len(data_content.encode("utf-8"))
+            if size >= max_bytes:
+                yield flush()
+        if buffer:
+            yield flush()
+    finally:
+        # 还在等待的下一个片段要先取消，外层才能正常关闭上游的生成器
+        if pending is not None and not pending.done():
+            pending.cancel()
+            try:
+                await pending
+            except (asyncio.CancelledError, Exception):
+                pass
+
+
+def raw_byte_stream(response):
+    """优先用 aiter_raw 跳过解码；上游启用了压缩时只能用 aiter_bytes"""
+    if response.headers.get("content-encoding", "identity") == "identity":
+        return response.aiter_raw()
+    return response.aiter_bytes()
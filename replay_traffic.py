@@ -0,0 +1,140 @@
+# replay_traffic.py - 按录制时的到达节奏（可缩放）回放 adapter 录制的流量，对比回放与录制时的 TTFT / 端到端延迟
+#
+# 用法（adapter 中设置 ENABLE_TRAFFIC_CAPTURE = True 录制；回放时先启动 mock_upstream.py，并让 adapter 指向它）:
+#   python replay_traffic.py logs/requests.jsonl --url http://127.0.0.1:8000 --speed 2
+import argparse
+import asyncio
+import json
+import random
+import time
+
+import httpx
+
+from bench_load import percentile
+
+FILLER_WORDS = ["the", "quick", "brown", "fox", "jumps", "over", "lazy", "dog", "你好", "世界", "代码", "\n"]
+
+
+def load_records(paths: list) -> list:
+    """读取一个或多个录制文件（多进程模式下每个进程一个），按到达时间排序"""
+    records = []
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    records.append(json.loads(line))
+    records.sort(key=lambda r: r["t"])
+    return records
+
+
+def filler_text(chars: int, seed: str) -> str:
+    """用哈希做种子生成等长的占位文本：录制时相同的消息回放时也相同，缓存和请求合并的效果得以保留"""
+    rng = random.Random(seed)
+    parts, size = [], 0
+    while size < chars:
+        word = rng.choice(FILLER_WORDS) + " "
+        parts.append(word)
+        size += len(word)
+    return "".join(parts)[:chars]
+
+
+def build_request(record: dict, args) -> dict:
+    messages = []
+    for m in record["messages"]:
+        if "content" in m:
+            messages.append(m)
+        else:
+            messages.append({"role": m["role"], "content": filler_text(m["chars"], m.get("sha256") or str(m["chars"]))})
+    return {**record.get("params", {}), "model": args.model or record["model"], "stream": record["stream"], "messages": messages}
+
+
+async def replay_one(client: httpx.AsyncClient, args, record: dict) -> dict:
+    body = build_request(record, args)
+    started = time.perf_counter()
+    ttft = None
+    try:
+        async with client.stream("POST", f"{args.url}/v1/chat/completions", json=body) as response:
+            if response.status_code != 200:
+                await response.aread()
+                return {"ok": False, "error": str(response.status_code)}
+            if body["stream"]:
+                async for line in response.aiter_lines():
+                    if not line.startswith("data: ") or line == "data: [DONE]":
+                        continue
+                    if json.loads(line[6:])["choices"][0]["delta"].get("content"):
+                        ttft = ttft or time.perf_counter() - started
+            else:
+                await response.aread()
+                ttft = time.perf_counter() - started
+    except httpx.HTTPError as e:
+        return {"ok": False, "error": type(e).__name__}
+    return {"ok": True, "ttft": ttft, "total": time.perf_counter() - started}
+
+
+async def run(args) -> dict:
+    records = load_records(args.files)[:args.limit or None]
+    if not records:
+        raise SystemExit("No records to replay.")
+    origin = records[0]["t"]
+    results = []
+
+    async def scheduled(client, record):
+        delay = (record["t"] - origin) / args.speed - (time.perf_counter() - started)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        results.append(await replay_one(client, args, record))
+
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+    async with httpx.AsyncClient(timeout=args.timeout, limits=limits) as client:
+        started = time.perf_counter()
+        await asyncio.gather(*[scheduled(client, r) for r in records])
+        elapsed = time.perf_counter() - started
+
+    ok = [r for r in results if r["ok"]]
+    errors = {}
+    for r in results:
+        if not r["ok"]:
+            errors[r["error"]] = errors.get(r["error"], 0) + 1
+    ttfts = [r["ttft"] for r in ok if r["ttft"] is not None]
+    totals = [r["total"] for r in ok]
+    captured_ok = [r for r in records if r["status"] == 200]
+    captured_ttfts = [r["chunk_ms"][0] / 1000 for r in captured_ok if r["chunk_ms"]]
+    captured_totals = [r["ms"] / 1000 for r in captured_ok]
+    return {
+        "requests": len(results), "succeeded": len(ok), "errors": errors,
+        "captured_span_s": round(records[-1]["t"] - origin, 3), "elapsed_s": round(elapsed, 3),
+        "ttft_p50_s": round(percentile(ttfts, 50), 3), "ttft_p99_s": round(percentile(ttfts, 99), 3),
+        "latency_p50_s": round(percentile(totals, 50), 3), "latency_p99_s": round(percentile(totals, 99), 3),
+        "captured_ttft_p50_s": round(percentile(captured_ttfts, 50), 3),
+        "captured_ttft_p99_s": round(percentile(captured_ttfts, 99), 3),
+        "captured_latency_p50_s": round(percentile(captured_totals, 50), 3),
+        "captured_latency_p99_s": round(percentile(captured_totals, 99), 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay captured adapter traffic at its original (or scaled) arrival rate.")
+    parser.add_argument("files", nargs="*", default=["logs/requests.jsonl"], help="capture files written by the adapter")
+    parser.add_argument("--url", default="http://127.0.0.1:8000", help="adapter base URL")
+    parser.add_argument("--speed", type=float, default=1.0, help="arrival rate multiplier (2 = twice as fast)")
+    parser.add_argument("--limit", type=int, default=0, help="replay only the first N records")
+    parser.add_argument("--model", help="send every request with this model instead of the captured one")
+    parser.add_argument("--timeout", type=float, default=300.0)
+    parser.add_argument("--json", action="store_true", help="print the report as one JSON line")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False))
+        return
+    print(f"🔁 Replayed {report['requests']} requests captured over {report['captured_span_s']}s at {args.speed}x")
+    print(f"   succeeded {report['succeeded']}, errors {report['errors'] or 'none'}, {report['elapsed_s']}s")
+    print(f"   TTFT     p50 {report['ttft_p50_s']}s  p99 {report['ttft_p99_s']}s"
+          f"   (captured p50 {report['captured_ttft_p50_s']}s  p99 {report['captured_ttft_p99_s']}s)")
+    print(f"   latency  p50 {report['latency_p50_s']}s  p99 {report['latency_p99_s']}s"
+          f"   (captured p50 {report['captured_latency_p50_s']}s  p99 {report['captured_latency_p99_s']}s)")
+
+
+if __name__ == "__main__":
+    main()
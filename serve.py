@@ -0,0 +1,32 @@
+# serve.py - 多进程启动器：在同一个端口上启动多个 adapter 工作进程，共享协调状态
+import argparse
+import os
+
+import uvicorn
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the adapter with several worker processes behind one port.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="worker processes (default: CPU count)")
+    parser.add_argument("--state-file", default=os.path.join("logs", "adapter_state.db"),
+                        help="SQLite file the workers use to share rate limits, session quota and leadership")
+    args = parser.parse_args()
+
+    os.environ["XIPUAI_WORKERS"] = str(args.workers)
+    os.environ["XIPUAI_STATE_FILE"] = args.state_file
+    if args.workers > 1:
+        # 上一次运行留下的计数不再可信，从干净的状态开始
+        for suffix in ("", "-wal", "-shm"):
+            try:
+                os.remove(args.state_file + suffix)
+            except FileNotFoundError:
+                pass
+
+    print(f"🚀 Starting {args.workers} adapter worker(s) on http://{args.host}:{args.port}")
+    uvicorn.run("adapter:app", host=args.host, port=args.port, workers=args.workers)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+# conftest.py - 测试夹具：在同一个事件循环里运行 mock_upstream.py 和 adapter.py，凭据和文件都放在临时目录
+#
+# adapter.py 在导入时读取 .env 和 XIPUAI_BASE_URL，所以先启动 mock 上游、准备好临时 .env 再导入它。
+# 测试代码在主线程里，通过 run() 把协程交给后台线程中的事件循环执行，
+# 这样可以直接调用 adapter 的内部对象，而不会和服务器跨事件循环。
+import asyncio
+import base64
+import json
+import os
+import sys
+import threading
+
+import pytest
+import uvicorn
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# 永不过期的测试令牌（exp = 2100-01-01）
+JM_TOKEN = "a." + base64.urlsafe_b64encode(json.dumps({"exp": 4102444800}).encode()).decode().rstrip("=") + ".c"
+
+
+class Harness:
+    """后台事件循环，以及在其中运行的 mock 上游和 adapter 服务器"""
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self.servers = []
+
+    def run(self, coro, timeout: float = 30):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result(timeout)
+
+    def serve(self, app) -> int:
+        """在后台事件循环里启动一个 uvicorn 服务器，返回它监听的端口"""
+        server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=0, log_level="warning"))
+
+        async def start():
+            task = asyncio.ensure_future(server.serve())
+            while not server.started:
+                await asyncio.sleep(0.01)
+            return task, server.servers[0].sockets[0].getsockname()[1]
+        task, port = self.run(start())
+        self.servers.append((server, task))
+        return port
+
+    def close(self):
+        async def stop():
+            # 后启动的先停（adapter 关闭时还要调用 mock 上游删除会话）
+            for server, task in reversed(self.servers):
+                server.should_exit = True
+                await task
+        self.run(stop())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(5)
+
+
+@pytest.fixture(scope="session")
+def harness(tmp_path_factory):
+    workdir = tmp_path_factory.mktemp("adapter")
+    env_file = workdir / ".env"
+    env_file.write_text(f"JM_TOKEN={JM_TOKEN}\nSDP_SESSION=test-sdp-session\n", encoding="utf-8")
+    previous_cwd = os.getcwd()
+    os.chdir(workdir)   # 日志、流量录制和批量任务目录都建在临时目录下
+
+    h = Harness()
+    import mock_upstream
+    mock_port = h.serve(mock_upstream.app)
+    os.environ["XIPUAI_BASE_URL"] = f"http://127.0.0.1:{mock_port}/api/chat"
+
+    # adapter 按调用它的文件所在目录向上查找 .env，测试中固定指向临时目录，不会读写仓库里的 .env
+    import dotenv
+    dotenv.find_dotenv = lambda *args, **kwargs: str(env_file)
+    import adapter
+
+    # 后台任务只保留测试用到的；上游调用不再间隔
+    adapter.ENABLE_HEARTBEAT = False
+    adapter.ENABLE_CONNECTION_PREWARM = False
+    adapter.ENABLE_SESSION_POOL = False
+    adapter.ENABLE_TOKEN_REFRESH = False
+    adapter.ENABLE_BATCHES = True
+    adapter.UPSTREAM_INTERVAL_MIN = 0.0
+    adapter.INTER_REQUEST_DELAY = 0.0
+    for account in adapter.account_pool.accounts.values():
+        account.scheduler.interval = 0.0
+    h.adapter = adapter
+    h.mock = mock_upstream
+    h.mock_port = mock_port
+    h.port = h.serve(adapter.app)
+    h.url = f"http://127.0.0.1:{h.port}"
+    yield h
+    h.close()
+    os.chdir(previous_cwd)
+
+
+@pytest.fixture
+def adapter(harness):
+    return harness.adapter
+
+
+@pytest.fixture
+def mock(harness, monkeypatch):
+    """mock 上游模块；测试中对 settings 的修改在测试结束后还原"""
+    for name, value in vars(harness.mock.settings).items():
+        monkeypatch.setattr(harness.mock.settings, name, value)
+    return harness.mock
+
+
+@pytest.fixture
+def account(adapter):
+    return adapter.account_pool.accounts[""]
+
+
+@pytest.fixture
+def run(harness):
+    return harness.run
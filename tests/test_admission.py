@@ -0,0 +1,125 @@
+# test_admission.py - 准入控制：名额、优先级、客户端轮转、排队上限和超时
+import asyncio
+
+import httpx
+import pytest
+from fastapi import HTTPException
+
+CHAT = {"model": "qwen2.5-72b", "messages": [{"role": "user", "content": "hello"}]}
+
+
+@pytest.fixture
+def controller(adapter, monkeypatch):
+    monkeypatch.setattr(adapter, "ADMISSION_MAX_IN_FLIGHT", 1)
+    monkeypatch.setattr(adapter, "ADMISSION_MAX_QUEUE", 10)
+    monkeypatch.setattr(adapter, "ADMISSION_MAX_QUEUE_PER_CLIENT", 10)
+    monkeypatch.setattr(adapter, "ADMISSION_QUEUE_TIMEOUT", 5)
+    return adapter.AdmissionController()
+
+
+async def admit_order(controller, requests):
+    """第一个名额先被占住，然后按顺序排队；每放行一个就记录下来并立即归还"""
+    blocker = await controller.acquire("blocker", "normal")
+    order = []
+
+    async def waiter(client, priority, label):
+        ticket = await controller.acquire(client, priority)
+        order.append(label)
+        ticket.release()
+    tasks = [asyncio.ensure_future(waiter(*request)) for request in requests]
+    await asyncio.sleep(0)
+    assert controller.waiting == len(requests)
+    blocker.release()
+    await asyncio.gather(*tasks)
+    return order
+
+
+def test_higher_priority_admitted_first(controller, run):
+    order = run(admit_order(controller, [
+        ("a", "low", "low"), ("b", "normal", "normal"), ("c", "high", "high"),
+    ]))
+    assert order == ["high", "normal", "low"]
+
+
+def test_clients_take_turns_within_priority(controller, run):
+    # a 先突发三个请求，b 和 c 随后各一个：不会让 a 的请求全部排在前面
+    order = run(admit_order(controller, [
+        ("a", "normal", "a1"), ("a", "normal", "a2"), ("a", "normal", "a3"),
+        ("b", "normal", "b1"), ("c", "normal", "c1"),
+    ]))
+    assert order == ["a1", "b1", "c1", "a2", "a3"]
+
+
+def test_queue_limits_reject_with_retry_after(controller, adapter, run, monkeypatch):
+    monkeypatch.setattr(adapter, "ADMISSION_MAX_QUEUE", 3)
+    monkeypatch.setattr(adapter, "ADMISSION_MAX_QUEUE_PER_CLIENT", 2)
+
+    async def scenario():
+        blocker = await controller.acquire("blocker", "normal")
+        queued, errors = [], []
+        # a 排满自己的两个位置后被 429 拒绝；b 再排一个，队列总数满了，c 被 503 拒绝
+        for client in ("a", "a", "a", "b", "c"):
+            task = asyncio.ensure_future(controller.acquire(client, "normal"))
+            await asyncio.sleep(0)
+            if task.done():
+                errors.append((task.exception().status_code, task.exception().headers["Retry-After"]))
+            else:
+                queued.append(task)
+        for task in queued:
+            task.cancel()
+        await asyncio.gather(*queued, return_exceptions=True)
+        blocker.release()
+        return errors
+    errors = run(scenario())
+    assert [status for status, _ in errors] == [429, 503]
+    assert all(int(retry_after) >= 1 for _, retry_after in errors)
+    assert controller.rejected == {"client_queue_full": 1, "queue_full": 1}
+    assert controller.active == 0 and controller.waiting == 0 and controller.client_waiting == {}
+
+
+def test_queue_timeout_and_cancelled_waiters_leave_no_trace(controller, adapter, run, monkeypatch):
+    monkeypatch.setattr(adapter, "ADMISSION_QUEUE_TIMEOUT", 0.05)
+
+    async def scenario():
+        blocker = await controller.acquire("blocker", "normal")
+        with pytest.raises(HTTPException) as excinfo:
+            await controller.acquire("a", "normal")
+        assert excinfo.value.status_code == 503
+        cancelled = asyncio.ensure_future(controller.acquire("b", "high"))
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        await asyncio.gather(cancelled, return_exceptions=True)
+        blocker.release()
+    run(scenario())
+    assert controller.rejected == {"queue_timeout": 1}
+    assert controller.active == 0 and controller.waiting == 0
+    assert controller.client_waiting == {} and all(not q for q in controller.queues.values())
+
+
+def test_ticket_release_is_idempotent(controller, run):
+    async def scenario():
+        ticket = await controller.acquire("a", "normal")
+        ticket.release()
+        ticket.release()
+    run(scenario())
+    assert controller.active == 0
+    assert controller.avg_generation is not None
+
+
+def test_queued_requests_are_served_over_http(adapter, mock, harness, run, monkeypatch):
+    monkeypatch.setattr(adapter, "ENABLE_ADMISSION_CONTROL", True)
+    monkeypatch.setattr(adapter, "ENABLE_REQUEST_COALESCING", False)
+    monkeypatch.setattr(adapter, "ADMISSION_MAX_IN_FLIGHT", 1)
+    monkeypatch.setattr(mock.settings, "chunks", 5)
+    monkeypatch.setattr(mock.settings, "chunk_delay", 0.02)
+    admitted = adapter.admission.admitted
+
+    async def scenario():
+        async with httpx.AsyncClient(base_url=harness.url, timeout=30) as client:
+            bodies = [dict(CHAT, messages=[{"role": "user", "content": f"hello {i}"}]) for i in range(3)]
+            return await asyncio.gather(*(client.post("/v1/chat/completions", json=body) for body in bodies))
+    responses = run(scenario())
+    assert [r.status_code for r in responses] == [200, 200, 200]
+    assert all(r.json()["choices"][0]["message"]["content"] for r in responses)
+    assert adapter.admission.admitted - admitted == 3
+    assert adapter.admission.active == 0 and adapter.admission.waiting == 0
@@ -0,0 +1,145 @@
+# test_batches.py - 批量任务：BatchStore 的文件格式，以及通过 HTTP 上传、处理、续跑和取消
+import json
+import time
+
+import httpx
+import pytest
+
+from batches import BatchStore
+
+
+def request_line(custom_id: str, content: str = "hello") -> dict:
+    return {"custom_id": custom_id, "method": "POST", "url": "/v1/chat/completions",
+            "body": {"model": "qwen2.5-72b", "messages": [{"role": "user", "content": content}]}}
+
+
+def jsonl(lines: list) -> bytes:
+    return "".join(json.dumps(line, ensure_ascii=False) + "\n" for line in lines).encode("utf-8")
+
+
+# --- BatchStore ---
+
+def test_read_input_splits_only_on_newlines(tmp_path):
+    store = BatchStore(str(tmp_path))
+    content = 'line one\r\n\n  \n{"x": " "}'.encode("utf-8")
+    info = store.create_file(content, "in.jsonl", "batch")
+    assert info["bytes"] == len(content)
+    assert store.read_input(info["id"]) == ["line one", '{"x": " "}']
+
+
+def test_batch_lifecycle_on_disk(tmp_path):
+    store = BatchStore(str(tmp_path))
+    input_file = store.create_file(jsonl([request_line("a"), request_line("b")]), "in.jsonl", "batch")
+    batch = store.create_batch(input_file["id"], "/v1/chat/completions", "24h", 3600, {"k": "v"}, 2)
+    rejected = store.create_batch(input_file["id"], "/v1/chat/completions", "24h", 3600, None, 0,
+                                  errors=[{"code": "empty_file", "message": "", "param": None, "line": None}])
+    assert batch["status"] == "in_progress" and rejected["status"] == "failed"
+    assert [b["id"] for b in store.active_batches()] == [batch["id"]]
+    assert store.files_in_use() == {input_file["id"], batch["output_file_id"], batch["error_file_id"]}
+
+    store.append_results(batch, [({"custom_id": "a"}, False), ({"custom_id": "b"}, True)])
+    with open(store.file_path(batch["output_file_id"]), "a", encoding="utf-8") as f:
+        f.write('{"custom_id": "half-writ')     # 写到一半时进程退出
+    assert store.finished_ids(batch) == {"completed": {"a"}, "failed": {"b"}}
+    assert store.file(batch["error_file_id"])["bytes"] > 0
+
+    store.update_batch(batch["id"], lambda b: b.update(status="completed"))
+    assert store.batch(batch["id"])["status"] == "completed"
+    assert store.active_batches() == [] and store.files_in_use() == set()
+    assert store.delete_file(input_file["id"]) and not store.delete_file(input_file["id"])
+
+
+# --- 通过 HTTP ---
+
+@pytest.fixture
+def client(harness, mock, monkeypatch):
+    monkeypatch.setattr(mock.settings, "ttft", 0.05)
+    monkeypatch.setattr(mock.settings, "chunks", 3)
+    with httpx.Client(base_url=harness.url, timeout=30) as client:
+        yield client
+
+
+def upload(client, lines: list) -> str:
+    response = client.post("/v1/files?purpose=batch&filename=in.jsonl", content=jsonl(lines),
+                           headers={"content-type": "application/jsonl"})
+    assert response.status_code == 200
+    return response.json()["id"]
+
+
+def wait_for(client, batch_id: str, statuses: tuple, timeout: float = 20) -> dict:
+    for _ in range(int(timeout / 0.05)):
+        batch = client.get(f"/v1/batches/{batch_id}").json()
+        if batch["status"] in statuses:
+            return batch
+        time.sleep(0.05)
+    raise AssertionError(f"batch stayed {batch['status']}")
+
+
+def results(client, file_id: str) -> list:
+    return [json.loads(line) for line in client.get(f"/v1/files/{file_id}/content").text.splitlines()]
+
+
+def test_batch_runs_to_completion(client, mock):
+    completions = mock.stats["completions"]
+    file_id = upload(client, [request_line(f"req-{i}", f"question {i}") for i in range(4)])
+    batch = client.post("/v1/batches", json={"input_file_id": file_id, "endpoint": "/v1/chat/completions",
+                                             "completion_window": "24h"}).json()
+    assert batch["status"] == "in_progress"
+    batch = wait_for(client, batch["id"], ("completed",))
+    assert batch["request_counts"] == {"total": 4, "completed": 4, "failed": 0}
+    records = results(client, batch["output_file_id"])
+    assert sorted(r["custom_id"] for r in records) == [f"req-{i}" for i in range(4)]
+    assert all(r["response"]["status_code"] == 200 and r["response"]["body"]["choices"][0]["message"]["content"]
+               for r in records)
+    assert results(client, batch["error_file_id"]) == []
+    assert mock.stats["completions"] - completions == 4
+    # 结束的任务不再占用文件
+    assert client.delete(f"/v1/files/{file_id}").status_code == 200
+
+
+def test_invalid_input_fails_without_running(client, mock):
+    completions = mock.stats["completions"]
+    file_id = upload(client, [request_line("dup"), request_line("dup")])
+    batch = client.post("/v1/batches", json={"input_file_id": file_id}).json()
+    assert batch["status"] == "failed"
+    assert [e["code"] for e in batch["errors"]["data"]] == ["duplicate_custom_id"]
+    assert mock.stats["completions"] == completions
+
+
+def test_runner_resumes_from_saved_results(adapter, client, mock):
+    lines = [request_line(f"req-{i}") for i in range(3)]
+    file_id = upload(client, lines)
+
+    def prepare():
+        # 模拟上次运行中已经写入了第一行的结果
+        batch = adapter.batch_store.create_batch(file_id, "/v1/chat/completions", "24h", 3600, None, len(lines))
+        adapter.batch_store.append_results(batch, [({"id": "batch_req_old", "custom_id": "req-0"}, False)])
+        return batch
+    completions = mock.stats["completions"]
+    batch = prepare()
+    adapter.batch_runner.wake()
+    batch = wait_for(client, batch["id"], ("completed",))
+    assert batch["request_counts"] == {"total": 3, "completed": 3, "failed": 0}
+    assert mock.stats["completions"] - completions == 2
+    assert [r["custom_id"] for r in results(client, batch["output_file_id"])][0] == "req-0"
+
+
+def test_cancel_stops_new_requests(adapter, client, mock, monkeypatch):
+    monkeypatch.setattr(adapter, "BATCH_MAX_IN_FLIGHT", 1)
+    monkeypatch.setattr(mock.settings, "ttft", 0.2)
+    file_id = upload(client, [request_line(f"req-{i}") for i in range(20)])
+    batch = client.post("/v1/batches", json={"input_file_id": file_id}).json()
+    wait_for(client, batch["id"], ("in_progress",))
+    response = client.post(f"/v1/batches/{batch['id']}/cancel")
+    assert response.json()["status"] in ("cancelling", "cancelled")
+    batch = wait_for(client, batch["id"], ("cancelled",))
+    counts = batch["request_counts"]
+    assert counts["completed"] < 20
+    assert len(results(client, batch["output_file_id"])) == counts["completed"]
+    assert adapter.batch_runner.in_flight == 0
+
+
+def test_disabled_batch_api_returns_404(adapter, client, monkeypatch):
+    monkeypatch.setattr(adapter, "ENABLE_BATCHES", False)
+    assert client.get("/v1/batches").status_code == 404
+    assert client.post("/v1/files?purpose=batch", content=b"{}\n").status_code == 404
@@ -0,0 +1,120 @@
+# test_coalescing.py - 相同请求合并：共享一次生成，首个请求失败或离开时等待中的请求接替或得到同样的错误
+import asyncio
+
+import httpx
+import pytest
+
+CHAT = {"model": "qwen2.5-72b", "temperature": 0, "messages": [{"role": "user", "content": "same question"}]}
+
+
+@pytest.fixture(autouse=True)
+def coalescing(adapter, mock, monkeypatch):
+    monkeypatch.setattr(adapter, "ENABLE_REQUEST_COALESCING", True)
+    monkeypatch.setattr(adapter, "ENABLE_RESPONSE_CACHE", False)
+    monkeypatch.setattr(mock.settings, "ttft", 0.2)
+    monkeypatch.setattr(mock.settings, "chunks", 10)
+    monkeypatch.setattr(mock.settings, "chunk_delay", 0.02)
+
+
+def expected_answer(mock) -> str:
+    size = mock.settings.chunk_size
+    text = mock.FILLER * 2
+    return "".join(text[(i * size) % len(mock.FILLER):][:size] for i in range(mock.settings.chunks))
+
+
+async def until(condition, timeout: float = 5):
+    for _ in range(int(timeout / 0.01)):
+        if condition():
+            return
+        await asyncio.sleep(0.01)
+    raise AssertionError("condition not reached")
+
+
+def assert_clean(adapter, account):
+    assert adapter.single_flight.flights == {}
+    assert account.in_flight == 0
+    assert adapter.admission.active == 0 and adapter.admission.waiting == 0
+
+
+def test_identical_requests_share_one_generation(adapter, account, mock, harness, run):
+    completions = mock.stats["completions"]
+    followers = adapter.single_flight.followers
+
+    async def scenario():
+        async with httpx.AsyncClient(base_url=harness.url, timeout=30) as client:
+            return await asyncio.gather(*(client.post("/v1/chat/completions", json=CHAT) for _ in range(3)))
+    responses = run(scenario())
+    assert [r.status_code for r in responses] == [200, 200, 200]
+    assert {r.json()["choices"][0]["message"]["content"] for r in responses} == {expected_answer(mock)}
+    assert mock.stats["completions"] - completions == 1
+    assert adapter.single_flight.followers - followers == 2
+    assert_clean(adapter, account)
+
+
+def test_follower_takes_over_when_leader_disconnects_while_queued(adapter, account, mock, harness, run, monkeypatch):
+    monkeypatch.setattr(adapter, "ENABLE_ADMISSION_CONTROL", True)
+    monkeypatch.setattr(adapter, "ADMISSION_MAX_IN_FLIGHT", 1)
+    followers = adapter.single_flight.followers
+
+    async def scenario():
+        blocker = await adapter.admission.acquire("blocker", "normal")
+        async with httpx.AsyncClient(base_url=harness.url, timeout=30) as client:
+            leader = asyncio.ensure_future(client.post("/v1/chat/completions", json=CHAT))
+            await until(lambda: adapter.single_flight.flights)
+            flight = next(iter(adapter.single_flight.flights.values()))
+            follower = asyncio.ensure_future(client.post("/v1/chat/completions", json=CHAT))
+            await until(lambda: adapter.single_flight.followers > followers)
+            # 首个请求还在准入队列里时客户端离开，生成没有开始，等待中的请求接替
+            leader.cancel()
+            await until(lambda: flight.abandoned)
+            blocker.release()
+            return await follower
+    response = run(scenario())
+    assert response.status_code == 200
+    assert response.json()["choices"][0]["message"]["content"] == expected_answer(mock)
+    assert_clean(adapter, account)
+
+
+def test_followers_get_the_leader_error(adapter, account, mock, harness, run, monkeypatch):
+    monkeypatch.setattr(adapter, "ENABLE_ADMISSION_CONTROL", True)
+    monkeypatch.setattr(adapter, "ADMISSION_MAX_IN_FLIGHT", 1)
+    monkeypatch.setattr(adapter, "ENABLE_UPSTREAM_RETRY", False)
+    monkeypatch.setattr(mock.settings, "error_rate", 1.0)
+    followers = adapter.single_flight.followers
+    completions = mock.stats["completions"]
+
+    async def scenario():
+        # 名额先占住，保证等待中的请求在首个请求失败之前已经加入
+        blocker = await adapter.admission.acquire("blocker", "normal")
+        async with httpx.AsyncClient(base_url=harness.url, timeout=30) as client:
+            requests = [asyncio.ensure_future(client.post("/v1/chat/completions", json=CHAT)) for _ in range(2)]
+            await until(lambda: adapter.single_flight.followers > followers)
+            blocker.release()
+            return await asyncio.gather(*requests)
+    responses = run(scenario())
+    assert responses[0].status_code >= 500
+    assert [r.status_code for r in responses[1:]] == [responses[0].status_code]
+    assert mock.stats["completions"] - completions == 1
+    assert_clean(adapter, account)
+
+
+def test_follower_keeps_generation_when_leader_leaves_mid_stream(adapter, account, mock, harness, run):
+    completions = mock.stats["completions"]
+    followers = adapter.single_flight.followers
+
+    async def scenario():
+        async with httpx.AsyncClient(base_url=harness.url, timeout=30) as client:
+            async with client.stream("POST", "/v1/chat/completions", json=dict(CHAT, stream=True)) as leader:
+                lines = leader.aiter_lines()
+                while not (await lines.__anext__()).startswith("data:"):
+                    pass
+                follower = asyncio.ensure_future(client.post("/v1/chat/completions", json=CHAT))
+                await until(lambda: adapter.single_flight.followers > followers)
+            # 首个请求读到第一个片段后断开，生成继续进行，等待中的请求拿到完整回答
+            return await follower
+    response = run(scenario())
+    assert response.status_code == 200
+    assert response.json()["choices"][0]["message"]["content"] == expected_answer(mock)
+    assert mock.stats["completions"] - completions == 1
+    run(until(lambda: account.in_flight == 0))
+    assert_clean(adapter, account)
@@ -0,0 +1,66 @@
+# test_disconnect.py - 客户端在响应开始发送之前断开时，会话、名额和 in_flight 都要归还
+import asyncio
+import json
+
+CHAT = {"model": "qwen2.5-72b", "stream": True, "messages": [{"role": "user", "content": "hello"}]}
+
+
+async def drop_before_body(adapter, body: dict):
+    """直接调用 ASGI 应用：请求发完之后连接就断了，发送响应头时 send 抛出 OSError（ASGI 2.4 的约定），
+    Starlette 不会再迭代响应体"""
+    scope = {
+        "type": "http", "asgi": {"version": "3.0", "spec_version": "2.4"}, "http_version": "1.1",
+        "method": "POST", "scheme": "http", "path": "/v1/chat/completions", "raw_path": b"/v1/chat/completions",
+        "query_string": b"", "root_path": "", "headers": [(b"content-type", b"application/json")],
+        "client": ("127.0.0.1", 50000), "server": ("127.0.0.1", 80),
+    }
+    messages = [{"type": "http.request", "body": json.dumps(body).encode(), "more_body": False}]
+    sent = []
+
+    async def receive():
+        if messages:
+            return messages.pop(0)
+        await asyncio.Event().wait()
+
+    async def send(message):
+        sent.append(message["type"])
+        raise OSError("connection reset by peer")
+
+    try:
+        await adapter.app(scope, receive, send)
+    except Exception:
+        pass
+    return sent
+
+
+def test_streaming_lease_released_when_body_never_read(adapter, account, mock, run, monkeypatch):
+    monkeypatch.setattr(adapter, "ENABLE_ADMISSION_CONTROL", True)
+    monkeypatch.setattr(adapter, "ENABLE_REQUEST_COALESCING", False)
+    completions = mock.stats["completions"]
+
+    sent = run(drop_before_body(adapter, CHAT))
+    assert sent == ["http.response.start"]
+    assert account.in_flight == 0
+    assert adapter.admission.active == 0
+    # 会话没有用过，按配置删除
+    run(account.deleter.flush())
+    assert mock.sessions.get(adapter.credential_store.get("JM_TOKEN"), {}) == {}
+    assert mock.stats["completions"] == completions
+
+
+def test_coalesced_generation_cancelled_when_leader_body_never_read(adapter, account, mock, run, monkeypatch):
+    monkeypatch.setattr(adapter, "ENABLE_ADMISSION_CONTROL", True)
+    monkeypatch.setattr(adapter, "ENABLE_REQUEST_COALESCING", True)
+    request = dict(CHAT, temperature=0, messages=[{"role": "user", "content": "coalesce me"}])
+
+    async def scenario():
+        await drop_before_body(adapter, request)
+        # 唯一的订阅者离开，后台的生成随之取消
+        for _ in range(100):
+            if not adapter.single_flight.flights and account.in_flight == 0:
+                break
+            await asyncio.sleep(0.05)
+    run(scenario())
+    assert adapter.single_flight.flights == {}
+    assert account.in_flight == 0
+    assert adapter.admission.active == 0
@@ -0,0 +1,97 @@
+# test_relay.py - relay.py 中原始字节 SSE 解析器和片段合并的单元测试
+import asyncio
+import json
+
+from relay import OpenAIChunkWriter, UpstreamSSEParser, coalesce_deltas
+
+
+def sse(*texts) -> bytes:
+    return b"".join(b"data: " + json.dumps({"data": t}, ensure_ascii=False).encode("utf-8") + b"\n\n" for t in texts)
+
+
+def test_parser_handles_chunks_split_anywhere():
+    raw = sse("你好", "，世界", "!") + b"data: [DONE]\n\n"
+    # 每个切分位置都试一遍，包括切在多字节 UTF-8 字符中间
+    for cut in range(1, len(raw)):
+        parser = UpstreamSSEParser()
+        assert parser.feed(raw[:cut]) + parser.feed(raw[cut:]) + parser.close() == ["你好", "，世界", "!"]
+
+
+def test_parser_byte_by_byte():
+    raw = sse("a", "bc", "😀")
+    parser = UpstreamSSEParser()
+    deltas = []
+    for i in range(len(raw)):
+        deltas += parser.feed(raw[i:i + 1])
+    assert deltas + parser.close() == ["a", "bc", "😀"]
+
+
+def test_parser_crlf_and_last_line_without_newline():
+    parser = UpstreamSSEParser()
+    assert parser.feed(b'data: {"data": "x"}\r\n\r\ndata:{"data":"y"}') == ["x"]
+    assert parser.close() == ["y"]
+    assert parser.buffer == b""
+
+
+def test_parser_skips_noise():
+    parser = UpstreamSSEParser()
+    raw = (b": keep-alive\n"
+           b"event: message\n"
+           b"data:\n"
+           b"data: not json\n"
+           b"data: [1, 2]\n"
+           b'data: {"data": 3}\n'
+           b'data: {"other": "x"}\n'
+           b"data: [DONE]\n"
+           b'data: {"data": ""}\n')
+    assert parser.feed(raw) == [""]
+
+
+def test_chunk_writer_matches_json_serialization():
+    writer = OpenAIChunkWriter("qwen2.5-72b")
+    text = 'quote " backslash \\ newline \n 中文 😀'
+    frame = writer.content(text)
+    assert frame.startswith(b"data: ") and frame.endswith(b"\n\n")
+    chunk = json.loads(frame[6:])
+    assert chunk["id"] == writer.completion_id
+    assert chunk["choices"] == [{"index": 0, "delta": {"content": text}, "finish_reason": None}]
+    assert writer.finish().endswith(b"data: [DONE]\n\n")
+
+
+async def deltas_from(items):
+    for delay, text in items:
+        await asyncio.sleep(delay)
+        yield text
+
+
+async def collect(stream):
+    return [item async for item in stream]
+
+
+def test_coalesce_sends_first_delta_then_merges_window():
+    items = [(0, "a"), (0, "b"), (0, "c"), (0.2, "d")]
+    out = asyncio.run(collect(coalesce_deltas(deltas_from(items), window=0.05, max_bytes=1024)))
+    assert out == ["a", "bc", "d"]
+
+
+def test_coalesce_flushes_at_max_bytes():
+    items = [(0, "first")] + [(0, "xx")] * 4
+    out = asyncio.run(collect(coalesce_deltas(deltas_from(items), window=10, max_bytes=4)))
+    assert out == ["first", "xxxx", "xxxx"]
+
+
+def test_coalesce_flushes_buffer_before_error():
+    async def failing():
+        yield "a"
+        yield "b"
+        raise RuntimeError("upstream broke")
+
+    async def scenario():
+        out = []
+        try:
+            async for item in coalesce_deltas(failing(), window=10, max_bytes=1024):
+                out.append(item)
+        except RuntimeError:
+            out.append("error")
+        return out
+    assert asyncio.run(scenario()) == ["a", "b", "error"]
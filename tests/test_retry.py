@@ -0,0 +1,96 @@
+# test_retry.py - 重试预算：每个客户端请求只存入一次，每次重试取走一个令牌，预算或次数用完时拒绝
+import httpx
+import pytest
+
+CHAT = {"model": "qwen2.5-72b", "messages": [{"role": "user", "content": "hello"}]}
+
+
+@pytest.fixture
+def policy(adapter, monkeypatch):
+    """换上一个全新的 RetryPolicy，退避时间为 0"""
+    monkeypatch.setattr(adapter, "ENABLE_UPSTREAM_RETRY", True)
+    monkeypatch.setattr(adapter, "RETRY_MAX_ATTEMPTS", 3)
+    monkeypatch.setattr(adapter, "RETRY_BUDGET_RATIO", 0.2)
+    monkeypatch.setattr(adapter, "RETRY_BUDGET_MAX", 10)
+    monkeypatch.setattr(adapter, "RETRY_BACKOFF_BASE", 0.0)
+    monkeypatch.setattr(adapter, "ENABLE_REQUEST_COALESCING", False)
+    policy = adapter.RetryPolicy()
+    monkeypatch.setattr(adapter, "retry_policy", policy)
+    return policy
+
+
+def error(adapter, kind: str = "server_error"):
+    return adapter.UpstreamError(kind, 502, "boom")
+
+
+def test_deposit_is_capped(policy):
+    assert policy.tokens == 10
+    policy.deposit()
+    assert policy.tokens == 10
+    policy.tokens = 0
+    for _ in range(5):
+        policy.deposit()
+    assert policy.tokens == pytest.approx(1.0)
+
+
+def test_allow_spends_tokens_and_counts_denials(adapter, policy):
+    policy.tokens = 1.5
+    assert policy.allow(error(adapter), 1, "completions")
+    assert policy.tokens == pytest.approx(0.5) and policy.retries == 1
+    # 不值得重试的错误既不花预算也不计入拒绝
+    assert not policy.allow(error(adapter, "bad_request"), 1, "completions")
+    assert not policy.allow(error(adapter), 1, "completions")
+    assert not policy.allow(error(adapter), 3, "completions")
+    assert policy.denied == {"budget": 1, "attempts": 1}
+    assert policy.tokens == pytest.approx(0.5) and policy.retries == 1
+
+
+def test_disabled_retry_never_spends(adapter, policy, monkeypatch):
+    monkeypatch.setattr(adapter, "ENABLE_UPSTREAM_RETRY", False)
+    assert not policy.allow(error(adapter), 1, "completions")
+    assert policy.tokens == 10 and policy.retries == 0 and policy.denied == {}
+
+
+def test_call_retries_without_depositing(adapter, policy, run):
+    calls = []
+
+    async def flaky():
+        calls.append(1)
+        if len(calls) < 3:
+            raise error(adapter, "rate_limited")
+        return "ok"
+    assert run(policy.call("saveSession", flaky)) == "ok"
+    assert len(calls) == 3
+    assert policy.retries == 2 and policy.tokens == 8
+
+
+def test_successful_request_deposits_once(adapter, policy, harness):
+    policy.tokens = 5.0
+    response = httpx.post(f"{harness.url}/v1/chat/completions", json=CHAT, timeout=30)
+    assert response.status_code == 200
+    assert policy.tokens == pytest.approx(5.2)
+    assert policy.retries == 0
+
+
+def test_failing_request_stops_at_max_attempts(adapter, policy, mock, harness, monkeypatch):
+    monkeypatch.setattr(mock.settings, "error_rate", 1.0)
+    policy.tokens = 5.0
+    completions = mock.stats["completions"]
+    response = httpx.post(f"{harness.url}/v1/chat/completions", json=CHAT, timeout=30)
+    assert response.status_code >= 500
+    assert mock.stats["completions"] - completions == 3
+    # 存入一次 0.2，重试两次各取走 1
+    assert policy.tokens == pytest.approx(3.2)
+    assert policy.retries == 2 and policy.denied == {"attempts": 1}
+
+
+def test_exhausted_budget_stops_retrying(adapter, policy, mock, harness, monkeypatch):
+    monkeypatch.setattr(mock.settings, "error_rate", 1.0)
+    policy.tokens = 0.9
+    completions = mock.stats["completions"]
+    response = httpx.post(f"{harness.url}/v1/chat/completions", json=CHAT, timeout=30)
+    assert response.status_code >= 500
+    # 0.9 + 0.2 只够重试一次
+    assert mock.stats["completions"] - completions == 2
+    assert policy.tokens == pytest.approx(0.1)
+    assert policy.retries == 1 and policy.denied == {"budget": 1}
@@ -7,7 +7,8 @@ from dotenv import load_dotenv, find_dotenv, set_key
 import sys
 
 # ================== 配置 ==================
-BASE_URL = "https://jmapi.xjtlu.edu.cn/api/chat"
+# 可用环境变量 XIPUAI_BASE_URL 指向本地的 mock_upstream.py 做测试
+BASE_URL = os.getenv("XIPUAI_BASE_URL", "https://jmapi.xjtlu.edu.cn/api/chat")
 # 目标接口仍然是 saveSession
 SESSION_API_URL = f"{BASE_URL}/saveSession?sf_request_type=ajax"
 # ==========================================
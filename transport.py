@@ -0,0 +1,118 @@
+# transport.py - 到上游的 HTTP 连接层：HTTP/2 复用、连接池上限、分开的超时设置、预热和连接复用统计
+import importlib.util
+import time
+from urllib.parse import urlsplit
+
+import httpx
+
+# httpx 的 HTTP/2 支持依赖 h2（见 libraries），没有安装时退回 HTTP/1.1
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+
+class UpstreamTransport:
+    """包装一个共享的 httpx.AsyncClient。
+
+    控制类调用（saveSession / delSession / 心跳）和流式 completions 使用不同的超时；
+    每个请求都挂上 httpcore 的 trace 扩展，统计新建连接、TLS 握手和连接复用情况。
+    """
+
+    def __init__(self, http2: bool, limits: httpx.Limits, control_timeout: httpx.Timeout, stream_timeout: httpx.Timeout):
+        self.http2 = http2 and HTTP2_AVAILABLE
+        self.control_timeout = control_timeout
+        self.stream_timeout = stream_timeout
+        self.client = httpx.AsyncClient(http2=self.http2, limits=limits, timeout=control_timeout)
+        self.requests = 0
+        self.connections_opened = 0
+        self.tls_handshakes = 0
+        self.connect_seconds = 0.0
+        self.prewarms = 0
+        self.http_versions = {}
+        self.last_request = 0.0
+
+    def _tracer(self, counted: bool = True):
+        """为单个请求生成 trace 回调；建连耗时从 TCP 开始算到请求头开始发送。
+
+        counted 为 False 的请求（预热）不计入请求数和最近请求时间，否则预热本身会让连接看起来一直有流量。
+        """
+        connect_started = None
+
+        async def trace(event_name: str, info: dict):
+            nonlocal connect_started
+            if event_name == "connection.connect_tcp.started":
+                connect_started = time.perf_counter()
+            elif event_name == "connection.connect_tcp.complete":
+                self.connections_opened += 1
+            elif event_name == "connection.start_tls.complete":
+                self.tls_handshakes += 1
+            elif event_name in ("http11.send_request_headers.started", "http2.send_request_headers.started"):
+                if counted:
+                    self.requests += 1
+                    self.last_request = time.time()
+                if connect_started is not None:
+                    self.connect_seconds += time.perf_counter() - connect_started
+                    connect_started = None
+        return trace
+
+    def _count_version(self, response: httpx.Response):
+        self.http_versions[response.http_version] = self.http_versions.get(response.http_version, 0) + 1
+
+    async def post(self, url: str, **kwargs) -> httpx.Response:
+        """控制类调用：较短的超时"""
+        response = await self.client.post(url, timeout=self.control_timeout, extensions={"trace": self._tracer()}, **kwargs)
+        self._count_version(response)
+        return response
+
+    def stream(self, method: str, url: str, **kwargs):
+        """流式调用：较长的读超时，返回 httpx 的流式上下文管理器"""
+        return _CountingStream(self, self.client.stream(method, url, timeout=self.stream_timeout,
+                                                        extensions={"trace": self._tracer()}, **kwargs))
+
+    async def prewarm(self, url: str):
+        """提前建立到上游主机的连接（DNS + TCP + TLS），请求本身的结果不重要"""
+        parts = urlsplit(url)
+        origin = f"{parts.scheme}://{parts.netloc}/"
+        try:
+            response = await self.client.head(origin, timeout=self.control_timeout, extensions={"trace": self._tracer(counted=False)})
+            self._count_version(response)
+        except httpx.HTTPError:
+            return False
+        self.prewarms += 1
+        return True
+
+    def idle_for(self) -> float:
+        return time.time() - self.last_request if self.last_request else float("inf")
+
+    async def aclose(self):
+        await self.client.aclose()
+
+    def status(self) -> dict:
+        reused = max(0, self.requests - self.connections_opened)
+        return {
+            "http2": self.http2,
+            "http2_available": HTTP2_AVAILABLE,
+            "requests": self.requests,
+            "connections_opened": self.connections_opened,
+            "tls_handshakes": self.tls_handshakes,
+            "reused_requests": reused,
+            "reuse_ratio": round(reused / self.requests, 3) if self.requests else None,
+            "avg_connect_ms": round(self.connect_seconds / self.connections_opened * 1000, 1) if self.connections_opened else None,
+            "http_versions": dict(self.http_versions),
+            "prewarms": self.prewarms,
+            "idle_seconds": round(self.idle_for(), 1) if self.last_request else None,
+        }
+
+
+class _CountingStream:
+    """在 client.stream() 的上下文管理器外面记录协商到的 HTTP 版本"""
+
+    def __init__(self, transport: UpstreamTransport, context):
+        self.transport = transport
+        self.context = context
+
+    async def __aenter__(self) -> httpx.Response:
+        response = await self.context.__aenter__()
+        self.transport._count_version(response)
+        return response
+
+    async def __aexit__(self, *exc_info):
+        return await self.context.__aexit__(*exc_info)